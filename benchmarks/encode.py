@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+"""
+Encode throughput for large add_group_members payloads.
+
+Compares muddle.encoding.encode_params with the per-item dict.update loop
+the API modules used before it.
+
+    python benchmarks/encode.py [members]
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from muddle.encoding import encode_params
+
+
+def loop_encode(members):
+    option_params = {}
+    for i, member in enumerate(members):
+        option_params.update({
+            'members[%s][groupid]' % i: member['groupid'],
+            'members[%s][userid]' % i: member['userid']
+        })
+    params = {'wsfunction': 'core_group_add_group_members'}
+    params.update(option_params)
+    return params
+
+
+def main(size=50000, repeat=5):
+    members = [{'groupid': i % 300, 'userid': i} for i in range(size)]
+    cases = [
+        ('dict.update loop', lambda: loop_encode(members)),
+        ('encode_params', lambda: encode_params('core_group_add_group_members', {'members': members})),
+    ]
+    print('%d members, best of %d' % (size, repeat))
+    for name, encode in cases:
+        best = min(timeit.repeat(encode, number=1, repeat=repeat))
+        print('%-18s %8.1f ms  %10.0f members/s' % (name, best * 1000, size / best))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
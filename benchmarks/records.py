@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+"""
+Memory held by decoded user lists: full dicts, as get_users_by_field
+returns by default, against muddle.records types and field projections.
+
+Users are decoded from synthetic get_users_by_field JSON a chunk at a time,
+as the API does, and the memory still allocated once all are loaded is
+measured with tracemalloc.
+
+    python benchmarks/records.py [users]
+"""
+
+import gc
+import json
+import os
+import sys
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from muddle.records import User, project
+
+CHUNK = 100
+
+
+def make_user(i):
+    return {
+        'id': i, 'username': 'user%06d' % i, 'firstname': 'First%d' % i,
+        'lastname': 'Last%d' % i, 'fullname': 'First%d Last%d' % (i, i),
+        'email': 'user%06d@example.org' % i, 'address': '', 'phone1': '',
+        'phone2': '', 'icq': '', 'skype': '', 'yahoo': '', 'aim': '', 'msn': '',
+        'department': 'Department %d' % (i % 40), 'institution': 'University',
+        'idnumber': '%08d' % i, 'interests': '', 'firstaccess': 1500000000 + i,
+        'lastaccess': 1600000000 + i, 'auth': 'ldap', 'suspended': False,
+        'confirmed': True, 'lang': 'en', 'calendartype': 'gregorian',
+        'theme': '', 'timezone': '99', 'mailformat': 1,
+        'description': '', 'descriptionformat': 1, 'city': 'Dunedin',
+        'url': '', 'country': 'NZ',
+        'profileimageurlsmall': 'https://moodle.example.org/theme/image.php/f2',
+        'profileimageurl': 'https://moodle.example.org/theme/image.php/f1',
+        'customfields': [
+            {'type': 'text', 'value': 'Programme %d' % (i % 90), 'name': 'Programme',
+             'shortname': 'programme'},
+            {'type': 'text', 'value': str(2015 + i % 8), 'name': 'Cohort',
+             'shortname': 'cohort'},
+        ],
+        'preferences': [
+            {'name': 'auth_forcepasswordchange', 'value': '0'},
+            {'name': 'email_bounce_count', 'value': '0'},
+            {'name': 'email_send_count', 'value': str(i % 50)},
+        ],
+    }
+
+
+def held(responses, convert):
+    """ Bytes still allocated after decoding and converting every chunk """
+    gc.collect()
+    tracemalloc.start()
+    users = []
+    for response in responses:
+        users.extend(convert(json.loads(response)))
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return len(users), size
+
+
+def main(size=100000):
+    responses = [json.dumps([make_user(i) for i in range(start, min(start + CHUNK, size))])
+                 for start in range(0, size, CHUNK)]
+    cases = [
+        ('dicts', lambda users: users),
+        ('records.User', lambda users: project(users, User)),
+        ("('id', 'username', 'idnumber')", lambda users: project(users, ('id', 'username', 'idnumber'))),
+    ]
+    print('%d users' % size)
+    baseline = None
+    for name, convert in cases:
+        count, size_held = held(responses, convert)
+        baseline = baseline or size_held
+        print('%-32s %8.1f MB  %5.1f%%  %6d bytes/user' % (
+            name, size_held / 1e6, 100.0 * size_held / baseline, size_held / count))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:]])
@@ -17,5 +17,5 @@ __version__ = '0.2.0'
 
 # Module namespace.
 
-from .muddle import AppConfig, WSConfig, Config
+from .muddle import AppConfig, WSConfig, AsyncWSConfig, Config
 from .muddle import group, users, course, category, localpresentation, stats
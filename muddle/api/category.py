@@ -1,9 +1,153 @@
-from muddle.utils import valid_options
+from muddle.config import AsyncWSConfig
+from muddle.encoding import encode_params
+from muddle.exceptions import MuddleError, check_response
+from muddle.records import Category, record_type
+from muddle.utils import bisect_failures, chunks, valid_options
+
+
+class CategoryTree:
+    """
+    The whole category hierarchy, from one core_course_get_categories
+    call, indexed for local lookups. Made by API.tree.
+
+    Categories are held in depth-first order with each category's span in
+    that order, so a subtree is a slice and "is X under Y" is a
+    comparison.
+
+    :keyword dict categories: category id -> category
+    :keyword dict idnumbers: idnumber -> category id (categories with one)
+    :keyword dict paths: Moodle id path, e.g. '/1/5/9' -> category id
+    :keyword dict names: name path, e.g. 'Science/Physics' -> category id
+    """
+
+    def __init__(self, categories, fields=None):
+        record = record_type(fields or Category)
+        for field in ('id', 'name', 'idnumber', 'parent', 'sortorder', 'path'):
+            if field not in record.FIELDS:
+                raise ValueError("Tree fields must include '%s'" % field)
+        self.categories = {}
+        self._children = {0: []}
+        for data in categories:
+            category = record.from_dict(data)
+            self.categories[category['id']] = category
+            self._children.setdefault(category['id'], [])
+        for category in sorted(self.categories.values(), key=lambda c: c['sortorder'] or 0):
+            # Categories whose parent we can't see go at the top level
+            parent = category['parent'] if category['parent'] in self.categories else 0
+            self._children[parent].append(category['id'])
+
+        self.idnumbers = {}
+        self.paths = {}
+        self.names = {}
+        # Depth-first order, and each category's [start, end) in it
+        self._order = []
+        self._span = {}
+        self._courses = {}
+        stack = [(category_id, '', False) for category_id in reversed(self._children[0])]
+        while stack:
+            category_id, name_path, done = stack.pop()
+            if done:
+                self._span[category_id] = (self._span[category_id], len(self._order))
+                continue
+            category = self.categories[category_id]
+            name_path = name_path + '/' + category['name'] if name_path else category['name']
+            self._span[category_id] = len(self._order)
+            self._order.append(category_id)
+            if category['idnumber']:
+                self.idnumbers[category['idnumber']] = category_id
+            self.paths[category['path']] = category_id
+            self.names[name_path] = category_id
+            # Close the span once the children are done
+            stack.append((category_id, name_path, True))
+            stack.extend((child, name_path, False)
+                         for child in reversed(self._children[category_id]))
+
+    def __len__(self):
+        return len(self.categories)
+
+    def __iter__(self):
+        """ Categories in depth-first order """
+        return (self.categories[category_id] for category_id in self._order)
+
+    def __contains__(self, category_id):
+        return category_id in self.categories
+
+    def get(self, category_id):
+        return self.categories.get(category_id)
+
+    def by_idnumber(self, idnumber):
+        return self.categories.get(self.idnumbers.get(idnumber))
+
+    def by_path(self, path):
+        """ By id path ('/1/5/9') or name path ('Science/Physics') """
+        category_id = self.paths.get(path)
+        if category_id is None:
+            category_id = self.names.get(path)
+        return self.categories.get(category_id)
+
+    def parent(self, category_id):
+        return self.categories.get(self.categories[category_id]['parent'])
+
+    def children(self, category_id=0):
+        """ Child categories, in sort order; 0 for the top level """
+        return [self.categories[child] for child in self._children.get(category_id, ())]
+
+    def ancestors(self, category_id):
+        """ Ancestors, top level first """
+        path = self.categories[category_id]['path'] or ''
+        ancestors = [self.categories.get(int(part)) for part in path.split('/')[1:-1]]
+        return [ancestor for ancestor in ancestors if ancestor is not None]
+
+    def subtree(self, category_id, include_self=True):
+        """ The category and its descendants, depth first """
+        start, end = self._span[category_id]
+        if not include_self:
+            start += 1
+        return [self.categories[descendant] for descendant in self._order[start:end]]
+
+    def is_within(self, category_id, ancestor_id):
+        """ Whether category_id is ancestor_id or one of its descendants """
+        start, end = self._span[ancestor_id]
+        return start <= self._span[category_id][0] < end
+
+    def attach_courses(self, courses):
+        """
+        Attach courses, e.g. a course.CourseCatalogue, to their categories
+        for courses_in and courses_under. Replaces any attached before.
+        """
+        self._courses = {}
+        for course in courses:
+            self._courses.setdefault(course['categoryid'], []).append(course)
+
+    def courses_in(self, category_id):
+        """ Attached courses directly in the category """
+        return list(self._courses.get(category_id, ()))
+
+    def courses_under(self, category_id):
+        """ Attached courses in the category or any category below it """
+        start, end = self._span[category_id]
+        return [course for descendant in self._order[start:end]
+                for course in self._courses.get(descendant, ())]
+
+
+def _flatten_tree(categories, parent=None):
+    # Nested {'children': [...]} dicts -> rows with parent idnumbers
+    for category in categories:
+        row = dict(category)
+        children = row.pop('children', ())
+        if parent is not None:
+            row['parent'] = parent
+        yield row
+        yield from _flatten_tree(children, row.get('idnumber'))
 
 
 class API:
     """ Represents API endpoints for Moodle Course Categories """
 
+    # Categories per call, and concurrent calls, for create_tree
+    create_chunk_size = 500
+    workers = 4
+
     def __init__(self, config):
         self.config = config
 
@@ -18,13 +162,166 @@ class API:
         >>> import muddle
         >>> muddle.category(10).details()
         """
-        params = {'wsfunction': 'core_course_get_categories',
-                  'criteria[0][key]': 'id',
-                  'criteria[0][value]': category_id}
+        params = encode_params('core_course_get_categories', {
+            'criteria': [{'key': 'id', 'value': category_id}]
+        })
+
+        return self.config.request('post', params, decode=False)
 
-        params.update(self.config.request_params)
+    def get_categories(self, criteria=None, addsubcategories=True):
+        """
+        Fetch categories, all of them if no criteria are given.
 
-        return self.config.session.post(self.config.api_url, params=params)
+        :param dict criteria: (optional) e.g. {'idnumber': 'SCI'}; keys \
+            are id, ids (comma-separated), name, parent, idnumber, visible \
+            or theme
+        :param bool addsubcategories: (optional) Defaults to True. Include \
+            the subcategories of matching categories
+
+        Returns a list of categories with id, name, idnumber, description,
+        descriptionformat, parent, sortorder, coursecount, visible,
+        visibleold, timemodified, depth, path and theme.
+        """
+        params = encode_params('core_course_get_categories', {
+            'criteria': [{'key': key, 'value': value} for key, value in (criteria or {}).items()],
+            'addsubcategories': addsubcategories,
+        })
+        return self.config.request('get', params)
+
+    def tree(self, fields=None):
+        """
+        Fetch every category in one call and return them as a CategoryTree.
+
+        :param fields: (optional) Defaults to records.Category. Fields to \
+            keep per category (see muddle.records)
+
+        Example Usage::
+
+        >>> import muddle
+        >>> tree = muddle.category.API(m).tree()
+        >>> science = tree.by_idnumber('SCI')
+        >>> [c['name'] for c in tree.subtree(science['id'])]
+        >>> tree.attach_courses(muddle.course.API(m).catalogue())
+        >>> len(tree.courses_under(science['id']))
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('CategoryTree requires a (synchronous) WSConfig')
+        return CategoryTree(check_response(self.get_categories()), fields)
+
+    def create_tree(self, categories, existing=None, chunk_size=None, workers=None):
+        """
+        Create many categories, parents before children, in one
+        core_course_create_categories call per level of the tree (or per
+        chunk_size categories), so the number of round trips depends on
+        the tree's depth rather than its size.
+
+        :param list categories: dicts with name, idnumber and any of the \
+            options of create. 'parent' may be a category id, or the \
+            idnumber of an existing category or of another one in the list. \
+            Alternatively, give a category's subcategories as a 'children' \
+            list of such dicts.
+        :param existing: (optional) CategoryTree of the site's categories; \
+            fetched if not given
+        :param int chunk_size: (optional) Defaults to API.create_chunk_size
+        :param int workers: (optional) Defaults to API.workers
+
+        Categories whose idnumber already exists are not created again. A
+        failed call is retried in halves to find the categories that caused
+        it; their subcategories are then not created either.
+
+        Returns a dict:
+        :keyword dict ids: idnumber -> category id, for all the categories \
+            given that exist now
+        :keyword list failed: (category, error) for each category not created
+        :keyword int calls: create calls made
+
+        Example Usage::
+
+        >>> import muddle
+        >>> result = muddle.category.API(m).create_tree([
+        ...     {'name': 'Science', 'idnumber': 'SCI', 'children': [
+        ...         {'name': 'Physics', 'idnumber': 'SCI-PHYS'},
+        ...         {'name': 'Chemistry', 'idnumber': 'SCI-CHEM'}]},
+        ...     {'name': '2027', 'idnumber': 'SCI-PHYS-2027', 'parent': 'SCI-PHYS'}])
+        >>> result['ids']['SCI-PHYS-2027']
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('create_tree requires a (synchronous) WSConfig')
+        allowed_options = ['name', 'idnumber', 'parent', 'description',
+                           'descriptionformat', 'theme']
+        rows = list(_flatten_tree(categories))
+        for row in rows:
+            if not row.get('name') or not row.get('idnumber'):
+                raise ValueError('Category without a name or idnumber: %r' % (row,))
+            if not valid_options(row, allowed_options):
+                raise ValueError('Invalid category option(s) in %r' % (row,))
+        if existing is None:
+            existing = self.tree()
+
+        ids = dict(existing.idnumbers)
+        wanted = [row['idnumber'] for row in rows]
+        pending = []
+        queued = set()
+        for row in rows:
+            if row['idnumber'] not in ids and row['idnumber'] not in queued:
+                queued.add(row['idnumber'])
+                pending.append(row)
+
+        attempts = []
+
+        def create(batch):
+            attempts.append(len(batch))
+            params = encode_params('core_course_create_categories', {'categories': batch})
+            created = check_response(self.config.request('post', params))
+            # Results come back in the order sent, with id and name only
+            return [(category['idnumber'], result['id'])
+                    for category, result in zip(batch, created)]
+
+        failed = []
+        not_created = set()
+        while pending:
+            wave = []
+            waiting = []
+            for row in pending:
+                parent = row.get('parent') or 0
+                if isinstance(parent, int):
+                    wave.append(row)
+                elif parent in ids:
+                    wave.append(dict(row, parent=ids[parent]))
+                elif parent in queued:
+                    waiting.append(row)
+                elif parent in not_created:
+                    failed.append((row, MuddleError("Parent '%s' was not created" % parent)))
+                    not_created.add(row['idnumber'])
+                    queued.discard(row['idnumber'])
+                else:
+                    failed.append((row, MuddleError("Parent '%s' doesn't exist" % parent)))
+                    not_created.add(row['idnumber'])
+                    queued.discard(row['idnumber'])
+            if not wave:
+                if any(row['parent'] not in queued for row in waiting):
+                    # A parent was rejected after its child was put to wait
+                    pending = waiting
+                    continue
+                for row in waiting:
+                    failed.append((row, MuddleError("Parent '%s' is part of a cycle" % row['parent'])))
+                break
+            batches = chunks(wave, chunk_size or self.create_chunk_size)
+            for results, errors in self.config.map(
+                    lambda batch: bisect_failures(create, batch), batches, workers or self.workers):
+                for result in results:
+                    ids.update(result)
+                for row, error in errors:
+                    failed.append((row, error))
+                    not_created.add(row['idnumber'])
+            for row in wave:
+                queued.discard(row['idnumber'])
+            pending = waiting
+        return {
+            'ids': {idnumber: ids[idnumber] for idnumber in wanted if idnumber in ids},
+            'failed': failed,
+            'calls': len(attempts),
+        }
 
     def create(self, category_name, **kwargs):
         """
@@ -54,17 +351,11 @@ class API:
                            'theme']
 
         if valid_options(kwargs, allowed_options):
-            option_params = {}
-            for key in kwargs:
-                option_params.update(
-                    {'categories[0][' + key + ']': str(kwargs.get(key))})
-            params = {'wsfunction': 'core_course_create_categories',
-                      'categories[0][name]': category_name,
-                      }
-            params.update(option_params)
-            params.update(self.config.request_params)
-
-            return self.config.session.post(self.config.api_url, params=params)
+            category = {'name': category_name}
+            category.update(kwargs)
+            params = encode_params('core_course_create_categories', {'categories': [category]})
+
+            return self.config.request('post', params, decode=False)
 
     def delete(self, category_id, new_parent=None, recursive=False):
         """
@@ -80,14 +371,12 @@ class API:
         >>> muddle.category(10).delete()
         """
 
-        params = {'wsfunction': 'core_course_delete_categories',
-                  'categories[0][id]': category_id,
-                  'categories[0][recursive]': int(recursive)}
+        category = {'id': category_id, 'recursive': recursive}
         if new_parent:
-            params.update({'categories[0][newparent]': new_parent})
-        params.update(self.config.request_params)
+            category['newparent'] = new_parent
+        params = encode_params('core_course_delete_categories', {'categories': [category]})
 
-        return self.config.session.post(self.config.api_url, params=params)
+        return self.config.request('post', params, decode=False)
 
     def update(self, category_id, **kwargs):
         """
@@ -112,14 +401,8 @@ class API:
                            'theme']
 
         if valid_options(kwargs, allowed_options):
-            option_params = {}
-            for key in kwargs:
-                option_params.update(
-                    {'categories[0][' + key + ']': str(kwargs.get(key))})
-
-            params = {'wsfunction': 'core_course_update_categories',
-                      'categories[0][id]': category_id}
-            params.update(option_params)
-            params.update(self.config.request_params)
+            category = {'id': category_id}
+            category.update(kwargs)
+            params = encode_params('core_course_update_categories', {'categories': [category]})
 
-            return self.config.session.post(self.config.api_url, params=params)
+            return self.config.request('post', params, decode=False)
@@ -1,8 +1,175 @@
-from muddle.utils import valid_options
+import time
+
+import requests
+
+from muddle.config import AsyncWSConfig
+from muddle.encoding import encode_params
+from muddle.exceptions import MuddleError, WSError, check_response
+from muddle.records import Course, project, record_type
+from muddle.utils import bisect_failures, chunks, valid_options
+
+
+# Optional fields accepted by core_course_create_courses
+_CREATE_OPTIONS = ['idnumber', 'summary', 'summaryformat',
+                   'format', 'showgrades',
+                   'newsitems', 'startdate', 'enddate',
+                   'numsections', 'maxbytes', 'showreports',
+                   'visible', 'hiddensections', 'groupmode',
+                   'groupmodeforce', 'defaultgroupingid',
+                   'enablecompletion', 'completionnotify', 'lang',
+                   'forcetheme', 'courseformatoptions']
+
+_CONTENT_FIELDS = ('type', 'filename', 'filepath', 'fileurl', 'filesize',
+                   'mimetype', 'timemodified')
+
+
+def _flatten_contents(course_id, sections, contents):
+    # core_course_get_contents sections -> modules -> contents, as flat records
+    for section in sections:
+        for module in section.get('modules', ()):
+            record = {
+                'courseid': course_id,
+                'sectionid': section.get('id'),
+                'sectionnum': section.get('section'),
+                'sectionname': section.get('name'),
+                'cmid': module.get('id'),
+                'instance': module.get('instance'),
+                'modname': module.get('modname'),
+                'name': module.get('name'),
+                'url': module.get('url'),
+                'visible': module.get('visible'),
+            }
+            if not contents:
+                yield record
+                continue
+            for content in module.get('contents') or ():
+                item = dict(record)
+                for field in _CONTENT_FIELDS:
+                    item[field] = content.get(field)
+                yield item
+
+
+def _post(config, params):
+    # Decoded result of a write call, raising HTTPError for a 5xx status
+    # such as a proxy giving up: its body isn't Moodle's answer, and the
+    # call may still have taken effect
+    response = config.request('post', params, decode=False)
+    if response.status_code >= 500:
+        raise requests.HTTPError('%s response from server' % response.status_code,
+                                 response=response)
+    return check_response(response.json())
+
+
+class CourseCatalogue:
+    """
+    All of a site's courses, indexed for local lookups by id, shortname,
+    idnumber and category. Made by API.catalogue.
+
+    Moodle can't list only the courses changed since a given time, so
+    refresh() reads the full course list again, streamed, but keeps and
+    re-indexes only the courses that were added, removed or have a new
+    timemodified.
+
+    :keyword dict courses: course id -> course
+    :keyword dict shortnames: shortname -> course id
+    :keyword dict idnumbers: idnumber -> course id (courses with one)
+    :keyword dict categories: category id -> set of course ids
+    :keyword int synced: time of the last refresh
+    """
+
+    def __init__(self, api, fields=None, include_site=False):
+        self.api = api
+        self.record = record_type(fields or Course)
+        for field in ('id', 'shortname', 'idnumber', 'categoryid', 'timemodified'):
+            if field not in self.record.FIELDS:
+                raise ValueError("Catalogue fields must include '%s'" % field)
+        self.include_site = include_site
+        self.courses = {}
+        self.shortnames = {}
+        self.idnumbers = {}
+        self.categories = {}
+        self.synced = None
+
+    def __len__(self):
+        return len(self.courses)
+
+    def __iter__(self):
+        return iter(self.courses.values())
+
+    def __contains__(self, course_id):
+        return course_id in self.courses
+
+    def get(self, course_id):
+        return self.courses.get(course_id)
+
+    def by_shortname(self, shortname):
+        return self.courses.get(self.shortnames.get(shortname))
+
+    def by_idnumber(self, idnumber):
+        return self.courses.get(self.idnumbers.get(idnumber))
+
+    def in_category(self, category_id):
+        """ Courses directly in the category """
+        return [self.courses[course_id] for course_id in self.categories.get(category_id, ())]
+
+    def _add(self, course):
+        self.courses[course['id']] = course
+        self.shortnames[course['shortname']] = course['id']
+        if course['idnumber']:
+            self.idnumbers[course['idnumber']] = course['id']
+        self.categories.setdefault(course['categoryid'], set()).add(course['id'])
+
+    def _remove(self, course_id):
+        course = self.courses.pop(course_id)
+        if self.shortnames.get(course['shortname']) == course_id:
+            del self.shortnames[course['shortname']]
+        if course['idnumber'] and self.idnumbers.get(course['idnumber']) == course_id:
+            del self.idnumbers[course['idnumber']]
+        category = self.categories.get(course['categoryid'])
+        if category is not None:
+            category.discard(course_id)
+            if not category:
+                del self.categories[course['categoryid']]
+
+    def refresh(self):
+        """
+        Bring the catalogue up to date, returning a dict of the course ids
+        'added', 'updated' and 'removed'.
+        """
+        changes = {'added': [], 'updated': [], 'removed': []}
+        seen = set()
+        params = encode_params('core_course_get_courses')
+        started = int(time.time())
+        # Not from the cache, which may hold an earlier course list
+        for data in self.api.config.stream('get', params, use_cache=False):
+            if data.get('format') == 'site' and not self.include_site:
+                continue
+            course_id = data['id']
+            seen.add(course_id)
+            current = self.courses.get(course_id)
+            if current is not None and current['timemodified'] == data.get('timemodified'):
+                continue
+            if current is not None:
+                self._remove(course_id)
+                changes['updated'].append(course_id)
+            else:
+                changes['added'].append(course_id)
+            self._add(self.record.from_dict(data))
+        for course_id in set(self.courses) - seen:
+            self._remove(course_id)
+            changes['removed'].append(course_id)
+        self.synced = started
+        return changes
+
 
 class API:
     """ Represents API endpoints for a Moodle Course """
 
+    # Courses per call, and concurrent calls, for the bulk methods
+    create_chunk_size = 100
+    delete_chunk_size = 100
+    workers = 4
+
     def __init__(self, config):
         self.config = config
 
@@ -56,35 +223,23 @@ class API:
         >>> muddle.course().create('a new course', 'new-course', 20)
         """
 
-        allowed_options = ['idnumber', 'summary', 'summaryformat',
-                           'format', 'showgrades',
-                           'newsitems', 'startdate', 'enddate',
-                           'numsections', 'maxbytes', 'showreports',
-                           'visible', 'hiddensections', 'groupmode',
-                           'groupmodeforce', 'defaultgroupingid',
-                           'enablecompletion', 'completionnotify', 'lang',
-                           'forcetheme', 'courseformatoptions']
+        if valid_options(kwargs, _CREATE_OPTIONS):
+            course = {'fullname': fullname,
+                      'shortname': shortname,
+                      'categoryid': category_id}
+            course.update(kwargs)
+            params = encode_params('core_course_create_courses', {'courses': [course]})
+            return self.config.request('post', params, decode=False)
 
-        if valid_options(kwargs, allowed_options):
-            option_params = {}
-            for index, key in enumerate(kwargs):
-                val = kwargs.get(key)
-                if isinstance(val, bool):
-                    val = int(val)
-                option_params.update({'courses[0][' + key + ']': val})
-
-            params = {'wsfunction': 'core_course_create_courses',
-                      'courses[0][fullname]': fullname,
-                      'courses[0][shortname]': shortname,
-                      'courses[0][categoryid]': category_id}
-            params.update(option_params)
-            params.update(self.config.request_params)
-            return self.config.session.post(self.config.api_url, params=params)
-
-    def get_courses(self, idlist):
+    def get_courses(self, idlist=None, fields=None):
         """
         Fetch course data for specified course ids.
 
+        :param list idlist: (optional) course ids; all courses if not given
+        :param fields: (optional) Return slotted records (see muddle.records) \
+            holding only these fields, e.g. ('id', 'shortname'), rather than \
+            full dicts. records.Course gives its standard fields.
+
         Data fetched:
         :keyword int id: course id
         :keyword string shortname: course short name
@@ -117,12 +272,36 @@ class API:
         :keyword dict courseformatoptions: a list of format options (name/value pairs) for the course, in the form of dicts with 'name' and 'value' as keys. Names are alphanumeric, values raw strings (i.e. not formatting restriction on string contents)
 
         """
-        params = self.config.request_params
-        params.update({
-            'wsfunction': 'core_course_get_courses',
-            'ids': idlist
-        })
-        return self.config.session.get(self.config.api_url, params=params).json()
+        params = encode_params('core_course_get_courses', {'options': {'ids': idlist}})
+        result = self.config.request('get', params)
+        if fields is not None:
+            return project(result, fields)
+        return result
+
+    def catalogue(self, fields=None, include_site=False):
+        """
+        Load every course into a CourseCatalogue for local lookups.
+
+        :param fields: (optional) Defaults to records.Course. Fields to keep \
+            per course (see muddle.records); must include id, shortname, \
+            idnumber, categoryid and timemodified
+        :param bool include_site: (optional) Defaults to False. Include the \
+            site front page course
+
+        Example Usage::
+
+        >>> import muddle
+        >>> catalogue = muddle.course.API(m).catalogue()
+        >>> catalogue.by_shortname('ABC101')['id']
+        >>> catalogue.in_category(12)
+        >>> catalogue.refresh()
+        {'added': [2311], 'updated': [], 'removed': []}
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('CourseCatalogue requires a (synchronous) WSConfig')
+        catalogue = CourseCatalogue(self, fields, include_site)
+        catalogue.refresh()
+        return catalogue
 
     def get_courses_by_field(self, fieldname, value):
         """
@@ -165,13 +344,11 @@ class API:
         :keyword int requested: "If it is a requested course" - ???
         :keyword int cacherev: "Cache revision number" - ???
         """
-        params = self.config.request_params
-        params.update({
-            'wsfunction': 'core_course_get_courses_by_field',
+        params = encode_params('core_course_get_courses_by_field', {
             'field': fieldname,
             'value': value,
         })
-        return self.config.session.get(self.config.api_url, params=params).json()
+        return self.config.request('get', params)
 
     def delete(self, course_id):
         """
@@ -182,10 +359,136 @@ class API:
         >>> import muddle
         >>> muddle.course(10).delete()
         """
-        params = {'wsfunction': 'core_course_delete_courses',
-                  'courseids[0]': course_id}
-        params.update(self.config.request_params)
-        return self.config.session.post(self.config.api_url, params=params)
+        params = encode_params('core_course_delete_courses', {'courseids': [course_id]})
+        return self.config.request('post', params, decode=False)
+
+    def create_courses_bulk(self, courses, chunk_size=None, workers=None):
+        """
+        Create many courses, in calls of up to chunk_size courses, running
+        up to workers calls at once.
+
+        :param list courses: dicts with fullname, shortname and categoryid, \
+            and any of the keyword options of create_courses
+        :param int chunk_size: (optional) Defaults to API.create_chunk_size
+        :param int workers: (optional) Defaults to API.workers
+
+        Moodle creates all of a call's courses or none of them, so a failed
+        call is retried in halves to find the courses that caused it; the
+        rest are still created. A call that gets no usable answer (a
+        connection error, timeout, or an undecodable or incomplete
+        response, as from a proxy that gave up waiting) may still have
+        created its courses, so they are reported as failed and in
+        maybe_created; look those up by shortname before trying again.
+
+        Returns a dict:
+        :keyword dict ids: shortname -> new course id for each course created
+        :keyword list failed: (course, exception) for each course not \
+            known to be created; WSError if Moodle rejected it
+        :keyword list maybe_created: shortnames of the failed courses that \
+            may have been created
+
+        Example Usage::
+
+        >>> import muddle
+        >>> result = muddle.course.API(m).create_courses_bulk([
+        ...     {'fullname': 'Course A', 'shortname': 'A', 'categoryid': 3},
+        ...     {'fullname': 'Course B', 'shortname': 'B', 'categoryid': 3}])
+        >>> result['ids']
+        {'A': 201, 'B': 202}
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('create_courses_bulk requires a (synchronous) WSConfig')
+        courses = list(courses)
+        for course in courses:
+            extra = set(course) - set(_CREATE_OPTIONS) - {'fullname', 'shortname', 'categoryid'}
+            if extra:
+                raise ValueError('Invalid course option(s): %s' % ', '.join(sorted(extra)))
+
+        def create(batch):
+            params = encode_params('core_course_create_courses', {'courses': batch})
+            try:
+                created = {item['shortname']: item['id'] for item in _post(self.config, params)}
+            except WSError:
+                raise
+            except Exception as e:
+                # No usable answer, so the courses may have been created
+                return {}, [(course, e) for course in batch]
+            unconfirmed = [(course, MuddleError('No id returned for %s' % course['shortname']))
+                           for course in batch if course['shortname'] not in created]
+            return created, unconfirmed
+
+        batches = list(chunks(courses, chunk_size or self.create_chunk_size))
+        results = self.config.map(lambda batch: bisect_failures(create, batch), batches,
+                                  workers or self.workers, return_exceptions=True)
+        ids = {}
+        failed = []
+        maybe_created = []
+        for batch, outcome in zip(batches, results):
+            if isinstance(outcome, Exception):
+                calls, errors = [({}, [(course, outcome) for course in batch])], []
+            else:
+                calls, errors = outcome
+            for created, unconfirmed in calls:
+                ids.update(created)
+                failed.extend(unconfirmed)
+                maybe_created.extend(course['shortname'] for course, error in unconfirmed)
+            failed.extend(errors)
+        return {'ids': ids, 'failed': failed, 'maybe_created': maybe_created}
+
+    def delete_courses(self, course_ids, chunk_size=None, workers=None):
+        """
+        Delete many courses, in calls of up to chunk_size courses, running
+        up to workers calls at once. Failed calls are retried in halves, as
+        per create_courses_bulk.
+
+        Returns a dict:
+        :keyword list deleted: ids of the courses deleted
+        :keyword list failed: (course id, error) for each course not \
+            known to be deleted; error is a WSError, the warning dict Moodle \
+            gave, or the exception for a call that got no usable answer, \
+            whose courses may have been deleted
+
+        Example Usage::
+
+        >>> import muddle
+        >>> result = muddle.course.API(m).delete_courses(range(200, 400))
+        >>> result['failed']
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('delete_courses requires a (synchronous) WSConfig')
+        course_ids = [int(course_id) for course_id in course_ids]
+
+        def delete(batch):
+            params = encode_params('core_course_delete_courses', {'courseids': batch})
+            try:
+                result = _post(self.config, params) or {}
+                warnings = {int(warning.get('itemid') or 0): warning
+                            for warning in result.get('warnings', ())}
+            except WSError:
+                raise
+            except Exception as e:
+                # No usable answer, so the courses may have been deleted
+                return [(course_id, e) for course_id in batch]
+            return [(course_id, warnings.get(course_id)) for course_id in batch]
+
+        batches = list(chunks(course_ids, chunk_size or self.delete_chunk_size))
+        deleted = []
+        failed = []
+        for batch, outcome in zip(batches, self.config.map(
+                lambda batch: bisect_failures(delete, batch), batches,
+                workers or self.workers, return_exceptions=True)):
+            if isinstance(outcome, Exception):
+                failed.extend((course_id, outcome) for course_id in batch)
+                continue
+            results, errors = outcome
+            for result in results:
+                for course_id, warning in result:
+                    if warning is None:
+                        deleted.append(course_id)
+                    else:
+                        failed.append((course_id, warning))
+            failed.extend(errors)
+        return {'deleted': deleted, 'failed': failed}
 
     def get_course_contents(self, course_id):
         """
@@ -198,10 +501,81 @@ class API:
         >>> import muddle
         >>> muddle.course(10).content()
         """
-        params = self.config.request_params
-        params.update({'wsfunction': 'core_course_get_contents',
-                       'courseid': course_id})
-        return self.config.session.get(self.config.api_url, params=params).json()
+        params = encode_params('core_course_get_contents', {'courseid': course_id})
+        return self.config.request('get', params)
+
+    def iter_course_contents(self, course_id, backend='json'):
+        """
+        As get_course_contents, but yields the course's sections one at a
+        time as the response is decoded, so a large course's contents are
+        never held in memory all at once.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> for section in muddle.course.API(m).iter_course_contents(10):
+        ...     print(section['name'], len(section['modules']))
+        """
+        params = encode_params('core_course_get_contents', {'courseid': course_id})
+        return self.config.stream('get', params, backend)
+
+    def iter_contents(self, course_ids=None, category_id=None, contents=False,
+                      workers=None, on_error=None):
+        """
+        Yield the modules (or their contents) of many courses as flat
+        records, fetching up to `workers` courses' contents concurrently
+        ahead of the consumer. Only those courses are held in memory, so a
+        whole-site audit runs in fixed memory.
+
+        :param iterable course_ids: (optional) courses to read
+        :param int category_id: (optional) read the courses directly in this \
+            category instead
+        :param bool contents: (optional) Defaults to False. Yield a record \
+            per content item (file or URL) of each module, rather than one \
+            per module
+        :param int workers: (optional) Defaults to WSConfig.workers. Courses \
+            fetched at once
+        :param callable on_error: (optional) on_error(course_id, exception) \
+            is called for a course that can't be read, which is then \
+            skipped. By default the exception is raised.
+
+        Each record has courseid, sectionid, sectionnum, sectionname,
+        cmid, instance, modname, name, url and visible. With contents, it
+        also has type, filename, filepath, fileurl, filesize, mimetype and
+        timemodified from the content item.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> api = muddle.course.API(m)
+        >>> for item in api.iter_contents(category_id=4, contents=True):
+        ...     if item['type'] == 'url':
+        ...         check_link(item['courseid'], item['fileurl'])
+        """
+        # Checked here rather than in the generator, so that it is raised
+        # straight away
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('iter_contents requires a (synchronous) WSConfig')
+        return self._iter_contents(course_ids, category_id, contents, workers, on_error)
+
+    def _iter_contents(self, course_ids, category_id, contents, workers, on_error):
+        if category_id is not None:
+            result = check_response(self.get_courses_by_field('category', category_id))
+            course_ids = [course['id'] for course in result['courses']]
+
+        def fetch(course_id):
+            try:
+                return course_id, check_response(self.get_course_contents(course_id)), None
+            except Exception as e:
+                return course_id, None, e
+
+        for course_id, sections, error in self.config.imap(fetch, course_ids, workers):
+            if error is not None:
+                if on_error is None:
+                    raise error
+                on_error(course_id, error)
+                continue
+            yield from _flatten_contents(course_id, sections, contents)
 
     def duplicate(self, course_id, fullname, shortname, categoryid,
                   visible=True, **kwargs):
@@ -250,23 +624,18 @@ class API:
                            'grade_histories']
 
         if valid_options(kwargs, allowed_options):
-            option_params = {}
-            for index, key in enumerate(kwargs):
-                option_params.update(
-                    {'options[' + str(index) + '][name]': key,
-                     'options[' + str(index) + '][value]':
-                        int(kwargs.get(key))})
-
-            params = {'wsfunction': 'core_course_duplicate_course',
-                      'courseid': course_id,
-                      'fullname': fullname,
-                      'shortname': shortname,
-                      'categoryid': categoryid,
-                      'visible': int(visible)}
-            params.update(option_params)
-            params.update(self.config.request_params)
-
-            return self.config.session.post(self.config.api_url, params=params)
+            options = [{'name': key, 'value': int(value)}
+                       for key, value in kwargs.items()]
+            params = encode_params('core_course_duplicate_course', {
+                'courseid': course_id,
+                'fullname': fullname,
+                'shortname': shortname,
+                'categoryid': categoryid,
+                'visible': visible,
+                'options': options,
+            })
+
+            return self.config.request('post', params, decode=False)
 
     def export_data(self, course_id, export_to, delete_content=False):
         """
@@ -281,10 +650,10 @@ class API:
         >>> import muddle
         >>> muddle.course(10).export_data(12)
         """
-        params = {'wsfunction': 'core_course_import_course',
-                  'importfrom': course_id,
-                  'importto': export_to,
-                  'deletecontent': int(delete_content)}
-        params.update(self.config.request_params)
+        params = encode_params('core_course_import_course', {
+            'importfrom': course_id,
+            'importto': export_to,
+            'deletecontent': delete_content,
+        })
 
-        return self.config.session.post(self.config.api_url, params=params)
+        return self.config.request('post', params, decode=False)
@@ -1,9 +1,78 @@
-from muddle.utils import valid_options
+import requests
+
+from muddle.config import AsyncWSConfig
+from muddle.encoding import encode_params
+from muddle.exceptions import check_response
+from muddle.utils import valid_options, chunks
+
+
+class GroupSnapshot:
+    """
+    Groups, groupings and memberships of a set of courses, indexed for
+    lookups without further web service calls. Made by API.snapshot.
+
+    :keyword dict groups: group id -> group, as per get_course_groups
+    :keyword dict groupings: grouping id -> grouping, as per get_groupings \
+        (without its 'groups' list)
+    :keyword dict course_groups: course id -> set of group ids
+    :keyword dict course_groupings: course id -> set of grouping ids
+    :keyword dict group_members: group id -> set of user ids
+    :keyword dict user_groups: user id -> set of group ids
+    :keyword dict group_groupings: group id -> set of grouping ids
+    :keyword dict grouping_groups: grouping id -> set of group ids
+    :keyword dict grouping_members: grouping id -> set of user ids
+    """
+
+    def __init__(self, groups, groupings, grouping_groups, group_members):
+        self.groups = {group['id']: group for group in groups}
+        self.groupings = {grouping['id']: grouping for grouping in groupings}
+        self.course_groups = {}
+        for group in self.groups.values():
+            self.course_groups.setdefault(group['courseid'], set()).add(group['id'])
+        self.course_groupings = {}
+        for grouping in self.groupings.values():
+            self.course_groupings.setdefault(grouping['courseid'], set()).add(grouping['id'])
+
+        self.group_members = group_members
+        self.user_groups = {}
+        for groupid, userids in group_members.items():
+            for userid in userids:
+                self.user_groups.setdefault(userid, set()).add(groupid)
+
+        self.grouping_groups = grouping_groups
+        self.group_groupings = {}
+        self.grouping_members = {}
+        for groupingid, groupids in grouping_groups.items():
+            members = self.grouping_members[groupingid] = set()
+            for groupid in groupids:
+                self.group_groupings.setdefault(groupid, set()).add(groupingid)
+                members.update(group_members.get(groupid, ()))
+
+    def groups_for_user(self, userid, course_id=None):
+        """ Ids of groups the user is in, optionally only in one course """
+        groupids = self.user_groups.get(userid, set())
+        if course_id is None:
+            return set(groupids)
+        return groupids & self.course_groups.get(course_id, set())
+
+    def groupings_for_user(self, userid, course_id=None):
+        """ Ids of groupings containing a group the user is in """
+        groupingids = set()
+        for groupid in self.groups_for_user(userid, course_id):
+            groupingids.update(self.group_groupings.get(groupid, ()))
+        return groupingids
 
 
 class API:
     """ Represents API endpoints for Moodle Groups """
 
+    # Group ids per get_group_members call, and members per
+    # add_group_members/delete_group_members call, for bulk operations
+    read_chunk_size = 200
+    write_chunk_size = 1000
+    # Groups or groupings per create call, for bulk creation
+    create_chunk_size = 500
+
     def __init__(self, config):
         self.config = config
 
@@ -38,17 +107,9 @@ class API:
             'idnumber'
         ]
 
-        option_params = {}
-        for i, group in enumerate(groups):
-            if valid_options(group, group_options):
-                for key in group:
-                    option_params.update({
-                        'groups[%s][%s]' % (i, key): str(kwargs.get(key))
-                    })
-        params = {'wsfunction': 'core_group_create_groups'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.post(self.config.api_url, params=params).json()
+        groups = [group for group in groups if valid_options(group, group_options)]
+        params = encode_params('core_group_create_groups', {'groups': groups})
+        return self.config.request('post', params)
 
     def get_groups(self, idlist):
         """
@@ -56,12 +117,8 @@ class API:
 
         Data fetched is as per create_groups.
         """
-        params = self.config.request_params
-        params.update({
-            'wsfunction': 'core_group_get_groups',
-            'ids': idlist
-        })
-        return self.config.session.get(self.config.api_url, params=params).json()
+        params = encode_params('core_group_get_groups', {'groupids': idlist})
+        return self.config.request('get', params)
 
     def get_course_groups(self, course_id):
         """
@@ -70,12 +127,8 @@ class API:
         Data fetched is as per create_groups, but with the addition of 'id' for
         each group.
         """
-        params = self.config.request_params
-        params.update({
-            'wsfunction': 'core_group_get_course_groups',
-            'courseid': course_id
-        })
-        return self.config.session.get(self.config.api_url, params=params).json()
+        params = encode_params('core_group_get_course_groups', {'courseid': course_id})
+        return self.config.request('get', params)
 
     def delete_groups(self, idlist):
         """
@@ -86,15 +139,8 @@ class API:
         >>> import muddle
         >>> muddle.course(10).delete()
         """
-        option_params = {}
-        for i, groupid in enumerate(idlist):
-            option_params.update({
-                'groupids[%s]' % i: groupid
-            })
-        params = {'wsfunction': 'core_group_delete_groups'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.post(self.config.api_url, params=params)
+        params = encode_params('core_group_delete_groups', {'groupids': idlist})
+        return self.config.request('post', params, decode=False)
 
     def get_group_members(self, idlist):
         """
@@ -103,15 +149,8 @@ class API:
         Returns a list of dicts with 'groupid' and 'userids' entries. 'userids'
         value is a list of user ids.
         """
-        option_params = {}
-        for i, groupid in enumerate(idlist):
-            option_params.update({
-                'groupids[%s]' % i: groupid
-            })
-        params = {'wsfunction': 'core_group_get_group_members'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.get(self.config.api_url, params=params).json()
+        params = encode_params('core_group_get_group_members', {'groupids': idlist})
+        return self.config.request('get', params)
 
     def add_group_members(self, members):
         """
@@ -122,16 +161,8 @@ class API:
 
         Returns nothing.
         """
-        option_params = {}
-        for i, member in enumerate(members):
-            option_params.update({
-                'members[%s][groupid]' % i: member['groupid'],
-                'members[%s][userid]' % i: member['userid']
-            })
-        params = {'wsfunction': 'core_group_add_group_members'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.post(self.config.api_url, params=params)
+        params = encode_params('core_group_add_group_members', {'members': members})
+        return self.config.request('post', params, decode=False)
 
     def delete_group_members(self, members):
         """
@@ -142,16 +173,8 @@ class API:
 
         Returns nothing.
         """
-        option_params = {}
-        for i, member in enumerate(members):
-            option_params.update({
-                'members[%s][groupid]' % i: member['groupid'],
-                'members[%s][userid]' % i: member['userid']
-            })
-        params = {'wsfunction': 'core_group_delete_group_members'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.post(self.config.api_url, params=params)
+        params = encode_params('core_group_delete_group_members', {'members': members})
+        return self.config.request('post', params, decode=False)
 
     def create_groupings(self, groupings):
         """
@@ -182,17 +205,10 @@ class API:
             'idnumber'
         ]
 
-        option_params = {}
-        for i, grouping in enumerate(groupings):
-            if valid_options(grouping, grouping_options):
-                for key in grouping:
-                    option_params.update({
-                        'groupings[%s][%s]' % (i, key): str(kwargs.get(key))
-                    })
-        params = {'wsfunction': 'core_group_create_groupings'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.post(self.config.api_url, params=params).json()
+        groupings = [grouping for grouping in groupings
+                     if valid_options(grouping, grouping_options)]
+        params = encode_params('core_group_create_groupings', {'groupings': groupings})
+        return self.config.request('post', params)
 
     def update_groupings(self, groupings):
         """
@@ -222,17 +238,10 @@ class API:
             'idnumber'
         ]
 
-        option_params = {}
-        for i, grouping in enumerate(groupings):
-            if valid_options(grouping, grouping_options):
-                for key in grouping:
-                    option_params.update({
-                        'groupings[%s][%s]' % (i, key): str(kwargs.get(key))
-                    })
-        params = {'wsfunction': 'core_group_update_groupings'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.post(self.config.api_url, params=params)
+        groupings = [grouping for grouping in groupings
+                     if valid_options(grouping, grouping_options)]
+        params = encode_params('core_group_update_groupings', {'groupings': groupings})
+        return self.config.request('post', params, decode=False)
 
     def get_groupings(self, idlist, returngroups=True):
         """
@@ -244,18 +253,11 @@ class API:
 
         'groups' key is only populated if 'returngroups' param is True.
         """
-        option_params = {}
-        for i, groupingid in enumerate(idlist):
-            option_params.update({
-                'groupingids[%s]' % i: groupingid
-            })
-        params = {
-            'wsfunction': 'core_group_get_groupings',
-            'returngroups': 1 if returngroups else 0
-        }
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.get(self.config.api_url, params=params).json()
+        params = encode_params('core_group_get_groupings', {
+            'groupingids': idlist,
+            'returngroups': returngroups
+        })
+        return self.config.request('get', params)
 
     def get_course_groupings(self, course_id):
         """
@@ -264,12 +266,8 @@ class API:
         Data fetched is as per that supplied to update_groupings.
         Groups belonging to groupings are not retrieved.
         """
-        params = self.config.request_params
-        params.update({
-            'wsfunction': 'core_group_get_course_groupings',
-            'courseid': course_id
-        })
-        return self.config.session.get(self.config.api_url, params=params).json()
+        params = encode_params('core_group_get_course_groupings', {'courseid': course_id})
+        return self.config.request('get', params)
 
     def delete_groupings(self, idlist):
         """
@@ -280,15 +278,8 @@ class API:
         >>> import muddle
         >>> muddle.course(10).delete()
         """
-        option_params = {}
-        for i, groupingid in enumerate(idlist):
-            option_params.update({
-                'groupingids[%s]' % i: groupingid
-            })
-        params = {'wsfunction': 'core_group_delete_groupings'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.post(self.config.api_url, params=params)
+        params = encode_params('core_group_delete_groupings', {'groupingids': idlist})
+        return self.config.request('post', params, decode=False)
 
     def assign_grouping(self, assignments):
         """
@@ -299,14 +290,222 @@ class API:
 
         Returns nothing.
         """
-        option_params = {}
-        for i, assignment in enumerate(assignments):
-            option_params.update({
-                'assignments[%s][groupingid]' % i: assignment['groupingid'],
-                'assignments[%s][groupid]' % i: assignment['groupid']
-            })
-        params = {'wsfunction': 'core_group_assign_grouping'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.post(self.config.api_url, params=params)
+        params = encode_params('core_group_assign_grouping', {'assignments': assignments})
+        return self.config.request('post', params, decode=False)
+
+    def get_members_map(self, idlist):
+        """
+        Fetch members of many groups, in as few get_group_members calls as
+        read_chunk_size allows; chunks are fetched concurrently.
+
+        Returns a dict of group id -> set of user ids. Raises WSError if
+        Moodle returns an error.
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('get_members_map requires a (synchronous) WSConfig')
+        idlist = list(idlist)
+        results = self.config.map(self.get_group_members, chunks(idlist, self.read_chunk_size))
+        members = {groupid: set() for groupid in idlist}
+        for result in results:
+            for group in check_response(result):
+                members[group['groupid']] = set(group['userids'])
+        return members
+
+    def sync_members(self, desired, remove=True, dry_run=False):
+        """
+        Make group membership match desired.
+
+        :param dict desired: group id -> iterable of user ids that should \
+            be the group's members
+        :param bool remove: (optional) Defaults to True. Remove members not \
+            in desired; if False, only add
+        :param bool dry_run: (optional) Defaults to False. Work out the \
+            changes but don't make them
+
+        Current membership of all the groups is read in one call per
+        read_chunk_size groups, and changes are sent in add/delete calls of
+        up to write_chunk_size members, so a sync with nothing to change
+        costs one read and no writes.
+
+        Returns a report dict:
+        :keyword int groups: number of groups checked
+        :keyword list added: members added (with dry_run, to be added), as \
+            dicts with 'groupid' and 'userid'; members of failed calls are \
+            left out
+        :keyword list removed: members removed, likewise
+        :keyword int unchanged: members already correct
+        :keyword int writes: add/delete calls made
+        :keyword list errors: (members, exception) for each call that \
+            failed. Moodle makes no change for a call that fails with a \
+            WSError; one that failed with a connection error or a 5xx or \
+            undecodable response may have taken effect, so sync again to \
+            check
+
+        Example Usage::
+
+        >>> import muddle
+        >>> report = muddle.group.API(m).sync_members({12: [101, 102], 13: []})
+        >>> len(report['added']), len(report['removed'])
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('sync_members requires a (synchronous) WSConfig')
+        desired = {int(groupid): set(int(userid) for userid in userids)
+                   for groupid, userids in desired.items()}
+        current = self.get_members_map(desired)
+
+        added = []
+        removed = []
+        unchanged = 0
+        for groupid, userids in desired.items():
+            existing = current.get(groupid, set())
+            unchanged += len(userids & existing)
+            added.extend({'groupid': groupid, 'userid': userid}
+                         for userid in sorted(userids - existing))
+            if remove:
+                removed.extend({'groupid': groupid, 'userid': userid}
+                               for userid in sorted(existing - userids))
+
+        report = {
+            'groups': len(desired),
+            'added': added,
+            'removed': removed,
+            'unchanged': unchanged,
+            'writes': 0,
+            'errors': [],
+        }
+        if dry_run:
+            return report
+        for (key, method) in (('removed', self.delete_group_members),
+                              ('added', self.add_group_members)):
+            members, report[key] = report[key], []
+            for batch in chunks(members, self.write_chunk_size):
+                report['writes'] += 1
+                try:
+                    response = method(batch)
+                    if response.status_code >= 500:
+                        raise requests.HTTPError('%s response from server' % response.status_code,
+                                                 response=response)
+                    check_response(response.json())
+                except Exception as e:
+                    # Keep going, so the report covers every call made
+                    report['errors'].append((batch, e))
+                else:
+                    report[key].extend(batch)
+        return report
+
+    def snapshot(self, course_ids):
+        """
+        Fetch all groups, groupings and group members of the given courses
+        and return them as a GroupSnapshot.
 
+        Per-course group and grouping lists are fetched concurrently, then
+        grouping contents and group members in chunked calls covering all
+        the courses at once.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> snap = muddle.group.API(m).snapshot([10, 11, 12])
+        >>> snap.groups_for_user(101, course_id=10)
+        >>> snap.grouping_members[7]
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('snapshot requires a (synchronous) WSConfig')
+        course_ids = list(course_ids)
+        calls = [(self.get_course_groups, course_id) for course_id in course_ids]
+        calls += [(self.get_course_groupings, course_id) for course_id in course_ids]
+        results = self.config.map(lambda call: check_response(call[0](call[1])), calls)
+        groups = [group for result in results[:len(course_ids)] for group in result]
+        groupings = [grouping for result in results[len(course_ids):] for grouping in result]
+
+        grouping_groups = {grouping['id']: set() for grouping in groupings}
+        grouping_chunks = chunks(grouping_groups, self.read_chunk_size)
+        for result in self.config.map(self.get_groupings, grouping_chunks):
+            for grouping in check_response(result):
+                grouping_groups[grouping['id']] = set(group['id'] for group in grouping.get('groups', ()))
+
+        group_members = self.get_members_map(group['id'] for group in groups)
+        return GroupSnapshot(groups, groupings, grouping_groups, group_members)
+
+    def ensure_groups(self, groups):
+        """
+        Create groups that don't already exist, matching on idnumber.
+
+        :param list groups: groups as per create_groups; each must have \
+            an 'idnumber'
+
+        Existing groups are found with one get_course_groups call per
+        course. The rest are created in concurrent create_groups calls of
+        create_chunk_size groups, so it is safe to run again after a
+        failure. Raises the first WSError, after all calls have finished,
+        if any failed.
+
+        Idnumbers are matched within each group's course. Returns a dict
+        of idnumber -> group id for all the groups given, so raises
+        ValueError if the same idnumber is given for two courses.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> ids = muddle.group.API(m).ensure_groups([
+        ...     {'courseid': 10, 'name': 'Lab A', 'idnumber': 'LAB-A'}])
+        >>> ids['LAB-A']
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('ensure_groups requires a (synchronous) WSConfig')
+        return self._ensure(groups, self.get_course_groups, self.create_groups)
+
+    def ensure_groupings(self, groupings):
+        """
+        Create groupings that don't already exist, matching on idnumber.
+        As per ensure_groups, with groupings as per create_groupings.
+
+        Returns a dict of idnumber -> grouping id.
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('ensure_groupings requires a (synchronous) WSConfig')
+        return self._ensure(groupings, self.get_course_groupings, self.create_groupings)
+
+    def _ensure(self, items, get_existing, create):
+        items = list(items)
+        for item in items:
+            if not item.get('idnumber'):
+                raise ValueError("Item without an idnumber: %r" % (item,))
+        courses = {}
+        for item in items:
+            courseid = courses.setdefault(item['idnumber'], item['courseid'])
+            if int(courseid) != int(item['courseid']):
+                raise ValueError("idnumber '%s' given for courses %s and %s"
+                                 % (item['idnumber'], courseid, item['courseid']))
+        course_ids = sorted(set(int(item['courseid']) for item in items))
+        # (courseid, idnumber) -> id; idnumbers are only unique per course
+        existing = {}
+        for courseid, result in zip(course_ids, self.config.map(get_existing, course_ids)):
+            for item in check_response(result):
+                if item.get('idnumber'):
+                    existing[(courseid, item['idnumber'])] = item['id']
+
+        missing = []
+        seen = set(existing)
+        for item in items:
+            key = (int(item['courseid']), item['idnumber'])
+            if key not in seen:
+                seen.add(key)
+                missing.append(item)
+        results = self.config.map(
+            lambda batch: check_response(create(batch)),
+            chunks(missing, self.create_chunk_size),
+            return_exceptions=True
+        )
+        ids = dict(existing)
+        errors = []
+        for result in results:
+            if isinstance(result, Exception):
+                errors.append(result)
+            else:
+                ids.update(((int(item['courseid']), item['idnumber']), item['id'])
+                           for item in result)
+        if errors:
+            raise errors[0]
+        return {item['idnumber']: ids[(int(item['courseid']), item['idnumber'])]
+                for item in items}
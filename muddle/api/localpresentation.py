@@ -1,3 +1,4 @@
+from muddle.encoding import encode_params
 from muddle.utils import valid_options
 
 class API:
@@ -25,13 +26,11 @@ class API:
         >>> muddle.localpresentation().get_course_role_users('2018d4_GP', 'convenor')
         """
 
-        params = self.config.request_params
-        params.update({
-            'wsfunction': 'local_presentation_get_course_role_users',
+        params = encode_params('local_presentation_get_course_role_users', {
             'course': coursename,
             'role': rolename,
         })
-        return self.config.session.post(self.config.api_url, params=params).json()
+        return self.config.request('post', params)
 
     def get_course_grade_items(self, coursename):
         """
@@ -62,10 +61,8 @@ class API:
         >>> muddle.localpresentation().get_course_graede_items('2018d4_GP')
         """
 
-        params = self.config.request_params
-        params.update({
-            'wsfunction': 'local_presentation_get_course_grade_items',
+        params = encode_params('local_presentation_get_course_grade_items', {
             'course': coursename
         })
-        return self.config.session.get(self.config.api_url, params=params).json()
+        return self.config.request('get', params)
 
@@ -1,5 +1,12 @@
+from muddle.activity import ActivityStore
+from muddle.config import AsyncWSConfig
+from muddle.encoding import encode_params
+from muddle.exceptions import check_response
 from muddle.utils import valid_options
 
+GRANULARITIES = ('daily', 'weekly', 'monthly')
+
+
 class API:
     """ Represents API endpoints for Moodle stats """
 
@@ -22,16 +29,12 @@ class API:
         :keyword int    activity_read: read activity by role during time period
         :keyword int    activity_write: write activity by role during time period
         """
-        params = {
-            'wsfunction': 'local_presentation_get_stats_activity_monthly_by_course',
+        params = encode_params('local_presentation_get_stats_activity_monthly_by_course', {
             'course': course_shortname,
-        }
-        if time_start is not None:
-            params['starttime'] = time_start
-        if time_end is not None:
-            params['endtime'] = time_end
-        params.update(self.config.request_params)
-        return self.config.session.get(self.config.api_url, params=params).json()
+            'starttime': time_start,
+            'endtime': time_end,
+        })
+        return self.config.request('get', params)
 
     def weekly_activity_by_shortname(self, course_shortname, time_start=None, time_end=None):
         """
@@ -49,16 +52,12 @@ class API:
         :keyword int    activity_read: read activity by role during time period
         :keyword int    activity_write: write activity by role during time period
         """
-        params = {
-            'wsfunction': 'local_presentation_get_stats_activity_weekly_by_course',
+        params = encode_params('local_presentation_get_stats_activity_weekly_by_course', {
             'course': course_shortname,
-        }
-        if time_start is not None:
-            params['starttime'] = time_start
-        if time_end is not None:
-            params['endtime'] = time_end
-        params.update(self.config.request_params)
-        return self.config.session.get(self.config.api_url, params=params).json()
+            'starttime': time_start,
+            'endtime': time_end,
+        })
+        return self.config.request('get', params)
 
     def daily_activity_by_shortname(self, course_shortname, time_start=None, time_end=None):
         """
@@ -76,13 +75,73 @@ class API:
         :keyword int    activity_read: read activity by role during time period
         :keyword int    activity_write: write activity by role during time period
         """
-        params = {
-            'wsfunction': 'local_presentation_get_stats_activity_daily_by_course',
+        params = encode_params('local_presentation_get_stats_activity_daily_by_course', {
             'course': course_shortname,
-        }
-        if time_start is not None:
-            params['starttime'] = time_start
-        if time_end is not None:
-            params['endtime'] = time_end
-        params.update(self.config.request_params)
-        return self.config.session.get(self.config.api_url, params=params).json()
+            'starttime': time_start,
+            'endtime': time_end,
+        })
+        return self.config.request('get', params)
+
+    def activity_by_shortname(self, granularity, course_shortname, time_start=None, time_end=None):
+        """
+        Fetch activity data for specified course at the given granularity,
+        'daily', 'weekly' or 'monthly'. See daily_activity_by_shortname.
+        """
+        if granularity not in GRANULARITIES:
+            raise ValueError("granularity must be one of %s" % ', '.join(GRANULARITIES))
+        fetch = getattr(self, '%s_activity_by_shortname' % granularity)
+        return fetch(course_shortname, time_start, time_end)
+
+    def harvest(self, course_shortnames, granularity='daily', time_start=None, time_end=None,
+                store=None, workers=None, on_error=None):
+        """
+        Fetch activity data for many courses into a columnar ActivityStore,
+        up to `workers` courses at once, for reporting without building a
+        dict per row.
+
+        :param iterable course_shortnames: courses to fetch
+        :param string granularity: (optional) Defaults to 'daily'. Or \
+            'weekly' or 'monthly'
+        :param int time_start: (optional) UNIX time to fetch from
+        :param int time_end: (optional) UNIX time to fetch to
+        :param store: (optional) ActivityStore to add the rows to
+        :param int workers: (optional) Defaults to WSConfig.workers. Courses \
+            fetched at once
+        :param callable on_error: (optional) on_error(course_shortname, \
+            exception) is called for a course that can't be read, which is \
+            then skipped. By default the exception is raised.
+
+        Returns the store.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> stats = muddle.stats.API(m)
+        >>> store = stats.harvest(shortnames, 'daily', time_start=1767182400)
+        >>> len(store), store.nbytes
+        (5840000, 105120000)
+        >>> store.rollup(by=('role', 'period'), period='month')
+        {('student', '2026-01'): (912340, 40122), ...}
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('harvest requires a (synchronous) WSConfig')
+        if granularity not in GRANULARITIES:
+            raise ValueError("granularity must be one of %s" % ', '.join(GRANULARITIES))
+        if store is None:
+            store = ActivityStore(granularity)
+
+        def fetch(shortname):
+            try:
+                rows = self.activity_by_shortname(granularity, shortname, time_start, time_end)
+                return shortname, check_response(rows), None
+            except Exception as e:
+                return shortname, None, e
+
+        for shortname, rows, error in self.config.imap(fetch, course_shortnames, workers):
+            if error is not None:
+                if on_error is None:
+                    raise error
+                on_error(shortname, error)
+                continue
+            store.extend(rows)
+        return store
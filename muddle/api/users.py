@@ -1,17 +1,164 @@
-from muddle.utils import valid_options, clean_username
+import asyncio
+from concurrent.futures import Future
+
+from muddle.batch import then
+from muddle.config import AsyncWSConfig
+from muddle.encoding import encode_params
+from muddle.exceptions import check_response
+from muddle.records import Record, project
+from muddle.utils import valid_options, clean_username, chunks
+
+
+def _match_key(fieldname, value):
+    # Moodle compares usernames and emails case-insensitively
+    value = str(value)
+    if fieldname in ('username', 'email'):
+        return value.lower()
+    return value
+
+
+def _with_key_fields(fields, fieldname):
+    # Results are merged and matched on id and the looked-up field
+    if fields is None or isinstance(fields, type) and issubclass(fields, Record):
+        return fields
+    fields = tuple(fields)
+    for field in ('id', fieldname):
+        if field not in fields:
+            fields += (field,)
+    return fields
+
+
+class UserResolver:
+    """
+    Maps usernames, idnumbers and emails to user ids, remembering both
+    the users it has found and the values that matched no user, so each
+    value is looked up at most once. Made by API.resolver.
+
+    Every user fetched is indexed by all of RESOLVED_FIELDS, so looking a
+    user up by username also answers later questions about their idnumber
+    and email.
+    """
+
+    RESOLVED_FIELDS = ('username', 'idnumber', 'email')
+
+    def __init__(self, api):
+        self.api = api
+        self.ids = {field: {} for field in self.RESOLVED_FIELDS}
+        self.missing = {field: set() for field in self.RESOLVED_FIELDS}
+        # Set once every user has been loaded, after which unknown values
+        # are misses without asking Moodle
+        self.complete = False
+        self._cleaned = {}
+
+    def _key(self, field, value):
+        if field == 'username':
+            cleaned = self._cleaned.get(value)
+            if cleaned is None:
+                cleaned = self._cleaned[value] = clean_username(value)
+            value = cleaned
+        return _match_key(field, value)
+
+    def add(self, users):
+        """ Index user records, e.g. from get_users_by_field """
+        for user in users:
+            for field in self.RESOLVED_FIELDS:
+                value = user.get(field)
+                if value:
+                    key = _match_key(field, value)
+                    self.ids[field][key] = user['id']
+                    self.missing[field].discard(key)
+
+    def preload(self, field, values):
+        """
+        Fetch any of values not already known, in chunked concurrent
+        calls, recording those that match no user.
+        """
+        ids = self.ids[field]
+        missing = self.missing[field]
+        unknown = {}
+        for value in values:
+            key = self._key(field, value)
+            if key not in ids and key not in missing:
+                unknown.setdefault(key, value)
+        if not unknown or self.complete:
+            missing.update(unknown)
+            return
+        self.add(self.api.get_users_by_field(field, list(unknown), clean=False,
+                                             fields=self.RESOLVED_FIELDS))
+        missing.update(key for key in unknown if key not in ids)
+
+    def preload_all(self, chunk_size=1000, max_gap=10000):
+        """
+        Fetch every user, by id, chunk_size ids per call with API.workers
+        calls at a time. Stops once max_gap ids in a row have had no user,
+        so set it above the largest run of deleted users.
+        """
+        start = 1
+        last = 0
+        step = chunk_size * self.api.workers
+        while start - last <= max_gap:
+            users = self.api.get_users_by_field('id', range(start, start + step),
+                                                chunk_size=chunk_size, fields=self.RESOLVED_FIELDS)
+            self.add(users)
+            if users:
+                last = max(user['id'] for user in users)
+            start += step
+        self.complete = True
+
+    def resolve(self, field, values):
+        """
+        Return the user id for each of values, in order, with None where no
+        user matches. Only values never seen before are looked up.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> resolver = muddle.users.API(m).resolver()
+        >>> resolver.resolve('username', ['bob', 'Alice '])
+        [101, 102]
+        """
+        values = list(values)
+        self.preload(field, values)
+        ids = self.ids[field]
+        return [ids.get(self._key(field, value)) for value in values]
+
+    def resolve_one(self, field, value):
+        return self.resolve(field, [value])[0]
+
 
 class API:
     """ Represents API endpoints for Moodle Users """
 
+    # Values sent per request, and concurrent requests, when looking up
+    # more values than fit in one chunk
+    chunk_size = 100
+    workers = 4
+
     def __init__(self, config):
         self.config = config
 
-    def get_users_by_field(self, fieldname, values, clean=True):
+    def get_users_by_field(self, fieldname, values, clean=True, chunk_size=None, workers=None,
+                           fields=None):
         """
         Get users with field matching values
 
         :param string field: 'id', 'idnumber', 'username' or 'email'
         :param list values: a list of values to match
+        :param int chunk_size: (optional) Defaults to API.chunk_size. \
+            Values are sent in chunks of this size to stay inside URL and \
+            max_input_vars limits
+        :param int workers: (optional) Defaults to API.workers. \
+            Number of chunks requested concurrently
+        :param fields: (optional) Return slotted records (see \
+            muddle.records) holding only these fields, e.g. \
+            ('id', 'username'), rather than full dicts. 'id' and fieldname \
+            are always included. records.User gives its standard fields.
+
+        Users are returned once each, ordered as the matching values were
+        given, however many chunks are needed, and a WSError is raised if
+        any chunk fails. Use match_users_by_field to see which values had
+        no match. In a Batch, values must fit in one chunk, and a Future
+        for the users is returned.
 
         Returns:
 
@@ -56,13 +203,130 @@ class API:
         :param list preferences: List of preferences, each having 'name' and 'value'
         """
 
-        option_params = { 'field': fieldname }
-        for (index, value) in enumerate(values):
-            if (clean and (fieldname == 'username')):
-                value = clean_username(value)
-            option_params['values[' + str(index) + ']'] = value
+        values = list(values)
+        if clean and fieldname == 'username':
+            values = [clean_username(value) for value in values]
+        value_chunks = chunks(values, chunk_size or self.chunk_size)
+        fields = _with_key_fields(fields, fieldname)
+        if isinstance(self.config, AsyncWSConfig):
+            return self._gather_users_by_field(fieldname, values, value_chunks, fields)
+        if len(value_chunks) == 1:
+            result = self._get_users_by_field(fieldname, values, fields)
+            if isinstance(result, Future):
+                return then(result, lambda result: self._merge_users(fieldname, values, [result]))
+            return self._merge_users(fieldname, values, [result])
+        # Each chunk is projected as it arrives, so full dicts for all the
+        # users are never held at once
+        results = self.config.map(
+            lambda chunk: self._get_users_by_field(fieldname, chunk, fields),
+            value_chunks, workers or self.workers)
+        return self._merge_users(fieldname, values, results)
+
+    def match_users_by_field(self, fieldname, values, clean=True, chunk_size=None, workers=None,
+                             fields=None):
+        """
+        Look up users as per get_users_by_field, reporting misses.
+
+        Returns a list of (value, user) pairs in the order the values were
+        given; user is None where no user matched the value.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> pairs = muddle.users.API(m).match_users_by_field('username', ['bob', 'alice'])
+        >>> missing = [value for (value, user) in pairs if user is None]
+        """
+        values = list(values)
+        users = self.get_users_by_field(fieldname, values, clean, chunk_size, workers, fields)
+        found = {_match_key(fieldname, user[fieldname]): user for user in check_response(users)}
+        pairs = []
+        for value in values:
+            key = value
+            if clean and fieldname == 'username':
+                key = clean_username(value)
+            pairs.append((value, found.get(_match_key(fieldname, key))))
+        return pairs
+
+    def resolver(self, preload_all=False):
+        """
+        Return a UserResolver for mapping usernames, idnumbers and emails
+        to user ids, optionally loading every user up front.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> resolver = muddle.users.API(m).resolver()
+        >>> resolver.preload('username', roster_usernames)
+        >>> userids = resolver.resolve('username', roster_usernames)
+        """
+        if isinstance(self.config, AsyncWSConfig):
+            raise TypeError('UserResolver requires a (synchronous) WSConfig')
+        resolver = UserResolver(self)
+        if preload_all:
+            resolver.preload_all()
+        return resolver
+
+    def iter_users_by_field(self, fieldname, values, clean=True, chunk_size=None, backend='json'):
+        """
+        As get_users_by_field, but yields users one at a time as each
+        response is decoded. Chunks are fetched one after another, so only
+        one user record need be held in memory at a time. Users come in
+        the order Moodle returns them.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> for user in muddle.users.API(m).iter_users_by_field('idnumber', idnumbers):
+        ...     print(user['id'], user['username'])
+        """
+        values = list(values)
+        if clean and fieldname == 'username':
+            values = [clean_username(value) for value in values]
+        value_chunks = chunks(values, chunk_size or self.chunk_size)
+        if isinstance(self.config, AsyncWSConfig):
+            return self._aiter_users_by_field(fieldname, value_chunks, backend)
+        return self._iter_users_by_field(fieldname, value_chunks, backend)
+
+    def _iter_users_by_field(self, fieldname, value_chunks, backend):
+        for chunk in value_chunks:
+            yield from self.config.stream('get', self._users_by_field_params(fieldname, chunk), backend)
+
+    async def _aiter_users_by_field(self, fieldname, value_chunks, backend):
+        for chunk in value_chunks:
+            async for user in self.config.stream('get', self._users_by_field_params(fieldname, chunk), backend):
+                yield user
+
+    @staticmethod
+    def _users_by_field_params(fieldname, values):
+        return encode_params('core_user_get_users_by_field', {
+            'field': fieldname,
+            'values': values,
+        })
+
+    def _get_users_by_field(self, fieldname, values, fields=None):
+        params = self._users_by_field_params(fieldname, values)
+        result = self.config.request('get', params)
+        if fields is not None:
+            return project(result, fields)
+        return result
+
+    async def _gather_users_by_field(self, fieldname, values, value_chunks, fields=None):
+        results = await asyncio.gather(
+            *[self._get_users_by_field(fieldname, chunk, fields) for chunk in value_chunks])
+        return self._merge_users(fieldname, values, results)
 
-        params = {'wsfunction': 'core_user_get_users_by_field'}
-        params.update(option_params)
-        params.update(self.config.request_params)
-        return self.config.session.get(self.config.api_url, params=params).json()
+    @staticmethod
+    def _merge_users(fieldname, values, results):
+        # Merge per-chunk results back into input order, dropping duplicates
+        found = {}
+        for result in results:
+            for user in check_response(result):
+                found[_match_key(fieldname, user[fieldname])] = user
+        users = []
+        seen = set()
+        for value in values:
+            user = found.get(_match_key(fieldname, value))
+            if user is not None and user['id'] not in seen:
+                seen.add(user['id'])
+                users.append(user)
+        return users
@@ -0,0 +1,182 @@
+# Several web service calls in one HTTP request
+
+import json
+from concurrent.futures import Future
+
+from .exceptions import MuddleError, WSError, check_response
+from .utils import is_read_function, unflatten_params
+
+BATCH_WSFUNCTION = 'tool_mobile_call_external_functions'
+
+
+def then(future, fn):
+    """
+    Return a Future for fn(result) of future, for API methods that work on
+    a result queued in a Batch. An exception from the call or from fn is
+    passed on.
+    """
+    chained = Future()
+
+    def done(future):
+        if future.cancelled():
+            chained.cancel()
+            return
+        try:
+            chained.set_result(fn(future.result()))
+        except Exception as e:
+            chained.set_exception(e)
+
+    future.add_done_callback(done)
+    return chained
+
+
+class Batch:
+    """
+    Queues web service calls and sends them together through Moodle's
+    tool_mobile_call_external_functions.
+
+    Use in place of a WSConfig when creating API objects. Each API call
+    returns a concurrent.futures.Future straight away; futures are resolved
+    when the batch is sent, on leaving the with block. Results are always
+    decoded JSON, even for methods that would otherwise return a response
+    object. Moodle stops at the first failing call, so calls queued after it
+    fail with a MuddleError.
+
+    With a cache on the config, queued reads are answered from it where
+    they can be, and each call's result updates or invalidates the cache
+    as if it had been sent on its own.
+
+    Example Usage::
+
+    >>> import muddle
+    >>> with m.batch() as b:
+    ...     contents = muddle.course.API(b).get_course_contents(10)
+    ...     groups = muddle.group.API(b).get_course_groups(10)
+    >>> contents.result(), groups.result()
+    """
+
+    def __init__(self, config, **settings):
+        self.config = config
+        self.api_url = config.api_url
+        # settingraw, settingfilter, settingfileurl, settinglang
+        self.settings = settings
+        self._calls = []
+
+    @property
+    def request_params(self):
+        return self.config.request_params
+
+    def request(self, method, params, decode=True):
+        """ Queue a call; returns a Future for its result """
+        future = Future()
+        self._calls.append((dict(params), future))
+        return future
+
+    def __len__(self):
+        return len(self._calls)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.send()
+        else:
+            self.cancel()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            await self.send_async()
+        else:
+            self.cancel()
+
+    def cancel(self):
+        """ Drop queued calls without sending them """
+        calls, self._calls = self._calls, []
+        for params, future in calls:
+            future.cancel()
+
+    def send(self):
+        """ Send queued calls in one request and resolve their futures """
+        calls = self._from_cache()
+        if not calls:
+            return
+        try:
+            data = self.config.request('post', self._batch_params(calls))
+        except Exception as e:
+            data = e
+        self._resolve(calls, data)
+        self._update_cache(calls)
+
+    async def send_async(self):
+        """ As send, for use with AsyncWSConfig """
+        calls = self._from_cache()
+        if not calls:
+            return
+        try:
+            data = await self.config.request('post', self._batch_params(calls))
+        except Exception as e:
+            data = e
+        self._resolve(calls, data)
+        self._update_cache(calls)
+
+    def _from_cache(self):
+        # Take the queued calls, resolving reads that are cached; only
+        # those queued before any write, which could make them stale
+        calls, self._calls = self._calls, []
+        cache = self.config.cache
+        if cache is None:
+            return calls
+        remaining = []
+        for i, (params, future) in enumerate(calls):
+            if not is_read_function(params['wsfunction']):
+                return remaining + calls[i:]
+            hit, data = cache.get(params)
+            if hit:
+                future.set_result(data)
+            else:
+                remaining.append((params, future))
+        return remaining
+
+    def _update_cache(self, calls):
+        # In call order, so a read queued after a write is cached but one
+        # queued before it is dropped again
+        cache = self.config.cache
+        if cache is None:
+            return
+        for params, future in calls:
+            cache.invalidate(params)
+            if not future.cancelled() and future.exception() is None:
+                cache.set(params, future.result())
+
+    def _batch_params(self, calls):
+        params = {'wsfunction': BATCH_WSFUNCTION}
+        for i, (call_params, future) in enumerate(calls):
+            call_params = dict(call_params)
+            params['requests[%s][function]' % i] = call_params.pop('wsfunction')
+            params['requests[%s][arguments]' % i] = json.dumps(unflatten_params(call_params))
+            for key, value in self.settings.items():
+                params['requests[%s][%s]' % (i, key)] = int(value) if isinstance(value, bool) else value
+        return params
+
+    @staticmethod
+    def _resolve(calls, data):
+        try:
+            responses = check_response(data)['responses']
+        except Exception as e:
+            # The batch request itself failed, so every call did
+            for params, future in calls:
+                future.set_exception(data if isinstance(data, Exception) else e)
+            return
+        for i, (params, future) in enumerate(calls):
+            if i >= len(responses):
+                future.set_exception(MuddleError(
+                    '%s not run: an earlier call in the batch failed' % params['wsfunction']))
+            elif responses[i]['error']:
+                future.set_exception(WSError(json.loads(responses[i]['exception'])))
+            else:
+                data = responses[i]['data']
+                future.set_result(None if data is None else json.loads(data))
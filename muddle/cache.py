@@ -0,0 +1,393 @@
+# Response caching for read-only web service functions
+
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+from .batch import BATCH_WSFUNCTION
+from .utils import is_read_function
+
+# Parameters that don't affect a response
+IGNORED_PARAMS = ('wstoken', 'moodlewsrestformat')
+
+# Write function -> reads it makes stale, as
+# (read function, read param pattern, write param pattern). Cached reads
+# are dropped if their values for the read pattern overlap the write's
+# values for the write pattern; if the patterns are None, all cached
+# results of that read are dropped. '*' matches an array index. Writes
+# not listed here clear the whole cache.
+INVALIDATES = {
+    'core_group_create_groups': [
+        ('core_group_get_course_groups', 'courseid', 'groups[*][courseid]'),
+    ],
+    'core_group_delete_groups': [
+        ('core_group_get_groups', 'groupids[*]', 'groupids[*]'),
+        ('core_group_get_course_groups', None, None),
+        ('core_group_get_group_members', 'groupids[*]', 'groupids[*]'),
+        ('core_group_get_groupings', None, None),
+    ],
+    'core_group_add_group_members': [
+        ('core_group_get_group_members', 'groupids[*]', 'members[*][groupid]'),
+    ],
+    'core_group_delete_group_members': [
+        ('core_group_get_group_members', 'groupids[*]', 'members[*][groupid]'),
+    ],
+    'core_group_create_groupings': [
+        ('core_group_get_course_groupings', 'courseid', 'groupings[*][courseid]'),
+    ],
+    'core_group_update_groupings': [
+        ('core_group_get_groupings', 'groupingids[*]', 'groupings[*][id]'),
+        ('core_group_get_course_groupings', None, None),
+    ],
+    'core_group_delete_groupings': [
+        ('core_group_get_groupings', 'groupingids[*]', 'groupingids[*]'),
+        ('core_group_get_course_groupings', None, None),
+    ],
+    'core_group_assign_grouping': [
+        ('core_group_get_groupings', 'groupingids[*]', 'assignments[*][groupingid]'),
+    ],
+    'core_course_create_courses': [
+        ('core_course_get_courses', None, None),
+        ('core_course_get_courses_by_field', None, None),
+        ('core_course_get_categories', None, None),
+    ],
+    'core_course_delete_courses': [
+        ('core_course_get_courses', None, None),
+        ('core_course_get_courses_by_field', None, None),
+        ('core_course_get_categories', None, None),
+        ('core_course_get_contents', 'courseid', 'courseids[*]'),
+    ],
+    'core_course_duplicate_course': [
+        ('core_course_get_courses', None, None),
+        ('core_course_get_courses_by_field', None, None),
+        ('core_course_get_categories', None, None),
+    ],
+    'core_course_import_course': [
+        ('core_course_get_contents', 'courseid', 'importto'),
+        ('core_course_get_contents', 'courseid', 'importfrom'),
+    ],
+    'core_course_create_categories': [
+        ('core_course_get_categories', None, None),
+    ],
+    'core_course_update_categories': [
+        ('core_course_get_categories', None, None),
+        ('core_course_get_courses_by_field', None, None),
+    ],
+    'core_course_delete_categories': [
+        ('core_course_get_categories', None, None),
+        ('core_course_get_courses', None, None),
+        ('core_course_get_courses_by_field', None, None),
+    ],
+}
+
+
+def _pattern(name):
+    return re.compile('^' + re.escape(name).replace(r'\*', r'\d+') + '$')
+
+
+def _values(params, pattern):
+    """ Set of string values of params whose keys match pattern """
+    pattern = _pattern(pattern)
+    values = set()
+    for key, value in params:
+        if pattern.match(key):
+            if isinstance(value, (list, tuple)):
+                values.update(value)
+            else:
+                values.add(value)
+    return values
+
+
+def normalize_params(params):
+    """
+    Hashable, order-independent form of a request's parameters, without
+    token or format. Values are compared as strings, as Moodle sees them.
+    """
+    items = []
+    for key, value in params.items():
+        if key in IGNORED_PARAMS or value is None:
+            continue
+        if isinstance(value, (list, tuple)):
+            value = tuple(str(item) for item in value)
+        elif isinstance(value, bool):
+            value = str(int(value))
+        else:
+            value = str(value)
+        items.append((key, value))
+    return tuple(sorted(items))
+
+
+class CacheBase:
+    """ TTL and invalidation rules shared by the cache backends """
+
+    def __init__(self, ttl=300, ttls=None):
+        self.ttl = ttl
+        self.ttls = dict(ttls or {})
+        self.hits = 0
+        self.misses = 0
+
+    def _ttl(self, wsfunction):
+        return self.ttls.get(wsfunction, self.ttl)
+
+    def _expires(self, params):
+        ttl = self._ttl(params.get('wsfunction'))
+        return None if ttl is None else time.time() + ttl
+
+    def cacheable(self, params):
+        wsfunction = params.get('wsfunction', '')
+        return is_read_function(wsfunction) and self._ttl(wsfunction) != 0
+
+    def key(self, params):
+        return (params.get('wsfunction'), normalize_params(params))
+
+    def invalidate(self, params):
+        """ Drop cached reads made stale by the write call with these params """
+        wsfunction = params.get('wsfunction', '')
+        # Batch invalidates for each of its calls instead
+        if is_read_function(wsfunction) or wsfunction == BATCH_WSFUNCTION:
+            return
+        rules = INVALIDATES.get(wsfunction)
+        if rules is None:
+            self.clear()
+            return
+        self._invalidate(rules, normalize_params(params))
+
+    @staticmethod
+    def _stale(key, rules, written):
+        for (read_function, read_pattern, write_pattern) in rules:
+            if key[0] != read_function:
+                continue
+            if read_pattern is None or (
+                    _values(key[1], read_pattern) & _values(written, write_pattern)):
+                return True
+        return False
+
+
+class ResponseCache(CacheBase):
+    """
+    In-memory cache of decoded responses from read functions.
+
+    Entries are keyed by wsfunction and normalized parameters, expire after
+    a per-function TTL, and the least recently used are evicted once there
+    are more than maxsize. Cached results are shared between callers, so
+    treat them as read-only.
+
+    :param int maxsize: (optional) Defaults to 1024. Most entries to keep
+    :param int ttl: (optional) Defaults to 300. Seconds entries live; None \
+        for no expiry
+    :param dict ttls: (optional) TTLs for particular functions, overriding \
+        ttl. A TTL of 0 stops that function being cached.
+
+    Example Usage::
+
+    >>> import muddle
+    >>> cache = muddle.cache.ResponseCache(ttls={'core_course_get_courses': 3600})
+    >>> m = muddle.WSConfig(api_key='dsghsa8casjnajk833', api_url='https://my.moodle.example.com', cache=cache)
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, ttls=None):
+        super().__init__(ttl, ttls)
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, params):
+        """ Returns (True, result) if a fresh result is cached, else (False, None) """
+        if not self.cacheable(params):
+            return False, None
+        key = self.key(params)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                expires, value = entry
+                if expires is None or expires > time.time():
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return True, value
+                del self._entries[key]
+            self.misses += 1
+        return False, None
+
+    def set(self, params, value):
+        """ Cache a result, unless it is a Moodle error """
+        if not self.cacheable(params):
+            return
+        if isinstance(value, dict) and 'exception' in value:
+            return
+        key = self.key(params)
+        with self._lock:
+            self._entries[key] = (self._expires(params), value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def _invalidate(self, rules, written):
+        with self._lock:
+            for key in list(self._entries):
+                if self._stale(key, rules, written):
+                    del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SQLiteCache(CacheBase):
+    """
+    Cache of read results in an SQLite file, so that separate processes
+    (cron jobs, shell loops) can share them. Safe for concurrent use by
+    several processes and threads.
+
+    :param string path: database file; created if missing
+    :param string namespace: (optional) Keeps results for different sites \
+        and tokens apart; WSConfig sets this to its api_url and a hash of \
+        its token if not given
+    :param int ttl: (optional) Defaults to 3600. Seconds entries live; None \
+        for no expiry
+    :param dict ttls: (optional) TTLs for particular functions, overriding ttl
+    :param int maxsize: (optional) Defaults to None (unlimited). Entries kept; \
+        those closest to expiry are dropped first
+
+    The file is created readable only by its owner, as results can hold
+    user records.
+
+    In ~/.mdl, give a service a 'cache' entry with a 'path' to use one::
+
+        "services": {
+            "prod": {
+                "baseurl": "https://my.moodle.example.com",
+                "token": "dsghsa8casjnajk833",
+                "cache": {"path": "~/.cache/muddle.sqlite", "ttl": 3600}
+            }
+        }
+    """
+
+    # Expired rows are purged every this many writes
+    purge_interval = 100
+
+    def __init__(self, path, namespace=None, ttl=3600, ttls=None, maxsize=None):
+        super().__init__(ttl, ttls)
+        self.path = os.path.expanduser(path)
+        self.namespace = namespace
+        self.maxsize = maxsize
+        self._local = threading.local()
+        self._writes = 0
+        self._connection().execute(
+            'CREATE TABLE IF NOT EXISTS responses ('
+            ' namespace TEXT NOT NULL,'
+            ' wsfunction TEXT NOT NULL,'
+            ' params TEXT NOT NULL,'
+            ' expires REAL,'
+            ' value TEXT NOT NULL,'
+            ' PRIMARY KEY (namespace, wsfunction, params))'
+        )
+
+    def _connection(self):
+        # sqlite3 connections can't be shared between threads
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, mode=0o700, exist_ok=True)
+            if not os.path.exists(self.path):
+                # SQLite gives its WAL files the database file's mode
+                os.close(os.open(self.path, os.O_CREAT | os.O_WRONLY, 0o600))
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+        return connection
+
+    def _row_key(self, params):
+        return (self.namespace or '', params.get('wsfunction'),
+                json.dumps(normalize_params(params)))
+
+    def __len__(self):
+        return self._connection().execute(
+            'SELECT COUNT(*) FROM responses WHERE namespace = ?',
+            (self.namespace or '',)).fetchone()[0]
+
+    def get(self, params):
+        """ Returns (True, result) if a fresh result is cached, else (False, None) """
+        if not self.cacheable(params):
+            return False, None
+        row = self._connection().execute(
+            'SELECT value FROM responses WHERE namespace = ? AND wsfunction = ? AND params = ?'
+            ' AND (expires IS NULL OR expires > ?)',
+            self._row_key(params) + (time.time(),)).fetchone()
+        if row is None:
+            self.misses += 1
+            return False, None
+        self.hits += 1
+        return True, json.loads(row[0])
+
+    def set(self, params, value):
+        """ Cache a result, unless it is a Moodle error """
+        if not self.cacheable(params):
+            return
+        if isinstance(value, dict) and 'exception' in value:
+            return
+        connection = self._connection()
+        connection.execute(
+            'INSERT OR REPLACE INTO responses (namespace, wsfunction, params, expires, value)'
+            ' VALUES (?, ?, ?, ?, ?)',
+            self._row_key(params) + (self._expires(params), json.dumps(value)))
+        self._writes += 1
+        if self._writes % self.purge_interval == 0:
+            self.purge()
+
+    def purge(self):
+        """ Delete expired entries, and the excess over maxsize """
+        connection = self._connection()
+        connection.execute(
+            'DELETE FROM responses WHERE expires IS NOT NULL AND expires <= ?', (time.time(),))
+        if self.maxsize is not None:
+            connection.execute(
+                'DELETE FROM responses WHERE rowid IN (SELECT rowid FROM responses'
+                ' ORDER BY expires IS NOT NULL, expires DESC LIMIT -1 OFFSET ?)',
+                (self.maxsize,))
+
+    def _invalidate(self, rules, written):
+        connection = self._connection()
+        functions = set(rule[0] for rule in rules)
+        stale = []
+        for wsfunction in functions:
+            rows = connection.execute(
+                'SELECT params FROM responses WHERE namespace = ? AND wsfunction = ?',
+                (self.namespace or '', wsfunction))
+            for (params,) in rows:
+                key = (wsfunction, [tuple(item) for item in json.loads(params)])
+                if self._stale(key, rules, written):
+                    stale.append((self.namespace or '', wsfunction, params))
+        connection.executemany(
+            'DELETE FROM responses WHERE namespace = ? AND wsfunction = ? AND params = ?', stale)
+
+    def clear(self):
+        self._connection().execute(
+            'DELETE FROM responses WHERE namespace = ?', (self.namespace or '',))
+
+
+def make_cache(cache, namespace=None):
+    """
+    Cache from a WSConfig 'cache' option: True, a dict of settings (with a
+    'path' for an SQLiteCache), or a cache object.
+    """
+    if cache is True:
+        return ResponseCache()
+    if isinstance(cache, dict):
+        if 'path' in cache:
+            settings = {'namespace': namespace}
+            settings.update(cache)
+            return SQLiteCache(**settings)
+        return ResponseCache(**cache)
+    if cache is False:
+        return None
+    # Not `cache or None`: an empty cache is falsy
+    return cache
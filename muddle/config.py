@@ -1,14 +1,35 @@
 # muddle configuration file handling
 
 import argparse
+import asyncio
+import collections
+import copy
+import hashlib
 import json
 import os
 import requests
 import logging
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 import http.client as http_client
+from urllib.parse import urlencode
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+from .batch import Batch
+from .cache import make_cache
+from .jsonstream import ArrayDecoder, iter_array, loads
+from .utils import is_read_function
 
 MOODLE_WS_ENDPOINT = '/webservice/rest/server.php'
 
+log = logging.getLogger(__name__)
+
 # Python3, no need for (object)
 class WSConfig:
     """
@@ -18,28 +39,544 @@ class WSConfig:
 
     >>> import muddle
     >>> config = muddle.config.WSConfig(api_key='dsghsa8casjnajk833', api_url='https://my.moodle.example.com')
+
+    Parameters for 'post' calls (all the write functions) are sent as a
+    form-encoded body, keeping the token out of URLs and logs and avoiding
+    request line limits; set form_body=False for the old behaviour. Reads
+    are sent the same way if post_reads is set, or if their query string
+    would be longer than max_query_length.
+
+    Transport options (keyword arguments, or per-service in ~/.mdl):
+
+    :keyword int pool_connections: Defaults to 10. Number of hosts to keep \
+        connection pools for
+    :keyword int pool_maxsize: Defaults to 10. Connections kept per host; \
+        raise this to match the number of concurrent callers
+    :keyword bool keep_alive: Defaults to True. Reuse connections between \
+        requests
+    :keyword timeout: Defaults to None (wait forever). Seconds, or a \
+        [connect, read] pair
+    :keyword int retries: Defaults to 0. Times to retry a read function \
+        after a connection error, timeout or 5xx status. Writes are never \
+        retried, as they may have taken effect.
+    :keyword float backoff_factor: Defaults to 0.5. Retry n waits \
+        backoff_factor * 2 ** (n - 1) seconds first
+
+    connection_stats() reports how often pooled connections were reused.
+
+    requests sessions aren't thread-safe, so each thread using the config
+    gets its own session, made on first use. They share verify, headers
+    and one connection pool; map() and imap() run calls across a thread
+    pool. A session passed in is used as-is by every thread.
+
+    :keyword cache: Defaults to None. A muddle.cache.ResponseCache, True for \
+        one with default settings, or a dict of ResponseCache arguments. \
+        Results of read functions are then cached, and write calls made \
+        through this config drop the cached reads they affect. A dict with \
+        a 'path' makes a muddle.cache.SQLiteCache shared between processes.
     """
     verify = None
-    session = None
-    
-    def __init__(self, api_key=None, api_url=None, session=None, verify=None):
+    form_body = True
+    post_reads = False
+    max_query_length = 4000
+    pool_connections = 10
+    pool_maxsize = 10
+    keep_alive = True
+    timeout = None
+    retries = 0
+    backoff_factor = 0.5
+    cache = None
+    retry_statuses = (500, 502, 503, 504)
+    # Bytes read at a time by stream()
+    stream_chunk_size = 65536
+    # Default thread pool size for map()
+    workers = 8
+
+    # Keyword arguments accepted by __init__; None leaves the default alone
+    options = (
+        'form_body', 'post_reads', 'max_query_length',
+        'pool_connections', 'pool_maxsize', 'keep_alive', 'timeout',
+        'retries', 'backoff_factor', 'cache',
+    )
+
+    def __init__(self, api_key=None, api_url=None, session=None, verify=None, **options):
         self.api_key = api_key
         self.api_url = api_url + MOODLE_WS_ENDPOINT
-        if session is None:
-            session = requests.Session()
+        self._set_options(options)
         if verify is not None:
             self.verify = verify
-            session.verify = verify
-        self.session = session
+            if session is not None:
+                session.verify = verify
+        self._session = session
+        self._local = threading.local()
+        self._adapter = None
+        self._lock = threading.Lock()
         self._request_params = {
             'wstoken': api_key,
             'moodlewsrestformat': 'json'
         }
 
+    def _set_options(self, options):
+        for key, value in options.items():
+            if key not in self.options:
+                raise TypeError("Unknown %s option '%s'" % (type(self).__name__, key))
+            if value is not None:
+                setattr(self, key, value)
+        if isinstance(self.timeout, list):
+            self.timeout = tuple(self.timeout)
+        self.cache = make_cache(self.cache, self._cache_namespace())
+
+    def _cache_namespace(self):
+        # Tokens for the same site can differ in what they may read, so
+        # their cached results are kept apart; hashed to keep the token
+        # itself out of the cache file
+        token = hashlib.sha256((self.api_key or '').encode('utf-8')).hexdigest()
+        return '%s %s' % (self.api_url, token[:16])
+
+    @property
+    def session(self):
+        """ The calling thread's requests session """
+        if self._session is not None:
+            return self._session
+        session = getattr(self._local, 'session', None)
+        if session is None:
+            session = self._local.session = self._make_session()
+        return session
+
+    @session.setter
+    def session(self, session):
+        self._session = session
+
+    def _make_session(self):
+        with self._lock:
+            # urllib3 pools are thread-safe, so all sessions share one
+            if self._adapter is None:
+                self._adapter = requests.adapters.HTTPAdapter(
+                    pool_connections=self.pool_connections,
+                    pool_maxsize=self.pool_maxsize
+                )
+        session = requests.Session()
+        session.mount('https://', self._adapter)
+        session.mount('http://', self._adapter)
+        if self.verify is not None:
+            session.verify = self.verify
+        if not self.keep_alive:
+            session.headers['Connection'] = 'close'
+        return session
+
+    def map(self, fn, items, workers=None, return_exceptions=False):
+        """
+        Call fn(item) for each item on a pool of threads, for running API
+        calls concurrently. Each thread uses its own session.
+
+        :param callable fn: function of one argument
+        :param iterable items: arguments to call fn with
+        :param int workers: (optional) Defaults to WSConfig.workers. Number \
+            of threads; keep pool_maxsize at least this big so that their \
+            connections are reused
+        :param bool return_exceptions: (optional) Defaults to False. Put \
+            exceptions in the results instead of raising the first one
+
+        Returns a list of results in the order of items. All calls finish
+        before anything is raised.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> api = muddle.group.API(m)
+        >>> groups = m.map(api.get_course_groups, [10, 11, 12], workers=3)
+        """
+        with ThreadPoolExecutor(workers or self.workers) as executor:
+            futures = [executor.submit(fn, item) for item in items]
+        results = []
+        for future in futures:
+            exception = future.exception()
+            if exception is None:
+                results.append(future.result())
+            elif return_exceptions:
+                results.append(exception)
+            else:
+                raise exception
+        return results
+
+    def imap(self, fn, items, workers=None, return_exceptions=False):
+        """
+        Lazy map: as map(), but yields results in the order of items as
+        they become available, with at most `workers` calls running or
+        finished-but-unconsumed ahead of the consumer. Items are read from
+        the iterable only as needed, so long inputs and large results run
+        in bounded memory.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> api = muddle.course.API(m)
+        >>> for contents in m.imap(api.get_course_contents, course_ids, workers=4):
+        ...     audit(contents)
+        """
+        workers = workers or self.workers
+        items = iter(items)
+        pending = collections.deque()
+        with ThreadPoolExecutor(workers) as executor:
+            try:
+                for item in items:
+                    pending.append(executor.submit(fn, item))
+                    if len(pending) >= workers:
+                        yield self._imap_result(pending.popleft(), return_exceptions)
+                while pending:
+                    yield self._imap_result(pending.popleft(), return_exceptions)
+            finally:
+                # Abandoned or failed: don't start anything still queued
+                for future in pending:
+                    future.cancel()
+
+    @staticmethod
+    def _imap_result(future, return_exceptions):
+        exception = future.exception()
+        if exception is None:
+            return future.result()
+        if return_exceptions:
+            return exception
+        raise exception
+
+    def connection_stats(self):
+        """
+        Connection reuse counters for the session's pools.
+
+        Returns a dict with 'requests' made, 'connections' opened, and
+        'reused', the number of requests that went over an existing
+        connection.
+        """
+        stats = {'requests': 0, 'connections': 0}
+        if self._session is not None:
+            adapters = set(self._session.adapters.values())
+        else:
+            adapters = [self._adapter] if self._adapter is not None else []
+        for adapter in adapters:
+            poolmanager = getattr(adapter, 'poolmanager', None)
+            if poolmanager is None:
+                continue
+            for key in poolmanager.pools.keys():
+                pool = poolmanager.pools.get(key)
+                if pool is not None:
+                    stats['requests'] += pool.num_requests
+                    stats['connections'] += pool.num_connections
+        stats['reused'] = max(stats['requests'] - stats['connections'], 0)
+        return stats
+
+    def with_options(self, **options):
+        """
+        Return a copy of the config with some options changed, e.g. a
+        longer timeout for slow calls. The copy shares this config's
+        sessions, connection pool and cache.
+
+        Example Usage::
+
+        >>> import muddle
+        >>> slow = m.with_options(timeout=3600)
+        >>> muddle.course.API(slow).duplicate(10, 'Copy', 'copy-10', 20)
+        """
+        config = copy.copy(self)
+        config._set_options(options)
+        return config
+
+    def _attempts(self, params):
+        # Only reads are safe to send again
+        if is_read_function(params.get('wsfunction', '')):
+            return self.retries + 1
+        return 1
+
+    def _backoff(self, attempt):
+        return self.backoff_factor * (2 ** attempt)
+
     @property
     def request_params(self):
         return self._request_params.copy()
 
+    def _prepare(self, method, params):
+        """
+        Add token and format to params, and decide whether they travel in
+        the query string or the body. Returns (method, request kwargs).
+        """
+        request_params = self.request_params
+        request_params.update(params)
+        if method == 'post':
+            in_body = self.form_body
+        else:
+            in_body = self.post_reads or (
+                self.max_query_length is not None and
+                len(urlencode(request_params, doseq=True)) > self.max_query_length
+            )
+            if in_body:
+                method = 'post'
+        if in_body:
+            return method, {'data': request_params}
+        return method, {'params': request_params}
+
+    def request(self, method, params, decode=True, use_cache=True):
+        """
+        Call a web service function.
+
+        :param string method: HTTP method to use, 'get' or 'post'
+        :param dict params: 'wsfunction' and its parameters; token and \
+            format are added here
+        :param bool decode: (optional) Defaults to True. Return the decoded \
+            JSON rather than the response object
+        :param bool use_cache: (optional) Defaults to True. If False, always \
+            call Moodle rather than answering from the cache; the result \
+            still replaces the cached one
+
+        All API classes send their requests through here, so a config with
+        a different transport (see AsyncWSConfig) can be dropped in without
+        changing them.
+        """
+        if decode and use_cache and self.cache is not None:
+            hit, data = self.cache.get(params)
+            if hit:
+                return data
+        response = self._send(method, params)
+        return self._finish(params, response, decode)
+
+    def stream(self, method, params, backend='json', use_cache=True):
+        """
+        Call a web service function that returns a list, yielding its items
+        as they are decoded instead of reading the whole response first.
+
+        :param string method: HTTP method to use, 'get' or 'post'
+        :param dict params: 'wsfunction' and its parameters
+        :param string backend: (optional) Defaults to 'json'. 'ijson' to \
+            use ijson; see muddle.jsonstream.ArrayDecoder
+        :param bool use_cache: (optional) Defaults to True. If False, always \
+            call Moodle rather than answering from the cache
+
+        Results are not added to the cache, but are served from it if
+        present. Raises WSError if Moodle returns an error.
+        """
+        if use_cache and self.cache is not None:
+            hit, data = self.cache.get(params)
+            if hit:
+                yield from data
+                return
+        response = self._send(method, params, stream=True)
+        with response:
+            yield from iter_array(response.iter_content(self.stream_chunk_size), backend)
+
+    def _send(self, method, params, stream=False):
+        attempts = self._attempts(params)
+        method, kwargs = self._prepare(method, params)
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                response = self.session.request(method, self.api_url, timeout=self.timeout,
+                                                stream=stream, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                if last:
+                    raise
+            else:
+                if last or response.status_code not in self.retry_statuses:
+                    break
+                response.close()
+            log.info('Retrying %s (attempt %s)', params.get('wsfunction'), attempt + 2)
+            time.sleep(self._backoff(attempt))
+        return response
+
+    def _finish(self, params, response, decode):
+        # Writes invalidate cached reads whether or not they succeeded
+        if self.cache is not None:
+            self.cache.invalidate(params)
+        if not decode:
+            return response
+        data = loads(response.content)
+        if self.cache is not None:
+            self.cache.set(params, data)
+        return data
+
+    def batch(self, **settings):
+        """
+        Return a Batch for sending several calls in one HTTP request.
+
+        Keyword arguments (settingraw, settingfilter, settingfileurl,
+        settinglang) are passed to Moodle for every queued call.
+        """
+        return Batch(self, **settings)
+
+
+class AsyncResponse:
+    """ Fully-read response returned by AsyncWSConfig when decode=False """
+
+    def __init__(self, status_code, headers, content):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode('utf-8')
+
+    def json(self):
+        return loads(self.content)
+
+
+class AsyncWSConfig(WSConfig):
+    """
+    asyncio configuration. API methods called with this config return
+    awaitables instead of results; at most `concurrency` requests are in
+    flight at once. Requires aiohttp.
+
+    Example Usage::
+
+    >>> import asyncio, muddle
+    >>> async def contents(ids):
+    ...     async with muddle.AsyncWSConfig(api_key='dsghsa8casjnajk833', api_url='https://my.moodle.example.com') as m:
+    ...         api = muddle.course.API(m)
+    ...         return await asyncio.gather(*[api.get_course_contents(i) for i in ids])
+    >>> asyncio.run(contents([2, 3, 4]))
+    """
+
+    # An aiohttp session, not a per-thread requests session
+    session = None
+
+    def __init__(self, api_key=None, api_url=None, session=None, verify=None, concurrency=100, **options):
+        if aiohttp is None:
+            raise ImportError('AsyncWSConfig requires aiohttp (pip install muddle[async])')
+        self.api_key = api_key
+        self.api_url = api_url + MOODLE_WS_ENDPOINT
+        if verify is not None:
+            self.verify = verify
+        self.session = session
+        self.concurrency = concurrency
+        self._semaphore = None
+        self._connection_counts = {'requests': 0, 'connections': 0, 'reused': 0}
+        self._set_options(options)
+        self._request_params = {
+            'wstoken': api_key,
+            'moodlewsrestformat': 'json'
+        }
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    def _ssl(self):
+        # Follow requests' meaning of verify: False, True or a CA bundle path
+        if self.verify is None or self.verify is True:
+            return None
+        if self.verify is False:
+            return False
+        import ssl
+        return ssl.create_default_context(cafile=self.verify)
+
+    def _get_session(self):
+        # Created lazily, as aiohttp sessions must be made inside a running loop
+        if self.session is None:
+            connector = aiohttp.TCPConnector(
+                limit=self.concurrency,
+                force_close=not self.keep_alive,
+                ssl=self._ssl()
+            )
+            self.session = aiohttp.ClientSession(connector=connector, timeout=self._timeout(),
+                                                 trace_configs=[self._trace_config()])
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.concurrency)
+        return self.session
+
+    def _timeout(self):
+        if self.timeout is None:
+            return aiohttp.ClientTimeout(total=None)
+        if isinstance(self.timeout, tuple):
+            connect, read = self.timeout
+            return aiohttp.ClientTimeout(total=None, sock_connect=connect, sock_read=read)
+        return aiohttp.ClientTimeout(total=None, sock_connect=self.timeout, sock_read=self.timeout)
+
+    def _trace_config(self):
+        # Count requests and connections for connection_stats()
+        counts = self._connection_counts
+
+        def counter(name):
+            async def count(session, context, params):
+                counts[name] += 1
+            return count
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_request_start.append(counter('requests'))
+        trace_config.on_connection_create_end.append(counter('connections'))
+        trace_config.on_connection_reuseconn.append(counter('reused'))
+        return trace_config
+
+    def connection_stats(self):
+        """
+        As WSConfig.connection_stats, counted with aiohttp request tracing.
+        Requests over a session passed in by the caller aren't counted.
+        """
+        return dict(self._connection_counts)
+
+    @staticmethod
+    def _param_pairs(params):
+        # Encode params as requests does: lists repeat the key, None is dropped
+        pairs = []
+        for key, value in params.items():
+            if value is None:
+                continue
+            if isinstance(value, (list, tuple)):
+                pairs.extend((key, str(item)) for item in value)
+            else:
+                pairs.append((key, str(value)))
+        return pairs
+
+    async def request(self, method, params, decode=True, use_cache=True):
+        """ Coroutine version of WSConfig.request """
+        if decode and use_cache and self.cache is not None:
+            hit, data = self.cache.get(params)
+            if hit:
+                return data
+        attempts = self._attempts(params)
+        method, kwargs = self._prepare(method, params)
+        kwargs = {key: self._param_pairs(value) for key, value in kwargs.items()}
+        session = self._get_session()
+        for attempt in range(attempts):
+            last = attempt == attempts - 1
+            try:
+                async with self._semaphore:
+                    async with session.request(method.upper(), self.api_url, **kwargs) as response:
+                        content = await response.read()
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                if last:
+                    raise
+            else:
+                if last or response.status not in self.retry_statuses:
+                    break
+            log.info('Retrying %s (attempt %s)', params.get('wsfunction'), attempt + 2)
+            await asyncio.sleep(self._backoff(attempt))
+        response = AsyncResponse(response.status, response.headers, content)
+        return self._finish(params, response, decode)
+
+    async def stream(self, method, params, backend='json', use_cache=True):
+        """ Async generator version of WSConfig.stream """
+        if use_cache and self.cache is not None:
+            hit, data = self.cache.get(params)
+            if hit:
+                for item in data:
+                    yield item
+                return
+        method, kwargs = self._prepare(method, params)
+        kwargs = {key: self._param_pairs(value) for key, value in kwargs.items()}
+        session = self._get_session()
+        decoder = ArrayDecoder(backend)
+        async with self._semaphore:
+            async with session.request(method.upper(), self.api_url, **kwargs) as response:
+                async for chunk in response.content.iter_chunked(self.stream_chunk_size):
+                    for item in decoder.feed(chunk):
+                        yield item
+        for item in decoder.close():
+            yield item
+
 
 class AppConfig():
     # argparser: fully set up argparser instance if using cli
@@ -62,7 +599,8 @@ class AppConfig():
         'session': None,
         'verify': None
         }
-    service_defaultables = ('verify', 'session')
+    defaults.update({option: None for option in WSConfig.options})
+    service_defaultables = ('verify', 'session') + WSConfig.options
 
     def __init__(self):
         logging.basicConfig()
@@ -197,9 +735,9 @@ class AppConfig():
         service_config = {}
         for key in self.service_defaultables:
             service_config[key] = self.get_item(key)
-        service_config.update(services.get(service, None))
-        if service_config is None:
+        if services.get(service, None) is None:
             self.error(u"No config available for service '%s'" % service)
+        service_config.update(services[service])
         return service_config
 
     # Return WSConfig for service in use
@@ -211,10 +749,12 @@ class AppConfig():
             moodletoken = service['token']
             session = service['session']
             verify = service['verify']
+            options = {key: service[key] for key in WSConfig.options}
             self._m = WSConfig(
                 api_key=moodletoken,
                 api_url=moodlebase,
                 session=session,
-                verify=verify
+                verify=verify,
+                **options
             )
         return self._m
@@ -0,0 +1,191 @@
+# Concurrent, resumable course duplication
+
+import json
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import requests
+
+from .api import course
+from .config import AsyncWSConfig
+from .exceptions import WSError, check_response
+
+log = logging.getLogger(__name__)
+
+
+class Duplicator:
+    """
+    Runs many course.API.duplicate jobs with a cap on how many run at
+    once, so that backup/restore load on the server stays bounded.
+
+    Each finished job is appended to a JSON-lines journal, so a run that is
+    interrupted can be started again with the same jobs and will skip
+    those already done. A job that timed out may still have completed on
+    the server, as may one that failed with a connection error or a 5xx or
+    undecodable response; such jobs are marked maybe_created, and on the
+    next run their shortnames are looked up before they are tried again.
+    Jobs that Moodle rejected with an error are simply tried again.
+
+    :param config: WSConfig to use
+    :param string journal: (optional) Path of the journal file
+    :param int workers: (optional) Defaults to 4. Duplications run at once; \
+        Moodle does each as a backup and restore, so raise this with care
+    :param timeout: (optional) Defaults to 3600. Seconds to wait for each \
+        duplication
+    :param callable on_progress: (optional) on_progress(result, done, total) \
+        is called as each job finishes
+
+    Jobs are dicts with the arguments to course.API.duplicate: courseid,
+    fullname, shortname and categoryid, and optionally visible and any of
+    its keyword options.
+
+    Each result is a dict with courseid, shortname, status ('done',
+    'failed' or 'timeout'), newid, error, seconds and maybe_created.
+
+    Example Usage::
+
+    >>> import muddle
+    >>> from muddle.duplicator import Duplicator
+    >>> jobs = [{'courseid': c['id'], 'fullname': c['fullname'] + ' 2027',
+    ...          'shortname': c['shortname'] + '-2027', 'categoryid': 42}
+    ...         for c in courses]
+    >>> dup = Duplicator(m, journal='rollover-2027.jsonl', workers=6)
+    >>> results = dup.run(jobs)
+    >>> dup.completed
+    {(10, 'ABC101-2027'): 2310, ...}
+    """
+
+    def __init__(self, config, journal=None, workers=4, timeout=3600, on_progress=None):
+        if isinstance(config, AsyncWSConfig):
+            raise TypeError('Duplicator requires a (synchronous) WSConfig')
+        self.config = config
+        self.journal = journal
+        self.workers = workers
+        self.timeout = timeout
+        self.on_progress = on_progress
+        # (source course id, new shortname) -> new course id
+        self.completed = {}
+        # Journalled jobs not known to be done, which may have finished
+        # on the server
+        self._unfinished = set()
+        self._lock = threading.Lock()
+        if journal is not None and os.path.exists(journal):
+            self._load_journal()
+
+    @staticmethod
+    def _key(job):
+        return (int(job['courseid']), job['shortname'])
+
+    def _load_journal(self):
+        with open(self.journal) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    # A line cut short by an interrupted run
+                    continue
+                key = self._key(entry)
+                if entry['status'] == 'done':
+                    self.completed[key] = entry['newid']
+                    self._unfinished.discard(key)
+                elif entry.get('maybe_created', entry['status'] == 'timeout'):
+                    self._unfinished.add(key)
+                else:
+                    self._unfinished.discard(key)
+
+    def _record(self, result):
+        with self._lock:
+            if result['status'] == 'done':
+                self.completed[self._key(result)] = result['newid']
+            elif result['maybe_created']:
+                self._unfinished.add(self._key(result))
+            else:
+                self._unfinished.discard(self._key(result))
+            if self.journal is not None:
+                with open(self.journal, 'a') as f:
+                    f.write(json.dumps(result) + '\n')
+
+    def run(self, jobs):
+        """
+        Run the jobs not already done, returning their results in the order
+        they finished.
+        """
+        todo = [job for job in jobs if self._key(job) not in self.completed]
+        total = len(todo)
+        api = course.API(self.config.with_options(timeout=self.timeout))
+        results = []
+        executor = ThreadPoolExecutor(self.workers)
+        futures = [executor.submit(self._run_job, api, job) for job in todo]
+        try:
+            for future in as_completed(futures):
+                result = future.result()
+                results.append(result)
+                log.info('Duplicated %s/%s: %s -> %s (%s)', len(results), total,
+                         result['courseid'], result['newid'], result['status'])
+                if self.on_progress is not None:
+                    self.on_progress(result, len(results), total)
+        finally:
+            # On an interrupt, let running jobs finish (they journal
+            # themselves) but don't start any more
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        return results
+
+    def _run_job(self, api, job):
+        key = self._key(job)
+        result = {'courseid': key[0], 'shortname': key[1], 'status': None,
+                  'newid': None, 'error': None, 'seconds': None,
+                  'maybe_created': key in self._unfinished}
+        start = time.time()
+        try:
+            if result['maybe_created']:
+                result['newid'] = self._find(api, job['shortname'])
+            if result['newid'] is None:
+                options = dict(job)
+                for name in ('courseid', 'fullname', 'shortname', 'categoryid'):
+                    del options[name]
+                # Once sent, the duplication may finish on the server
+                # whether or not we hear back
+                result['maybe_created'] = True
+                response = api.duplicate(job['courseid'], job['fullname'], job['shortname'],
+                                         job['categoryid'], **options)
+                if response is None:
+                    result['maybe_created'] = False
+                    raise ValueError('Invalid duplicate options: %s' % ', '.join(options))
+                if response.status_code >= 500:
+                    # e.g. a proxy that gave up waiting
+                    raise requests.HTTPError('%s response from server' % response.status_code,
+                                             response=response)
+                try:
+                    result['newid'] = check_response(response.json())['id']
+                except WSError:
+                    # Rejected by Moodle, so nothing was created
+                    result['maybe_created'] = False
+                    raise
+            result['status'] = 'done'
+            result['maybe_created'] = False
+        except requests.Timeout as e:
+            result['status'] = 'timeout'
+            result['error'] = str(e)
+        except Exception as e:
+            result['status'] = 'failed'
+            result['error'] = str(e)
+        result['seconds'] = round(time.time() - start, 1)
+        # Journalled here rather than by run(), so that jobs still running
+        # when run() is interrupted are recorded when they finish
+        self._record(result)
+        return result
+
+    @staticmethod
+    def _find(api, shortname):
+        # A duplication may have finished after we stopped waiting, or
+        # after a proxy gave up on it
+        courses = check_response(api.get_courses_by_field('shortname', shortname))['courses']
+        return courses[0]['id'] if courses else None
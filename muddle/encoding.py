@@ -0,0 +1,94 @@
+# Encoding of web service arguments into Moodle's nested array syntax
+
+
+# Encoded keys for lists of records, per wsfunction, array and record
+# key, e.g. ('core_group_add_group_members', 'members', 'userid') ->
+# ['members[0][userid]', 'members[1][userid]', ...]. Extended as larger
+# lists are seen (up to _MAX_CACHED_KEYS), so repeated payloads don't
+# rebuild their key strings.
+_schemas = {}
+_MAX_CACHED_KEYS = 100000
+
+_SCALARS = {str, int, float}
+
+
+def _record_keys(wsfunction, prefix, key, count):
+    schema = (wsfunction, prefix, key)
+    names = _schemas.get(schema, ())
+    if len(names) < count:
+        template = '%s[%%d][%s]' % (prefix.replace('%', '%%'), str(key).replace('%', '%%'))
+        extended = list(names)
+        extended.extend(template % i for i in range(len(names), min(count, _MAX_CACHED_KEYS)))
+        # Publish a new list rather than extending the cached one, so that
+        # threads encoding at once never see (or make) a half-built list
+        _schemas[schema] = extended
+        if count > len(extended):
+            return extended + [template % i for i in range(len(extended), count)]
+        return extended
+    return names
+
+
+def _flatten_records(flat, wsfunction, prefix, records):
+    """
+    Fast path for a list of dicts with the same keys and scalar values,
+    done a column at a time. Returns False, having added nothing, if the
+    records don't qualify.
+    """
+    if len(set(map(len, records))) != 1:
+        return False
+    columns = []
+    try:
+        for key in records[0]:
+            column = [record[key] for record in records]
+            if not set(map(type, column)) <= _SCALARS:
+                return False
+            columns.append((key, column))
+    except KeyError:
+        return False
+    for key, column in columns:
+        flat.update(zip(_record_keys(wsfunction, prefix, key, len(column)), column))
+    return True
+
+
+def _flatten(flat, wsfunction, prefix, value):
+    if value is None:
+        return
+    if isinstance(value, bool):
+        flat[prefix] = int(value)
+    elif isinstance(value, dict):
+        for key, item in value.items():
+            _flatten(flat, wsfunction, '%s[%s]' % (prefix, key), item)
+    elif isinstance(value, (list, tuple)):
+        if value and isinstance(value[0], dict) and _flatten_records(flat, wsfunction, prefix, value):
+            return
+        for i, item in enumerate(value):
+            _flatten(flat, wsfunction, '%s[%d]' % (prefix, i), item)
+    else:
+        flat[prefix] = value
+
+
+def encode_params(wsfunction, args=None):
+    """
+    Flatten web service arguments into request parameters.
+
+    Nested dicts and lists become Moodle's key syntax, so
+    {'members': [{'groupid': 3, 'userid': 7}]} is sent as
+    members[0][groupid]=3 and members[0][userid]=7. Bools are sent as 0/1
+    and None values are left out.
+
+    :param string wsfunction: the web service function being called
+    :param dict args: (optional) its arguments
+
+    Returns a dict of parameters including 'wsfunction', ready for
+    WSConfig.request.
+
+    Example Usage::
+
+    >>> encode_params('core_group_get_group_members', {'groupids': [3, 4]})
+    {'wsfunction': 'core_group_get_group_members', 'groupids[0]': 3, 'groupids[1]': 4}
+    """
+    flat = {'wsfunction': wsfunction}
+    if args:
+        for name, value in args.items():
+            _flatten(flat, wsfunction, name, value)
+    return flat
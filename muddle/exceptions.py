@@ -0,0 +1,28 @@
+# muddle exceptions
+
+
+class MuddleError(Exception):
+    """ Base class for muddle errors """
+
+
+class WSError(MuddleError):
+    """
+    Moodle returned an exception instead of a result.
+
+    The decoded error response is kept as `response`; its 'exception',
+    'errorcode' and 'message' entries are also available as attributes.
+    """
+
+    def __init__(self, response):
+        self.response = response
+        self.exception = response.get('exception')
+        self.errorcode = response.get('errorcode')
+        self.message = response.get('message')
+        super().__init__('%s: %s' % (self.errorcode, self.message))
+
+
+def check_response(data):
+    """ Return decoded response data, raising WSError if it is an error """
+    if isinstance(data, dict) and 'exception' in data:
+        raise WSError(data)
+    return data
@@ -0,0 +1,169 @@
+# Incremental, windowed harvesting of stats activity
+
+import logging
+import time
+
+from .activity import ActivityStore
+from .api import stats
+from .config import AsyncWSConfig
+from .exceptions import check_response
+
+log = logging.getLogger(__name__)
+
+DAY = 86400
+
+# Default span of each request, by granularity
+WINDOWS = {
+    'daily': 31 * DAY,
+    'weekly': 26 * 7 * DAY,
+    'monthly': 366 * DAY,
+}
+
+
+class ActivityHarvester:
+    """
+    Keeps ActivityStores of stats activity up to date, fetching only what
+    is new since the last harvest.
+
+    For each course and granularity a watermark, the latest timeend held,
+    is kept. refresh() asks for activity from the watermark to now, split
+    into windows of bounded length so that no single request is huge, and
+    merges the rows into the store for that granularity. Rows at or before
+    the watermark, and rows whose uniqueid has already been seen in this
+    refresh, are dropped. Watermarks start from the rows already in the
+    stores, so saving the stores (ActivityStore.save) between runs is
+    enough to carry on where the last run stopped.
+
+    :param config: WSConfig to use
+    :param dict stores: (optional) granularity -> ActivityStore to add to
+    :param int window: (optional) Seconds of activity per request. \
+        Defaults to 31 days for daily stats, 26 weeks for weekly and a year \
+        for monthly.
+    :param int workers: (optional) Defaults to WSConfig.workers. Requests \
+        made at once
+    :param int horizon: (optional) Defaults to 366 days. How far back to \
+        start, in seconds, for courses with no watermark when refresh() is \
+        not given since
+
+    Example Usage::
+
+    >>> import muddle
+    >>> from muddle.activity import ActivityStore
+    >>> from muddle.harvester import ActivityHarvester
+    >>> store = ActivityStore.load('daily.stats')
+    >>> harvester = ActivityHarvester(m, {'daily': store})
+    >>> harvester.refresh(shortnames, 'daily', since=1767225600)
+    {'requests': 4000, 'rows': 8000, 'duplicates': 0, 'failed': []}
+    >>> store.save('daily.stats')
+    """
+
+    def __init__(self, config, stores=None, window=None, workers=None, horizon=366 * DAY):
+        if isinstance(config, AsyncWSConfig):
+            raise TypeError('ActivityHarvester requires a (synchronous) WSConfig')
+        self.api = stats.API(config)
+        self.stores = dict(stores or {})
+        self.window = window
+        self.workers = workers
+        self.horizon = horizon
+        # (course shortname, granularity) -> latest timeend held
+        self.watermarks = {}
+        for granularity, store in self.stores.items():
+            self._load_watermarks(granularity, store)
+
+    def _load_watermarks(self, granularity, store):
+        for courseid, timeend in store.last_timeends().items():
+            shortname = store.courses.get(courseid)
+            if shortname is not None:
+                self.watermarks[(shortname, granularity)] = timeend
+
+    def store(self, granularity):
+        """ Return the store for granularity, creating it if needed """
+        if granularity not in self.stores:
+            self.stores[granularity] = ActivityStore(granularity)
+        return self.stores[granularity]
+
+    def windows(self, start, end, granularity):
+        """ Split start to end into (time_start, time_end) windows """
+        size = self.window or WINDOWS[granularity]
+        windows = []
+        while start < end:
+            windows.append((start, min(start + size, end)))
+            start += size
+        return windows
+
+    def refresh(self, course_shortnames, granularity='daily', since=None, until=None,
+                on_error=None):
+        """
+        Fetch and merge new activity for courses.
+
+        :param iterable course_shortnames: courses to refresh
+        :param string granularity: (optional) Defaults to 'daily'. Or \
+            'weekly' or 'monthly'
+        :param int since: (optional) UNIX time to start from for courses \
+            with no watermark yet. Defaults to `horizon` before until.
+        :param int until: (optional) Defaults to now. UNIX time to fetch to
+        :param callable on_error: (optional) on_error(course_shortname, \
+            exception) is called for a course that can't be read. By \
+            default the exception is raised.
+
+        A course's remaining windows are skipped after a failed one, so its
+        watermark never passes a gap; the next refresh tries again from
+        there.
+
+        Returns a dict with the number of requests made, rows added and
+        duplicate rows dropped, and the shortnames of courses that failed.
+        """
+        if granularity not in stats.GRANULARITIES:
+            raise ValueError("granularity must be one of %s" % ', '.join(stats.GRANULARITIES))
+        if until is None:
+            until = int(time.time())
+        if since is None:
+            since = until - self.horizon
+        store = self.store(granularity)
+        requests = []
+        for shortname in course_shortnames:
+            start = self.watermarks.get((shortname, granularity), since)
+            for window in self.windows(start, until, granularity):
+                requests.append((shortname,) + window)
+
+        def fetch(request):
+            shortname, time_start, time_end = request
+            try:
+                rows = self.api.activity_by_shortname(granularity, shortname,
+                                                      time_start, time_end)
+                return request, check_response(rows), None
+            except Exception as e:
+                return request, None, e
+
+        summary = {'requests': len(requests), 'rows': 0, 'duplicates': 0, 'failed': []}
+        course, seen, failed = None, set(), False
+        # Windows come back in order, each course's oldest first
+        results = self.api.config.imap(fetch, requests, self.workers)
+        for (shortname, time_start, time_end), rows, error in results:
+            if shortname != course:
+                course, seen, failed = shortname, set(), False
+            if failed:
+                continue
+            if error is not None:
+                failed = True
+                summary['failed'].append(shortname)
+                log.warning('Stats for %s from %s failed: %s', shortname, time_start, error)
+                if on_error is None:
+                    raise error
+                on_error(shortname, error)
+                continue
+            key = (shortname, granularity)
+            watermark = self.watermarks.get(key, 0)
+            latest = watermark
+            for row in rows:
+                timeend = int(row['timeend'])
+                if timeend <= watermark or row['uniqueid'] in seen:
+                    summary['duplicates'] += 1
+                    continue
+                seen.add(row['uniqueid'])
+                store.append(row)
+                summary['rows'] += 1
+                latest = max(latest, timeend)
+            if latest > watermark:
+                self.watermarks[key] = latest
+        return summary
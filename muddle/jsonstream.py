@@ -0,0 +1,159 @@
+# JSON decoding, whole or streamed, with optional faster backends
+
+import codecs
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+from .exceptions import MuddleError, check_response
+
+_WHITESPACE = ' \t\r\n'
+_NUMBER_START = '-0123456789'
+
+
+def loads(data):
+    """ Decode a whole JSON document, using orjson if it is installed """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
+class ArrayDecoder:
+    """
+    Incremental decoder for a response holding a JSON array.
+
+    feed() takes chunks of bytes as they arrive and returns the array items
+    completed so far, so only one item needs to be held in memory at a
+    time. If the response turns out to be a Moodle error object, close()
+    raises WSError.
+
+    :param string backend: (optional) Defaults to 'json', the standard \
+        library's C scanner, which is the quicker of the two for typical \
+        Moodle records. 'ijson' (if installed) also streams within each \
+        item, for arrays whose individual items are huge.
+    """
+
+    def __init__(self, backend='json'):
+        if backend == 'ijson' and ijson is None:
+            raise ImportError("The 'ijson' backend requires ijson (pip install ijson)")
+        self.backend = backend
+        self._text = codecs.getincrementaldecoder('utf-8')()
+        self._head = b''
+        self._buffer = ''
+        self._pos = 0
+        self._mode = None
+        self._done = False
+        # Don't retry decoding a partial item until the buffer is this big
+        self._retry_at = 0
+
+    def feed(self, chunk):
+        """ Add a chunk of bytes; returns a list of newly completed items """
+        if self._mode is None:
+            # Look at the first significant byte to see what we've got
+            self._head += chunk
+            stripped = self._head.lstrip(_WHITESPACE.encode('ascii'))
+            if not stripped:
+                return []
+            chunk, self._head = self._head, b''
+            if stripped[:1] == b'[' and self.backend == 'ijson':
+                self._mode = 'ijson'
+                self._items = ijson.sendable_list()
+                self._coro = ijson.items_coro(self._items, 'item', use_float=True)
+            elif stripped[:1] == b'[':
+                self._mode = 'json'
+                self._pos = len(chunk) - len(stripped) + 1
+            else:
+                # Probably an error object; collect it for close()
+                self._mode = 'document'
+        if self._mode == 'ijson':
+            self._coro.send(chunk)
+            items = list(self._items)
+            del self._items[:]
+            return items
+        self._buffer += self._text.decode(chunk)
+        if self._mode == 'json':
+            return self._decode_items()
+        return []
+
+    def close(self):
+        """ Finish decoding; returns any remaining items """
+        if self._mode is None:
+            self._mode = 'document'
+        if self._mode == 'ijson':
+            try:
+                self._coro.close()
+            except ijson.JSONError as e:
+                raise MuddleError('Incomplete JSON array in response') from e
+            items = list(self._items)
+            del self._items[:]
+            return items
+        self._buffer += self._text.decode(b'', final=True)
+        if self._mode == 'json':
+            self._retry_at = 0
+            items = self._decode_items()
+            if not self._done:
+                raise MuddleError('Incomplete JSON array in response')
+            return items
+        data = loads(self._buffer) if self._buffer.strip() else None
+        check_response(data)
+        raise MuddleError('Expected a JSON array, got %s' % type(data).__name__)
+
+    def _decode_items(self):
+        items = []
+        if len(self._buffer) < self._retry_at:
+            return items
+        self._retry_at = 0
+        decoder = json.JSONDecoder()
+        buffer = self._buffer
+        pos = self._pos
+        while not self._done:
+            while pos < len(buffer) and buffer[pos] in _WHITESPACE + ',':
+                pos += 1
+            if pos >= len(buffer):
+                break
+            if buffer[pos] == ']':
+                self._done = True
+                break
+            try:
+                item, end = decoder.raw_decode(buffer, pos)
+            except ValueError:
+                end = None
+            # A number may have been cut short, at the end of the buffer or
+            # before a '.', 'e' etc. still to come, so needs a delimiter
+            # after it
+            if end is None or end >= len(buffer) or (
+                    buffer[pos] in _NUMBER_START and buffer[end] not in _WHITESPACE + ',]'):
+                # Wait for the partial item to double before trying again,
+                # so one split over many chunks isn't decoded repeatedly
+                # from its start.
+                self._retry_at = 2 * (len(buffer) - pos)
+                break
+            items.append(item)
+            pos = end
+        # Keep only what is still to be decoded
+        self._buffer = buffer[pos:]
+        self._pos = 0
+        return items
+
+
+def iter_array(chunks, backend='json'):
+    """
+    Yield the items of a JSON array from an iterable of byte chunks.
+
+    Example Usage::
+
+    >>> list(iter_array([b'[{"id": 1}, {"i', b'd": 2}]']))
+    [{'id': 1}, {'id': 2}]
+    """
+    decoder = ArrayDecoder(backend)
+    for chunk in chunks:
+        yield from decoder.feed(chunk)
+    yield from decoder.close()
@@ -0,0 +1,172 @@
+# Compact group membership sets for cohort computations
+
+
+def _popcount(bits):
+    try:
+        return bits.bit_count()
+    except AttributeError:
+        # Python < 3.10
+        return bin(bits).count('1')
+
+
+class MemberSet:
+    """
+    A set of users, stored as a bitset over a Membership's dense user
+    indexes. Supports |, &, - and ^ with other sets from the same
+    Membership, len(), `in` (by user id) and iteration over user ids.
+    """
+
+    __slots__ = ('membership', 'bits')
+
+    def __init__(self, membership, bits=0):
+        self.membership = membership
+        self.bits = bits
+
+    def _other(self, other):
+        if not isinstance(other, MemberSet) or other.membership is not self.membership:
+            raise TypeError('Can only combine MemberSets from the same Membership')
+        return other.bits
+
+    def __or__(self, other):
+        return MemberSet(self.membership, self.bits | self._other(other))
+
+    def __and__(self, other):
+        return MemberSet(self.membership, self.bits & self._other(other))
+
+    def __sub__(self, other):
+        return MemberSet(self.membership, self.bits & ~self._other(other))
+
+    def __xor__(self, other):
+        return MemberSet(self.membership, self.bits ^ self._other(other))
+
+    def __eq__(self, other):
+        return isinstance(other, MemberSet) and other.membership is self.membership \
+            and other.bits == self.bits
+
+    def __hash__(self):
+        return hash(self.bits)
+
+    def __len__(self):
+        return _popcount(self.bits)
+
+    def __bool__(self):
+        return self.bits != 0
+
+    def __contains__(self, userid):
+        index = self.membership.index.get(userid)
+        return index is not None and bool(self.bits >> index & 1)
+
+    def __iter__(self):
+        userids = self.membership.userids
+        # Reading the binary string is linear, unlike peeling off bits
+        for index, bit in enumerate(reversed(bin(self.bits)[2:])):
+            if bit == '1':
+                yield userids[index]
+
+    def __repr__(self):
+        return '<MemberSet of %d users>' % len(self)
+
+    def userids(self):
+        """ The user ids as a Python set """
+        return set(self)
+
+    def to_members(self, groupid):
+        """
+        The users as a members list for group.API.add_group_members or
+        delete_group_members on the given group.
+        """
+        return [{'groupid': groupid, 'userid': userid} for userid in self]
+
+
+class Membership:
+    """
+    Group and grouping memberships, with user ids mapped to dense integer
+    indexes and each group held as a bitset. Union, intersection,
+    difference and counting across thousands of groups then work on a few
+    kilobytes per group rather than on sets or lists of user ids.
+
+    Example Usage::
+
+    >>> import muddle
+    >>> from muddle.membership import Membership
+    >>> snapshot = muddle.group.API(m).snapshot(course_ids)
+    >>> ms = Membership.from_snapshot(snapshot)
+    >>> cohort = ms.group(lab_a) - ms.grouping(tutorials_b)
+    >>> len(cohort)
+    >>> muddle.group.API(m).add_group_members(cohort.to_members(target_group))
+    """
+
+    def __init__(self):
+        # index -> user id, and user id -> index
+        self.userids = []
+        self.index = {}
+        self.groups = {}
+        self.groupings = {}
+
+    def _bits(self, userids):
+        index = self.index
+        positions = []
+        for userid in userids:
+            position = index.get(userid)
+            if position is None:
+                position = index[userid] = len(self.userids)
+                self.userids.append(userid)
+            positions.append(position)
+        if not positions:
+            return 0
+        bitmap = bytearray(max(positions) // 8 + 1)
+        for position in positions:
+            bitmap[position >> 3] |= 1 << (position & 7)
+        return int.from_bytes(bitmap, 'little')
+
+    def users(self, userids):
+        """ MemberSet of arbitrary user ids, e.g. from a roster """
+        return MemberSet(self, self._bits(userids))
+
+    def add_group(self, groupid, userids):
+        self.groups[groupid] = self._bits(userids)
+
+    def add_grouping(self, groupingid, groupids):
+        """ Add a grouping as the union of its groups, which must be added first """
+        bits = 0
+        for groupid in groupids:
+            bits |= self.groups.get(groupid, 0)
+        self.groupings[groupingid] = bits
+
+    def group(self, groupid):
+        return MemberSet(self, self.groups.get(groupid, 0))
+
+    def grouping(self, groupingid):
+        return MemberSet(self, self.groupings.get(groupingid, 0))
+
+    def union(self, sets):
+        bits = 0
+        for member_set in sets:
+            bits |= member_set.bits
+        return MemberSet(self, bits)
+
+    def intersection(self, sets):
+        bits = None
+        for member_set in sets:
+            bits = member_set.bits if bits is None else bits & member_set.bits
+        return MemberSet(self, bits or 0)
+
+    def counts(self):
+        """ Dict of group id -> number of members """
+        return {groupid: _popcount(bits) for groupid, bits in self.groups.items()}
+
+    @classmethod
+    def from_members_map(cls, members):
+        """ From group.API.get_members_map: group id -> user ids """
+        membership = cls()
+        for groupid, userids in members.items():
+            membership.add_group(groupid, userids)
+        return membership
+
+    @classmethod
+    def from_snapshot(cls, snapshot):
+        """ From a group.GroupSnapshot, including its groupings """
+        membership = cls.from_members_map(snapshot.group_members)
+        for groupingid, groupids in snapshot.grouping_groups.items():
+            membership.add_grouping(groupingid, groupids)
+        return membership
@@ -9,6 +9,7 @@ from .api import localpresentation
 from .api import stats
 
 from .config import WSConfig as WSConfig
+from .config import AsyncWSConfig as AsyncWSConfig
 from .config import AppConfig as AppConfig
 
 log = logging.getLogger(__name__)
@@ -0,0 +1,285 @@
+# Streaming roster import: read -> clean -> resolve user ids -> add to groups
+
+import csv
+import queue
+import threading
+
+from .api import group, users
+from .exceptions import WSError, check_response
+from .utils import bisect_failures, clean_username
+
+
+class Row:
+    """
+    One input row on its way through the pipeline.
+
+    :keyword int line: line number in the input
+    :keyword dict data: the row's columns
+    :keyword value: the user value being resolved (after cleaning)
+    :keyword int userid: resolved Moodle user id
+    :keyword int groupid: group the user is to be added to
+    :keyword string error: why the row failed, if it did
+    :keyword list warnings: problems that didn't stop the row
+    """
+
+    __slots__ = ('line', 'data', 'value', 'userid', 'groupid', 'error', 'warnings')
+
+    def __init__(self, line, data):
+        self.line = line
+        self.data = data
+        self.value = None
+        self.userid = None
+        self.groupid = None
+        self.error = None
+        self.warnings = []
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __repr__(self):
+        return '<Row %s %s>' % (self.line, self.error or 'ok')
+
+
+def read_csv(source, **csv_options):
+    """
+    Yield Rows from a CSV file (a path or an open file) with a header line.
+    csv_options are passed to csv.DictReader.
+    """
+    if isinstance(source, str):
+        with open(source, newline='') as f:
+            yield from read_csv(f, **csv_options)
+        return
+    reader = csv.DictReader(source, **csv_options)
+    for data in reader:
+        yield Row(reader.line_num, data)
+
+
+def _numbered(rows):
+    for line, row in enumerate(rows, 2):
+        if row.line is None:
+            row.line = line
+        yield row
+
+
+def clean_values(rows, column, field='username', strict=False):
+    """
+    Take each row's user value from column, cleaning usernames as Moodle
+    would. A value changed by cleaning gets a warning, or an error if
+    strict, since it may not be the user that was meant.
+    """
+    for row in rows:
+        value = (row.data.get(column) or '').strip()
+        if not value:
+            row.error = "No value in column '%s'" % column
+        elif field == 'username':
+            cleaned = clean_username(value)
+            if cleaned != value:
+                message = "Username '%s' cleaned to '%s'" % (value, cleaned)
+                if strict:
+                    row.error = message
+                else:
+                    row.warnings.append(message)
+            value = cleaned
+        row.value = value
+        yield row
+
+
+def resolve_users(rows, resolver, field='username', batch_size=500):
+    """
+    Fill in row.userid using a users.UserResolver, which is asked about
+    batch_size rows at a time and only looks up values it hasn't seen.
+    """
+    for batch in _batches(rows, batch_size):
+        wanted = [row for row in batch if row.ok]
+        try:
+            userids = resolver.resolve(field, [row.value for row in wanted])
+        except WSError as e:
+            for row in wanted:
+                row.error = 'User lookup failed: %s' % e
+        else:
+            for row, userid in zip(wanted, userids):
+                row.userid = userid
+                if userid is None:
+                    row.error = "No user with %s '%s'" % (field, row.value)
+        yield from batch
+
+
+def add_to_groups(rows, group_api, column, group_map=None, batch_size=1000):
+    """
+    Add each row's user to the group named in column (a group id, or a
+    key of group_map, e.g. from group.API.ensure_groups), in
+    add_group_members calls of batch_size members. A failed call is
+    retried in halves so that errors land on the right rows.
+    """
+    for batch in _batches(rows, batch_size):
+        pending = []
+        for row in batch:
+            if not row.ok:
+                continue
+            key = (row.data.get(column) or '').strip()
+            try:
+                row.groupid = group_map[key] if group_map is not None else int(key)
+            except (KeyError, ValueError):
+                row.error = "Unknown group '%s'" % key
+                continue
+            pending.append(row)
+        if pending:
+            _add(group_api, pending)
+        yield from batch
+
+
+def _add(group_api, rows):
+    # Moodle rejects the whole call if any member fails, so split a failed
+    # call in halves until the failing rows are found; a few bad rows in a
+    # large batch then cost a few extra calls rather than one per row.
+    def add(rows):
+        members = [{'groupid': row.groupid, 'userid': row.userid} for row in rows]
+        check_response(group_api.add_group_members(members).json())
+
+    for row, e in bisect_failures(add, rows)[1]:
+        row.error = 'Adding to group %s failed: %s' % (row.groupid, e)
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def buffered(iterable, maxsize):
+    """
+    Run iterable in a background thread, holding at most maxsize items
+    ahead of the consumer, so that stages can overlap without the buffer
+    between them growing.
+    """
+    items = queue.Queue(maxsize)
+    done = object()
+    stop = threading.Event()
+
+    def put(entry):
+        # Give up once the consumer has gone, rather than block on a full
+        # queue forever
+        while not stop.is_set():
+            try:
+                items.put(entry, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def produce():
+        try:
+            for item in iterable:
+                if not put((item, None)):
+                    return
+        except Exception as e:
+            put((done, e))
+            return
+        put((done, None))
+
+    thread = threading.Thread(target=produce, daemon=True)
+    thread.start()
+    try:
+        while True:
+            item, error = items.get()
+            if item is done:
+                if error is not None:
+                    raise error
+                return
+            yield item
+    finally:
+        stop.set()
+
+
+class RosterImport:
+    """
+    Constant-memory import of a roster of (user, group) rows into groups.
+
+    Rows stream through read -> clean -> resolve user ids -> add to groups,
+    with at most buffer_size rows waiting between the lookup and add
+    stages, so memory use doesn't depend on the size of the file (only
+    the resolver's map of distinct users grows).
+
+    :param config: WSConfig to use
+    :param string user_column: (optional) Defaults to 'username'. Column \
+        holding the user value
+    :param string group_column: (optional) Defaults to 'group'. Column \
+        holding the group id, or a key of group_map
+    :param string field: (optional) Defaults to 'username'. User field the \
+        values are matched against: 'username', 'idnumber' or 'email'
+    :param dict group_map: (optional) Map of group_column values to group ids
+    :param bool strict: (optional) Defaults to False. Reject usernames that \
+        cleaning would change, rather than warning
+    :param int lookup_batch_size: (optional) Defaults to 500. Values per user \
+        lookup
+    :param int add_batch_size: (optional) Defaults to 1000. Members per \
+        add_group_members call
+    :param int buffer_size: (optional) Defaults to 2000. Rows held between \
+        stages
+    :param resolver: (optional) users.UserResolver to use, e.g. one shared \
+        with other imports or preloaded with every user
+
+    Example Usage::
+
+    >>> import muddle
+    >>> from muddle.pipeline import RosterImport
+    >>> roster = RosterImport(m, user_column='username', group_column='group')
+    >>> report = roster.run('enrolments.csv', on_error=print)
+    """
+
+    def __init__(self, config, user_column='username', group_column='group', field='username',
+                 group_map=None, strict=False, lookup_batch_size=500, add_batch_size=1000,
+                 buffer_size=2000, resolver=None):
+        self.config = config
+        self.resolver = resolver or users.API(config).resolver()
+        self.user_column = user_column
+        self.group_column = group_column
+        self.field = field
+        self.group_map = group_map
+        self.strict = strict
+        self.lookup_batch_size = lookup_batch_size
+        self.add_batch_size = add_batch_size
+        self.buffer_size = buffer_size
+
+    def rows(self, source):
+        """
+        Process source (a CSV path or file, or an iterable of Rows),
+        yielding each Row once it has been added or has failed.
+        """
+        if isinstance(source, str) or hasattr(source, 'read'):
+            rows = read_csv(source)
+        else:
+            rows = _numbered(source)
+        rows = clean_values(rows, self.user_column, self.field, self.strict)
+        rows = resolve_users(rows, self.resolver, self.field, self.lookup_batch_size)
+        rows = buffered(rows, self.buffer_size)
+        return add_to_groups(rows, group.API(self.config), self.group_column,
+                             self.group_map, self.add_batch_size)
+
+    def run(self, source, on_error=None, on_warning=None):
+        """
+        Process source, calling on_error(row) for each failed row and
+        on_warning(row) for each row with warnings.
+
+        Returns a dict with counts of 'rows', 'added', 'failed' and 'warnings'.
+        """
+        report = {'rows': 0, 'added': 0, 'failed': 0, 'warnings': 0}
+        for row in self.rows(source):
+            report['rows'] += 1
+            if row.warnings:
+                report['warnings'] += 1
+                if on_warning is not None:
+                    on_warning(row)
+            if row.ok:
+                report['added'] += 1
+            else:
+                report['failed'] += 1
+                if on_error is not None:
+                    on_error(row)
+        return report
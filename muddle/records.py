@@ -0,0 +1,141 @@
+# Compact record types for web service results
+
+import inspect
+from concurrent.futures import Future
+
+from .batch import then
+from .exceptions import check_response
+
+
+class Record:
+    """
+    Base for records held in __slots__ rather than a dict, which take a
+    fraction of the memory when many are kept. Fields missing from the
+    data are None. Records can also be read like the dicts they replace:
+    record['id'], record.get('idnumber'), dict(record.items()).
+    """
+
+    __slots__ = ()
+    FIELDS = ()
+
+    @classmethod
+    def from_dict(cls, data):
+        record = cls.__new__(cls)
+        for field in cls.FIELDS:
+            setattr(record, field, data.get(field))
+        return record
+
+    def __getitem__(self, field):
+        if field not in self.FIELDS:
+            raise KeyError(field)
+        return getattr(self, field)
+
+    def get(self, field, default=None):
+        if field not in self.FIELDS:
+            return default
+        return getattr(self, field)
+
+    def __contains__(self, field):
+        return field in self.FIELDS
+
+    def keys(self):
+        return self.FIELDS
+
+    def items(self):
+        return [(field, getattr(self, field)) for field in self.FIELDS]
+
+    def as_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        return type(other) is type(self) and other.items() == self.items()
+
+    def __hash__(self):
+        return hash(tuple(getattr(self, field) for field in self.FIELDS))
+
+    def __repr__(self):
+        return '%s(%s)' % (type(self).__name__, ', '.join(
+            '%s=%r' % (field, getattr(self, field)) for field in self.FIELDS))
+
+
+class User(Record):
+    """ A user, as per users.API.get_users_by_field, without list fields """
+
+    FIELDS = ('id', 'username', 'firstname', 'lastname', 'fullname', 'email',
+              'idnumber', 'department', 'institution', 'auth', 'suspended',
+              'confirmed', 'firstaccess', 'lastaccess')
+    __slots__ = FIELDS
+
+
+class Course(Record):
+    """ A course, as per course.API.get_courses, without format options """
+
+    FIELDS = ('id', 'shortname', 'fullname', 'displayname', 'idnumber',
+              'categoryid', 'format', 'startdate', 'enddate', 'visible',
+              'timecreated', 'timemodified')
+    __slots__ = FIELDS
+
+
+class Group(Record):
+    """ A group, as per group.API.get_groups """
+
+    FIELDS = ('id', 'courseid', 'name', 'idnumber', 'description',
+              'descriptionformat', 'enrolmentkey')
+    __slots__ = FIELDS
+
+
+class Category(Record):
+    """ A course category, as per core_course_get_categories """
+
+    FIELDS = ('id', 'name', 'idnumber', 'parent', 'sortorder', 'coursecount',
+              'visible', 'depth', 'path', 'timemodified')
+    __slots__ = FIELDS
+
+
+# Record types made by record_type, by their fields
+_types = {}
+
+
+def record_type(fields):
+    """
+    Return a Record class with just the given fields, e.g.
+    record_type(('id', 'username')). Classes are cached, so all
+    projections onto the same fields share one type.
+    """
+    if isinstance(fields, type) and issubclass(fields, Record):
+        return fields
+    fields = tuple(fields)
+    cls = _types.get(fields)
+    if cls is None:
+        for field in fields:
+            if not field.isidentifier():
+                raise ValueError('Invalid field name %r' % field)
+        cls = _types[fields] = type('Record', (Record,), {'__slots__': fields, 'FIELDS': fields})
+    return cls
+
+
+def project(data, fields):
+    """
+    Convert a list of result dicts into records of the given fields (a
+    list of names or a Record class). Raises WSError if data is a Moodle
+    error. If data is awaitable, as from AsyncWSConfig, returns a
+    coroutine giving the records; if it is a Future, as from a Batch, a
+    Future giving them.
+
+    Example Usage::
+
+    >>> from muddle.records import project, Course
+    >>> courses = project(muddle.course.API(m).get_courses([2, 3]), Course)
+    >>> users = project(users, ('id', 'username'))
+    >>> users[0].username
+    """
+    if inspect.isawaitable(data):
+        return _aproject(data, fields)
+    if isinstance(data, Future):
+        return then(data, lambda result: project(result, fields))
+    from_dict = record_type(fields).from_dict
+    return [from_dict(item) for item in check_response(data)]
+
+
+async def _aproject(data, fields):
+    return project(await data, fields)
@@ -28,4 +28,68 @@ def clean_username(value):
     # Because then all we have to do is:
     from re import sub
     return sub(r'[^-\.@_a-z0-9]', '', value.lower())
-    
+
+
+def chunks(values, size):
+    """ Split a sequence into lists of at most size items """
+    values = list(values)
+    return [values[i:i + size] for i in range(0, len(values), size)]
+
+
+def unflatten_params(params):
+    """
+    Turn Moodle's flattened parameter keys back into nested structures.
+
+    {'members[0][groupid]': 3, 'field': 'id'} becomes
+    {'members': [{'groupid': 3}], 'field': 'id'}; containers whose keys are
+    all numeric become lists.
+    """
+    from re import findall
+
+    nested = {}
+    for key, value in params.items():
+        path = findall(r'[^\[\]]+', key)
+        node = nested
+        for part in path[:-1]:
+            node = node.setdefault(part, {})
+        node[path[-1]] = value
+
+    def listify(node):
+        if not isinstance(node, dict):
+            return node
+        node = {key: listify(value) for key, value in node.items()}
+        if node and all(key.isdigit() for key in node):
+            return [node[key] for key in sorted(node, key=int)]
+        return node
+
+    return listify(nested)
+
+
+def is_read_function(wsfunction):
+    """
+    Guess whether a web service function only reads data, and so is safe
+    to retry or cache. Moodle names these *_get_*.
+    """
+    return '_get_' in wsfunction
+
+
+def bisect_failures(call, items):
+    """
+    Call call(items), splitting a call that raises WSError in halves until
+    the items that cause it are found. For web service functions that make
+    all of a call's changes or none of them.
+
+    Returns the results of the calls that worked, and (item, WSError) for
+    each item that failed.
+    """
+    from .exceptions import WSError
+
+    try:
+        return [call(items)], []
+    except WSError as e:
+        if len(items) == 1:
+            return [], [(items[0], e)]
+    half = len(items) // 2
+    first, first_errors = bisect_failures(call, items[:half])
+    second, second_errors = bisect_failures(call, items[half:])
+    return first + second, first_errors + second_errors
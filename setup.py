@@ -31,6 +31,11 @@ setup(
     package_data={'': ['LICENSE']},
     include_package_data=True,
     install_requires=required,
+    extras_require={
+        'async': ['aiohttp>=3.0'],
+        'json': ['orjson', 'ijson>=3.1'],
+        'stats': ['numpy'],
+    },
     license='MIT',
     classifiers=(
         'Development Status :: 4 - Beta',
@@ -0,0 +1,153 @@
+# A local stand-in for a Moodle web service endpoint, for offline tests
+
+import json
+import threading
+import time
+import unittest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlparse
+
+import muddle
+from muddle.utils import unflatten_params
+
+# Parameters that aren't arguments of the function called
+_REQUEST_PARAMS = ('wstoken', 'moodlewsrestformat', 'wsfunction')
+
+
+def ws_error(errorcode, message='Error', exception='moodle_exception'):
+    """ A Moodle error response """
+    return {'exception': exception, 'errorcode': errorcode, 'message': message}
+
+
+class StandIn:
+    """
+    Threaded HTTP server answering web service calls with handlers
+    registered per wsfunction.
+
+    A handler is called as handler(args) with the call's arguments
+    unflattened (see muddle.utils.unflatten_params) and returns the data
+    to send back as JSON. Calls to functions with no handler get a Moodle
+    error. Every call is recorded in `calls` as (HTTP method, wsfunction,
+    args).
+
+    Batched calls (tool_mobile_call_external_functions) are answered by
+    the handlers of the functions in the batch, given their decoded JSON
+    arguments.
+
+    fail(status, times) makes the next calls return an HTTP error status;
+    with handled=True they are still handled first, as when a proxy gives
+    up on a call that the server goes on to finish. delay adds a pause to
+    every response.
+    """
+
+    def __init__(self):
+        self.handlers = {'tool_mobile_call_external_functions': self._batch}
+        self.calls = []
+        self.delay = 0
+        self._failures = []
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), self._handler_class())
+        self._server.daemon_threads = True
+        # Clients that time out leave broken pipes; don't print them
+        self._server.handle_error = lambda request, client_address: None
+        self._thread = threading.Thread(target=self._server.serve_forever, args=(0.05,),
+                                        daemon=True)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d' % self._server.server_port
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+    def on(self, wsfunction, handler):
+        self.handlers[wsfunction] = handler
+
+    def fail(self, status, times=1, handled=False):
+        with self._lock:
+            self._failures.extend([(status, handled)] * times)
+
+    def calls_to(self, wsfunction):
+        """ Args of the calls made to wsfunction """
+        return [args for method, name, args in self.calls if name == wsfunction]
+
+    def _batch(self, args):
+        responses = []
+        for request in args['requests']:
+            handler = self.handlers.get(request['function'])
+            if handler is None:
+                data = ws_error('invalidfunction', 'No handler for %s' % request['function'])
+            else:
+                data = handler(json.loads(request['arguments']))
+            if isinstance(data, dict) and 'exception' in data:
+                # Moodle stops at the first failing call
+                responses.append({'error': True, 'exception': json.dumps(data)})
+                break
+            responses.append({'error': False, 'data': json.dumps(data)})
+        return {'responses': responses}
+
+    def _respond(self, method, pairs):
+        params = dict(pairs)
+        wsfunction = params.get('wsfunction')
+        args = unflatten_params({key: value for key, value in params.items()
+                                 if key not in _REQUEST_PARAMS})
+        with self._lock:
+            self.calls.append((method, wsfunction, args))
+            status, handled = self._failures.pop(0) if self._failures else (200, True)
+        if self.delay:
+            time.sleep(self.delay)
+        if not handled:
+            return status, {}
+        handler = self.handlers.get(wsfunction)
+        if handler is None:
+            return status, ws_error('invalidfunction', 'No handler for %s' % wsfunction)
+        try:
+            data = handler(args)
+        except Exception as e:
+            # A broken handler; show it to the test rather than hanging up
+            return 500, {'handler_error': repr(e)}
+        return status, data if status == 200 else {}
+
+    def _handler_class(self):
+        standin = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+
+            def _handle(self, body=b''):
+                pairs = parse_qsl(urlparse(self.path).query) + parse_qsl(body.decode('utf-8'))
+                status, data = standin._respond(self.command, pairs)
+                content = json.dumps(data).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length', 0))
+                self._handle(self.rfile.read(length))
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+
+class StandInTestCase(unittest.TestCase):
+    """ Test case with a fresh StandIn server and a WSConfig pointed at it """
+
+    config_options = {}
+
+    def setUp(self):
+        self.server = StandIn().start()
+        self.addCleanup(self.server.stop)
+        self.config = muddle.WSConfig('token', self.server.url, **self.config_options)
@@ -0,0 +1,114 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+import muddle
+from muddle import activity
+from muddle.activity import ActivityStore
+
+from .standin import StandInTestCase
+
+DAY = 86400
+# 2026-01-01 00:00 UTC
+T0 = 1767225600
+
+ROLES = {3: 'editingteacher', 5: 'student'}
+
+
+def activity_row(courseid, roleid, timeend, read=1, write=0):
+    return {'uniqueid': '%s-%s-%s' % (courseid, roleid, timeend), 'courseid': courseid,
+            'courseshortname': 'C%d' % courseid, 'roleid': roleid, 'roleshortname': ROLES[roleid],
+            'timeend': timeend, 'activity_read': read, 'activity_write': write}
+
+
+def make_store():
+    store = ActivityStore('daily')
+    # 40 days from 2 Jan, for courses 1 and 2
+    store.extend(activity_row(courseid, roleid, T0 + day * DAY, read=courseid * roleid, write=1)
+                 for courseid in (1, 2) for roleid in ROLES for day in range(1, 41))
+    return store
+
+
+class ActivityStoreTests:
+    """ Rollups, run with and without numpy """
+
+    def test_totals(self):
+        self.assertEqual(self.store.rollup(by=()), (40 * (3 + 5 + 6 + 10), 160))
+
+    def test_by_course(self):
+        self.assertEqual(self.store.rollup(), {1: (320, 80), 2: (640, 80)})
+
+    def test_by_role_name_and_month(self):
+        totals = self.store.rollup(by=('role', 'period'), period='month')
+        # timeend 1 Feb 00:00 counts towards January
+        self.assertEqual(totals[('student', '2026-01')], (31 * 15, 62))
+        self.assertEqual(totals[('student', '2026-02')], (9 * 15, 18))
+
+    def test_where(self):
+        self.assertEqual(self.store.rollup(by=('roleid',), where={'courseid': 2}),
+                         {3: (240, 40), 5: (400, 40)})
+        self.assertEqual(self.store.rollup(where={'courseid': 99}), {})
+
+    def test_week(self):
+        weeks = self.store.rollup(by=('period',), period='week')
+        self.assertEqual(min(weeks), '2026-W01')
+
+    def test_bad_arguments(self):
+        self.assertRaises(ValueError, self.store.rollup, by=('colour',))
+        self.assertRaises(ValueError, self.store.rollup, by=('period',))
+        self.assertRaises(ValueError, self.store.rollup, where={'colour': 1})
+
+
+class PythonRollupTest(ActivityStoreTests, unittest.TestCase):
+
+    def setUp(self):
+        patcher = mock.patch.object(activity, 'numpy', None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.store = make_store()
+
+
+@unittest.skipIf(activity.numpy is None, 'numpy is not installed')
+class NumpyRollupTest(ActivityStoreTests, unittest.TestCase):
+
+    def setUp(self):
+        self.store = make_store()
+
+
+class ActivityStoreTest(unittest.TestCase):
+
+    def test_columns(self):
+        store = make_store()
+        self.assertEqual(len(store), 160)
+        self.assertEqual(store.nbytes, 160 * 18)
+        self.assertEqual(store.roles, ROLES)
+        self.assertEqual(store.courses, {1: 'C1', 2: 'C2'})
+        self.assertEqual(store.last_timeends(), {1: T0 + 40 * DAY, 2: T0 + 40 * DAY})
+
+    def test_save_and_load(self):
+        store = make_store()
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'daily.stats')
+            store.save(path)
+            loaded = ActivityStore.load(path)
+        self.assertEqual(loaded.granularity, 'daily')
+        self.assertEqual(list(loaded.rows()), list(store.rows()))
+
+
+class HarvestTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server.on('local_presentation_get_stats_activity_daily_by_course', self.daily)
+
+    def daily(self, args):
+        courseid = int(args['course'][1:])
+        return [activity_row(courseid, roleid, T0 + day * DAY)
+                for day in range(1, 11) for roleid in ROLES]
+
+    def test_harvest(self):
+        store = muddle.stats.API(self.config).harvest(['C1', 'C2'], time_start=T0, time_end=T0 + 10 * DAY)
+        self.assertEqual(len(store), 40)
+        self.assertEqual(store.rollup(by=('role',)), {'editingteacher': (20, 0), 'student': (20, 0)})
+        self.assertEqual(store.courses, {1: 'C1', 2: 'C2'})
@@ -0,0 +1,126 @@
+import os
+import tempfile
+import time
+import unittest
+
+import muddle
+from muddle.cache import ResponseCache, SQLiteCache, make_cache
+
+from .standin import StandInTestCase
+
+
+def members(groupid):
+    return {'wsfunction': 'core_group_get_group_members', 'groupids[0]': groupid}
+
+
+class CacheTests:
+    """ Tests run against each cache backend """
+
+    def test_reads_cached(self):
+        self.cache.set(members(3), [{'groupid': 3, 'userids': [7]}])
+        self.assertEqual(self.cache.get(members(3)), (True, [{'groupid': 3, 'userids': [7]}]))
+        self.assertEqual(self.cache.get(members(4)), (False, None))
+
+    def test_writes_and_errors_not_cached(self):
+        self.cache.set({'wsfunction': 'core_group_delete_groups', 'groupids[0]': 3}, None)
+        self.cache.set(members(3), {'exception': 'x', 'errorcode': 'e', 'message': 'm'})
+        self.assertEqual(len(self.cache), 0)
+
+    def test_expiry(self):
+        self.cache.ttls['core_group_get_group_members'] = 0.05
+        self.cache.set(members(3), [])
+        time.sleep(0.1)
+        self.assertEqual(self.cache.get(members(3)), (False, None))
+
+    def test_write_invalidates_matching_reads(self):
+        self.cache.set(members(3), [])
+        self.cache.set(members(4), [])
+        self.cache.invalidate({'wsfunction': 'core_group_add_group_members',
+                               'members[0][groupid]': 3, 'members[0][userid]': 7})
+        self.assertFalse(self.cache.get(members(3))[0])
+        self.assertTrue(self.cache.get(members(4))[0])
+
+    def test_unknown_write_clears(self):
+        self.cache.set(members(3), [])
+        self.cache.invalidate({'wsfunction': 'core_user_create_users'})
+        self.assertEqual(len(self.cache), 0)
+
+    def test_batch_wrapper_does_not_clear(self):
+        self.cache.set(members(3), [])
+        self.cache.invalidate({'wsfunction': 'tool_mobile_call_external_functions'})
+        self.assertEqual(len(self.cache), 1)
+
+
+class ResponseCacheTest(CacheTests, unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResponseCache()
+
+    def test_lru_eviction(self):
+        self.cache = ResponseCache(maxsize=2)
+        for groupid in (1, 2, 3):
+            self.cache.set(members(groupid), [])
+        self.assertEqual(len(self.cache), 2)
+        self.assertFalse(self.cache.get(members(1))[0])
+
+
+class SQLiteCacheTest(CacheTests, unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.path = os.path.join(directory.name, 'cache.sqlite')
+        self.cache = SQLiteCache(self.path, namespace='site')
+
+    def test_shared_between_instances(self):
+        self.cache.set(members(3), [{'groupid': 3, 'userids': [7]}])
+        other = SQLiteCache(self.path, namespace='site')
+        self.assertEqual(other.get(members(3)), (True, [{'groupid': 3, 'userids': [7]}]))
+        self.assertEqual(SQLiteCache(self.path, namespace='other').get(members(3)), (False, None))
+
+    def test_file_private(self):
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+
+
+class MakeCacheTest(unittest.TestCase):
+
+    def test_settings(self):
+        self.assertIsNone(make_cache(None))
+        self.assertIsNone(make_cache(False))
+        self.assertIsInstance(make_cache(True), ResponseCache)
+        self.assertEqual(make_cache({'maxsize': 5}).maxsize, 5)
+
+    def test_empty_cache_kept(self):
+        cache = ResponseCache()
+        self.assertIs(make_cache(cache), cache)
+
+
+class ConfigCacheTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.config = muddle.WSConfig('token', self.server.url, cache=True)
+        self.server.on('core_group_get_group_members',
+                       lambda args: [{'groupid': int(args['groupids'][0]), 'userids': []}])
+        self.server.on('core_group_add_group_members', lambda args: None)
+
+    def test_read_served_from_cache_until_write(self):
+        api = muddle.group.API(self.config)
+        api.get_group_members([3])
+        api.get_group_members([3])
+        self.assertEqual(len(self.server.calls), 1)
+        api.add_group_members([{'groupid': 3, 'userid': 7}])
+        api.get_group_members([3])
+        self.assertEqual(len(self.server.calls_to('core_group_get_group_members')), 2)
+
+    def test_tokens_kept_apart(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        cache = {'path': os.path.join(directory.name, 'cache.sqlite')}
+        first = muddle.WSConfig('token', self.server.url, cache=cache)
+        muddle.group.API(first).get_group_members([3])
+        muddle.group.API(muddle.WSConfig('token', self.server.url, cache=cache)).get_group_members([3])
+        self.assertEqual(len(self.server.calls), 1)
+        muddle.group.API(muddle.WSConfig('other', self.server.url, cache=cache)).get_group_members([3])
+        self.assertEqual(len(self.server.calls), 2)
+        self.assertNotIn('token', first.cache.namespace)
@@ -0,0 +1,87 @@
+import unittest
+
+import muddle
+from muddle.api.category import CategoryTree
+from muddle.config import aiohttp
+
+from .standin import StandInTestCase, ws_error
+
+
+def category(id, name, parent=0, idnumber=''):
+    return {'id': id, 'name': name, 'idnumber': idnumber, 'parent': parent,
+            'sortorder': id, 'path': '', 'depth': 0, 'coursecount': 0}
+
+
+class CategoryTreeTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.categories = [category(1, 'Science', idnumber='SCI'),
+                           category(2, 'Physics', 1, 'SCI-PHYS'),
+                           category(3, 'Arts')]
+        self.next_id = 100
+        self.server.on('core_course_get_categories', lambda args: self.categories)
+        self.server.on('core_course_create_categories', self.create_categories)
+        self.api = muddle.category.API(self.config)
+
+    def create_categories(self, args):
+        known = set(c['id'] for c in self.categories) | {0}
+        for new in args['categories']:
+            if int(new.get('parent', 0)) not in known or new['name'] == 'BAD':
+                return ws_error('invalidparent', 'Bad category')
+        created = []
+        for new in args['categories']:
+            self.next_id += 1
+            self.categories.append(category(self.next_id, new['name'], int(new.get('parent', 0)),
+                                            new['idnumber']))
+            created.append({'id': self.next_id, 'name': new['name']})
+        return created
+
+    def test_tree(self):
+        tree = self.api.tree()
+        self.assertEqual([c['id'] for c in tree.children()], [1, 3])
+        self.assertEqual(tree.names['Science/Physics'], 2)
+        self.assertTrue(tree.is_within(2, 1))
+        self.assertEqual([c['id'] for c in tree.subtree(1)], [1, 2])
+
+    def test_create_tree_one_call_per_level(self):
+        result = self.api.create_tree([
+            {'name': 'Chemistry', 'idnumber': 'SCI-CHEM', 'parent': 'SCI', 'children': [
+                {'name': '2027', 'idnumber': 'SCI-CHEM-2027', 'children': [
+                    {'name': 'S1', 'idnumber': 'SCI-CHEM-2027-S1'}]}]},
+            {'name': '2027', 'idnumber': 'SCI-PHYS-2027', 'parent': 'SCI-PHYS'},
+            {'name': 'Physics', 'idnumber': 'SCI-PHYS'},
+        ])
+        self.assertEqual(result['failed'], [])
+        self.assertEqual(result['calls'], 3)
+        self.assertEqual(result['ids']['SCI-PHYS'], 2)
+        tree = self.api.tree()
+        self.assertTrue(tree.is_within(result['ids']['SCI-CHEM-2027-S1'], 1))
+
+    def test_create_tree_failures(self):
+        result = self.api.create_tree([
+            {'name': 'BAD', 'idnumber': 'B', 'children': [{'name': 'Child', 'idnumber': 'B-C'}]},
+            {'name': 'Fine', 'idnumber': 'F'},
+            {'name': 'Orphan', 'idnumber': 'O', 'parent': 'MISSING'},
+            {'name': 'Loop 1', 'idnumber': 'L1', 'parent': 'L2'},
+            {'name': 'Loop 2', 'idnumber': 'L2', 'parent': 'L1'},
+        ])
+        reasons = {row['idnumber']: str(error) for row, error in result['failed']}
+        self.assertIn('F', result['ids'])
+        self.assertEqual(set(reasons), {'B', 'B-C', 'O', 'L1', 'L2'})
+        self.assertIn('was not created', reasons['B-C'])
+        self.assertIn("doesn't exist", reasons['O'])
+        self.assertIn('cycle', reasons['L1'])
+
+    def test_create_tree_child_waiting_on_rejected_parent(self):
+        result = self.api.create_tree([{'name': 'K', 'idnumber': 'K', 'parent': 'P2'},
+                                       {'name': 'P2', 'idnumber': 'P2', 'parent': 'MISSING'}],
+                                      existing=CategoryTree([]))
+        reasons = {row['idnumber']: str(error) for row, error in result['failed']}
+        self.assertIn("doesn't exist", reasons['P2'])
+        self.assertIn('was not created', reasons['K'])
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_create_tree_async_config_rejected(self):
+        api = muddle.category.API(muddle.AsyncWSConfig('token', self.server.url))
+        self.assertRaises(TypeError, api.create_tree, [{'name': 'A', 'idnumber': 'A'}], existing=CategoryTree([]))
@@ -0,0 +1,167 @@
+import asyncio
+import json
+import unittest
+
+import requests
+
+import muddle
+from muddle.config import aiohttp
+from muddle.exceptions import MuddleError, WSError
+
+from .standin import StandIn, StandInTestCase, ws_error
+
+
+def contents(args):
+    return [{'id': n, 'name': 'Section %d' % n, 'modules': []} for n in range(3)]
+
+
+class WSConfigTest(StandInTestCase):
+
+    def test_read_is_get_with_args(self):
+        self.server.on('core_course_get_contents', contents)
+        result = muddle.course.API(self.config).get_course_contents(10)
+        self.assertEqual([section['id'] for section in result], [0, 1, 2])
+        self.assertEqual(self.server.calls, [('GET', 'core_course_get_contents', {'courseid': '10'})])
+
+    def test_write_is_post(self):
+        self.server.on('core_group_add_group_members', lambda args: None)
+        response = muddle.group.API(self.config).add_group_members([{'groupid': 3, 'userid': 7}])
+        self.assertEqual(response.status_code, 200)
+        method, wsfunction, args = self.server.calls[0]
+        self.assertEqual(method, 'POST')
+        self.assertEqual(args, {'members': [{'groupid': '3', 'userid': '7'}]})
+
+    def test_read_retried_after_server_error(self):
+        self.config = self.config.with_options(retries=2, backoff_factor=0)
+        self.server.on('core_course_get_contents', contents)
+        self.server.fail(503, times=2)
+        result = muddle.course.API(self.config).get_course_contents(10)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(len(self.server.calls), 3)
+
+    def test_write_not_retried(self):
+        self.config = self.config.with_options(retries=2, backoff_factor=0)
+        self.server.fail(503)
+        response = muddle.group.API(self.config).add_group_members([{'groupid': 3, 'userid': 7}])
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(len(self.server.calls), 1)
+
+    def test_stream(self):
+        self.server.on('core_course_get_contents', contents)
+        self.config.stream_chunk_size = 7
+        sections = list(muddle.course.API(self.config).iter_course_contents(10))
+        self.assertEqual(sections, contents({}))
+
+    def test_stream_error(self):
+        self.server.on('core_course_get_contents', lambda args: ws_error('invalidrecord'))
+        with self.assertRaises(WSError) as caught:
+            list(muddle.course.API(self.config).iter_course_contents(10))
+        self.assertEqual(caught.exception.errorcode, 'invalidrecord')
+
+    def test_map_keeps_order(self):
+        self.server.on('core_course_get_contents', lambda args: [{'id': int(args['courseid'])}])
+        api = muddle.course.API(self.config)
+        results = self.config.map(api.get_course_contents, range(20), workers=4)
+        self.assertEqual([result[0]['id'] for result in results], list(range(20)))
+        self.assertGreater(self.config.connection_stats()['reused'], 0)
+
+    def test_imap_lazy_and_ordered(self):
+        self.server.on('core_course_get_contents', lambda args: [{'id': int(args['courseid'])}])
+        api = muddle.course.API(self.config)
+        results = self.config.imap(api.get_course_contents, range(100), workers=3)
+        self.assertEqual([next(results)[0]['id'] for _ in range(5)], list(range(5)))
+        results.close()
+        self.assertLess(len(self.server.calls), 10)
+        failing = self.config.imap(lambda n: 1 // n, [1, 0, 2], return_exceptions=True)
+        self.assertIsInstance(list(failing)[1], ZeroDivisionError)
+
+    def test_timeout(self):
+        self.server.delay = 0.5
+        self.config = self.config.with_options(timeout=0.1)
+        with self.assertRaises(requests.Timeout):
+            muddle.course.API(self.config).get_course_contents(10)
+
+
+class BatchTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server.on('tool_mobile_call_external_functions', self.batch)
+        self.server.on('core_course_get_contents', contents)
+
+    def batch(self, args):
+        responses = []
+        for request in args['requests']:
+            if request['function'] == 'core_group_get_course_groups':
+                data = [{'id': 1, 'courseid': json.loads(request['arguments'])['courseid']}]
+                responses.append({'error': False, 'data': json.dumps(data)})
+            else:
+                responses.append({'error': True, 'exception': json.dumps(ws_error('nopermission'))})
+                break
+        return {'responses': responses}
+
+    def test_calls_sent_together(self):
+        with self.config.batch() as batch:
+            first = muddle.group.API(batch).get_course_groups(10)
+            second = muddle.group.API(batch).get_course_groups(11)
+        self.assertEqual(first.result(), [{'id': 1, 'courseid': 10}])
+        self.assertEqual(second.result(), [{'id': 1, 'courseid': 11}])
+        self.assertEqual(len(self.server.calls), 1)
+
+    def test_calls_after_failure_not_run(self):
+        with self.config.batch() as batch:
+            failing = muddle.group.API(batch).delete_groups([5])
+            after = muddle.group.API(batch).get_course_groups(10)
+        self.assertRaises(WSError, failing.result)
+        self.assertRaises(MuddleError, after.result)
+
+    def test_reads_use_and_keep_cache(self):
+        self.config = muddle.WSConfig('token', self.server.url, cache=muddle.cache.ResponseCache())
+        muddle.course.API(self.config).get_course_contents(10)
+        with self.config.batch() as batch:
+            muddle.group.API(batch).get_course_groups(10)
+        self.assertEqual(len(self.config.cache), 2)
+        with self.config.batch() as batch:
+            cached = muddle.group.API(batch).get_course_groups(10)
+        self.assertEqual(cached.result(), [{'id': 1, 'courseid': 10}])
+        self.assertEqual(len(self.server.calls), 2)
+
+
+@unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+class AsyncWSConfigTest(unittest.TestCase):
+
+    def setUp(self):
+        self.server = StandIn().start()
+        self.addCleanup(self.server.stop)
+        self.server.on('core_course_get_contents', contents)
+
+    def run_with_config(self, coroutine, **options):
+        async def run():
+            async with muddle.AsyncWSConfig('token', self.server.url, **options) as config:
+                return await coroutine(config), config.connection_stats()
+        return asyncio.run(run())
+
+    def test_request(self):
+        async def fetch(config):
+            api = muddle.course.API(config)
+            return await asyncio.gather(*[api.get_course_contents(n) for n in range(10)])
+        results, stats = self.run_with_config(fetch, concurrency=2)
+        self.assertEqual(len(results), 10)
+        self.assertEqual(stats['requests'], 10)
+        self.assertLessEqual(stats['connections'], 2)
+
+    def test_retry(self):
+        self.server.fail(502)
+
+        async def fetch(config):
+            return await muddle.course.API(config).get_course_contents(10)
+        result, stats = self.run_with_config(fetch, retries=1, backoff_factor=0)
+        self.assertEqual(len(result), 3)
+        self.assertEqual(len(self.server.calls), 2)
+
+    def test_stream(self):
+        async def fetch(config):
+            return [section async for section in muddle.course.API(config).iter_course_contents(10)]
+        result, stats = self.run_with_config(fetch)
+        self.assertEqual(result, contents({}))
+
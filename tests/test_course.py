@@ -0,0 +1,230 @@
+import time
+import unittest
+
+import requests
+
+import muddle
+from muddle.config import aiohttp
+from muddle.exceptions import MuddleError, WSError
+from muddle.records import Course
+
+from .standin import StandInTestCase, ws_error
+
+
+def section(courseid, n):
+    return {'id': courseid * 10 + n, 'section': n, 'name': 'Section %d' % n, 'modules': [
+        {'id': courseid * 100 + n, 'instance': n, 'modname': 'resource', 'name': 'Notes %d' % n,
+         'url': 'http://moodle/mod/resource/%d' % n, 'visible': 1, 'contents': [
+             {'type': 'file', 'filename': 'notes%d.pdf' % n, 'filepath': '/', 'filesize': 100,
+              'fileurl': 'http://moodle/file/%d' % n, 'mimetype': 'application/pdf', 'timemodified': 0},
+             {'type': 'url', 'filename': 'link', 'fileurl': 'http://example.com/%d' % n}]}]}
+
+
+class ContentsTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.server.on('core_course_get_contents', self.get_contents)
+        self.server.on('core_course_get_courses_by_field', lambda args: {
+            'courses': [{'id': 5}, {'id': 6}] if args['value'] == '4' else [], 'warnings': []})
+        self.api = muddle.course.API(self.config)
+
+    def get_contents(self, args):
+        courseid = int(args['courseid'])
+        if courseid == 13:
+            return ws_error('invalidrecord', 'No course 13')
+        return [section(courseid, n) for n in range(2)]
+
+    def test_modules(self):
+        records = list(self.api.iter_contents([1, 2, 3], workers=2))
+        self.assertEqual([(r['courseid'], r['cmid']) for r in records],
+                         [(1, 100), (1, 101), (2, 200), (2, 201), (3, 300), (3, 301)])
+        self.assertEqual(records[1]['sectionname'], 'Section 1')
+
+    def test_contents(self):
+        records = list(self.api.iter_contents([1], contents=True))
+        self.assertEqual([(r['cmid'], r['type']) for r in records],
+                         [(100, 'file'), (100, 'url'), (101, 'file'), (101, 'url')])
+        self.assertEqual(records[0]['filename'], 'notes0.pdf')
+        self.assertIsNone(records[1]['filesize'])
+
+    def test_category(self):
+        records = list(self.api.iter_contents(category_id=4))
+        self.assertEqual(sorted(set(r['courseid'] for r in records)), [5, 6])
+
+    def test_errors(self):
+        self.assertRaises(WSError, list, self.api.iter_contents([1, 13]))
+        errors = []
+        records = list(self.api.iter_contents([1, 13, 2], on_error=lambda courseid, e: errors.append(courseid)))
+        self.assertEqual(errors, [13])
+        self.assertEqual(len(records), 4)
+
+    def test_lazy(self):
+        records = self.api.iter_contents(range(1, 101), workers=2)
+        next(records)
+        records.close()
+        self.assertLess(len(self.server.calls), 10)
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_config_rejected(self):
+        api = muddle.course.API(muddle.AsyncWSConfig('token', self.server.url))
+        self.assertRaises(TypeError, api.iter_contents, [1])
+
+
+def course(id, shortname, categoryid=1, idnumber='', timemodified=1000):
+    return {'id': id, 'shortname': shortname, 'fullname': shortname, 'idnumber': idnumber,
+            'categoryid': categoryid, 'format': 'topics', 'timemodified': timemodified}
+
+
+class CatalogueTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.courses = [dict(course(1, 'Site'), format='site', categoryid=0),
+                        course(2, 'ABC101', idnumber='ABC'), course(3, 'XYZ', categoryid=2)]
+        self.server.on('core_course_get_courses', lambda args: self.courses)
+        self.api = muddle.course.API(self.config)
+
+    def test_lookups(self):
+        catalogue = self.api.catalogue()
+        self.assertEqual(len(catalogue), 2)
+        self.assertNotIn(1, catalogue)
+        self.assertIsInstance(catalogue.get(2), Course)
+        self.assertEqual(catalogue.by_shortname('XYZ')['id'], 3)
+        self.assertEqual(catalogue.by_idnumber('ABC')['id'], 2)
+        self.assertEqual([c['id'] for c in catalogue.in_category(2)], [3])
+        self.assertIsNone(catalogue.by_shortname('nope'))
+        self.assertIn(1, self.api.catalogue(include_site=True))
+
+    def test_fields(self):
+        catalogue = self.api.catalogue(fields=('id', 'shortname', 'idnumber', 'categoryid', 'timemodified'))
+        self.assertEqual(catalogue.get(2).as_dict(), {'id': 2, 'shortname': 'ABC101', 'idnumber': 'ABC',
+                                                      'categoryid': 1, 'timemodified': 1000})
+        self.assertRaises(ValueError, self.api.catalogue, fields=('id', 'shortname'))
+
+    def test_fields_in_batch(self):
+        with self.config.batch() as batch:
+            courses = muddle.course.API(batch).get_courses([2], fields=('id', 'shortname'))
+        self.assertEqual(courses.result()[1].shortname, 'ABC101')
+
+    def test_refresh(self):
+        catalogue = self.api.catalogue()
+        self.assertEqual(catalogue.refresh(), {'added': [], 'updated': [], 'removed': []})
+        self.courses[1] = course(2, 'ABC102', categoryid=3, timemodified=2000)
+        del self.courses[2]
+        self.courses.append(course(4, 'NEW', idnumber='N'))
+        self.assertEqual(catalogue.refresh(), {'added': [4], 'updated': [2], 'removed': [3]})
+        self.assertIsNone(catalogue.by_shortname('ABC101'))
+        self.assertIsNone(catalogue.by_idnumber('ABC'))
+        self.assertEqual(catalogue.by_shortname('ABC102')['categoryid'], 3)
+        self.assertEqual(catalogue.in_category(2), [])
+        self.assertEqual(catalogue.by_idnumber('N')['id'], 4)
+
+    def test_refresh_skips_cache(self):
+        self.config = muddle.WSConfig('token', self.server.url, cache=True)
+        self.api = muddle.course.API(self.config)
+        self.api.get_courses()
+        catalogue = self.api.catalogue()
+        self.courses.append(course(4, 'NEW'))
+        self.assertEqual(catalogue.refresh()['added'], [4])
+        self.assertEqual(len(self.server.calls), 3)
+
+
+class BulkCoursesTest(StandInTestCase):
+    """ create_courses_bulk and delete_courses, retrying failed calls in halves """
+
+    def setUp(self):
+        super().setUp()
+        self.courses = {}
+        self.next_id = 200
+        self.server.on('core_course_create_courses', self.create_courses)
+        self.server.on('core_course_delete_courses', self.delete_courses)
+        self.api = muddle.course.API(self.config)
+
+    def create_courses(self, args):
+        # All or nothing, as Moodle does
+        if any(course['shortname'] == 'SLOW' for course in args['courses']):
+            time.sleep(1)
+        for course in args['courses']:
+            if course['shortname'] in self.courses or course['shortname'].startswith('BAD'):
+                return ws_error('shortnametaken', 'Short name is already used')
+        created = []
+        for course in args['courses']:
+            self.next_id += 1
+            self.courses[course['shortname']] = self.next_id
+            created.append({'id': self.next_id, 'shortname': course['shortname']})
+        return created
+
+    def delete_courses(self, args):
+        ids = [int(course_id) for course_id in args['courseids']]
+        if 13 in ids:
+            return ws_error('invalidrecord', 'Course 13 is cursed')
+        return {'warnings': [{'item': 'course', 'itemid': course_id, 'warningcode': 'unknowncourseidnumber',
+                              'message': 'Unknown course'} for course_id in ids if course_id > 100]}
+
+    def course(self, shortname):
+        return {'fullname': shortname, 'shortname': shortname, 'categoryid': 1}
+
+    def test_create(self):
+        result = self.api.create_courses_bulk([self.course('C%d' % n) for n in range(10)], chunk_size=4)
+        self.assertEqual(len(result['ids']), 10)
+        self.assertEqual(result['failed'], [])
+        self.assertEqual(len(self.server.calls), 3)
+
+    def test_create_finds_failing_courses(self):
+        courses = [self.course('C%d' % n) for n in range(16)]
+        courses[5] = self.course('BAD5')
+        courses[11] = self.course('BAD11')
+        result = self.api.create_courses_bulk(courses, chunk_size=16)
+        self.assertEqual(len(result['ids']), 14)
+        self.assertEqual([course['shortname'] for course, error in result['failed']], ['BAD5', 'BAD11'])
+        self.assertIsInstance(result['failed'][0][1], WSError)
+        # Far fewer calls than one per course
+        self.assertLess(len(self.server.calls), 16)
+
+    def test_create_rejects_unknown_options(self):
+        with self.assertRaises(ValueError):
+            self.api.create_courses_bulk([dict(self.course('C'), colour='red')])
+
+    def test_create_gateway_error(self):
+        self.server.fail(502, handled=True)
+        result = self.api.create_courses_bulk([self.course('C%d' % n) for n in range(6)], chunk_size=2)
+        self.assertEqual(len(result['ids']), 4)
+        self.assertEqual(len(result['maybe_created']), 2)
+        self.assertEqual([course['shortname'] for course, error in result['failed']], result['maybe_created'])
+        # Created on the server, though we never heard
+        self.assertTrue(all(shortname in self.courses for shortname in result['maybe_created']))
+
+    def test_create_timeout_keeps_other_chunks(self):
+        self.api = muddle.course.API(self.config.with_options(timeout=0.5))
+        courses = [self.course('C%d' % n) for n in range(6)]
+        courses[4] = self.course('SLOW')
+        result = self.api.create_courses_bulk(courses, chunk_size=2)
+        self.assertEqual(sorted(result['ids']), ['C0', 'C1', 'C2', 'C3'])
+        self.assertEqual(result['maybe_created'], ['SLOW', 'C5'])
+        self.assertIsInstance(result['failed'][0][1], requests.Timeout)
+
+    def test_create_missing_ids_reported(self):
+        self.server.on('core_course_create_courses', lambda args: [])
+        result = self.api.create_courses_bulk([self.course('C0')])
+        self.assertEqual(result['maybe_created'], ['C0'])
+        self.assertIsInstance(result['failed'][0][1], MuddleError)
+
+    def test_delete(self):
+        result = self.api.delete_courses([10, 11, 12, 13, 14, 101], chunk_size=6)
+        self.assertEqual(sorted(result['deleted']), [10, 11, 12, 14])
+        failed = dict(result['failed'])
+        self.assertIsInstance(failed[13], WSError)
+        self.assertEqual(failed[101]['warningcode'], 'unknowncourseidnumber')
+
+    def test_delete_gateway_error(self):
+        self.server.fail(502)
+        result = self.api.delete_courses([10, 11], chunk_size=2)
+        self.assertEqual(result['deleted'], [])
+        self.assertIsInstance(dict(result['failed'])[10], requests.HTTPError)
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_config_rejected(self):
+        api = muddle.course.API(muddle.AsyncWSConfig('token', self.server.url))
+        self.assertRaises(TypeError, api.create_courses_bulk, [self.course('C')])
+        self.assertRaises(TypeError, api.delete_courses, [10])
@@ -0,0 +1,85 @@
+import json
+import os
+import tempfile
+import unittest
+
+import muddle
+from muddle.config import aiohttp
+from muddle.duplicator import Duplicator
+
+from .standin import StandInTestCase, ws_error
+
+
+class DuplicatorTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.journal = os.path.join(directory.name, 'journal.jsonl')
+        self.courses = {}
+        self.server.on('core_course_duplicate_course', self.duplicate)
+        self.server.on('core_course_get_courses_by_field', self.by_shortname)
+        self.jobs = [{'courseid': n, 'fullname': 'Course %d' % n, 'shortname': 'C%d-2027' % n,
+                      'categoryid': 4} for n in range(1, 7)]
+
+    def duplicate(self, args):
+        if args['shortname'] in self.courses:
+            return ws_error('shortnametaken', 'Short name is already used')
+        self.courses[args['shortname']] = 1000 + int(args['courseid'])
+        return {'id': self.courses[args['shortname']], 'shortname': args['shortname']}
+
+    def by_shortname(self, args):
+        courses = [{'id': self.courses[args['value']]}] if args['value'] in self.courses else []
+        return {'courses': courses, 'warnings': []}
+
+    def journalled(self):
+        with open(self.journal) as f:
+            return [json.loads(line) for line in f]
+
+    def test_run_and_resume(self):
+        results = Duplicator(self.config, self.journal, workers=3).run(self.jobs)
+        self.assertEqual(sorted(result['newid'] for result in results), list(range(1001, 1007)))
+        self.assertEqual(len(self.journalled()), 6)
+        again = Duplicator(self.config, self.journal, workers=3)
+        self.assertEqual(again.completed[(1, 'C1-2027')], 1001)
+        self.assertEqual(again.run(self.jobs), [])
+
+    def test_interrupted_run_journals_running_jobs(self):
+        self.server.delay = 0.2
+
+        def interrupt(result, done, total):
+            raise KeyboardInterrupt
+        with self.assertRaises(KeyboardInterrupt):
+            Duplicator(self.config, self.journal, workers=3, on_progress=interrupt).run(self.jobs)
+        self.assertEqual(len(self.journalled()), len(self.courses))
+        self.assertLess(len(self.courses), 6)
+        Duplicator(self.config, self.journal, workers=3).run(self.jobs)
+        self.assertEqual(len(self.courses), 6)
+
+    def test_gateway_error_looked_up_before_retry(self):
+        self.server.fail(502, handled=True)
+        results = Duplicator(self.config, self.journal, workers=1).run(self.jobs[:1])
+        self.assertEqual((results[0]['status'], results[0]['maybe_created']), ('failed', True))
+        results = Duplicator(self.config, self.journal, workers=1).run(self.jobs[:1])
+        self.assertEqual((results[0]['status'], results[0]['newid']), ('done', 1001))
+        self.assertEqual(len(self.server.calls_to('core_course_duplicate_course')), 1)
+
+    def test_rejected_job_not_looked_up(self):
+        self.courses['C1-2027'] = 999
+        results = Duplicator(self.config, self.journal, workers=1).run(self.jobs[:1])
+        self.assertEqual((results[0]['status'], results[0]['maybe_created']), ('failed', False))
+        results = Duplicator(self.config, self.journal, workers=1).run(self.jobs[:1])
+        self.assertEqual((results[0]['status'], results[0]['newid']), ('failed', None))
+        self.assertEqual(self.server.calls_to('core_course_get_courses_by_field'), [])
+        self.assertEqual(len(self.server.calls_to('core_course_duplicate_course')), 2)
+
+    def test_timeout(self):
+        self.server.delay = 0.3
+        results = Duplicator(self.config, self.journal, timeout=0.1).run(self.jobs[:1])
+        self.assertEqual(results[0]['status'], 'timeout')
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_config_rejected(self):
+        with self.assertRaises(TypeError):
+            Duplicator(muddle.AsyncWSConfig('token', self.server.url), self.journal)
@@ -0,0 +1,44 @@
+import threading
+import unittest
+
+from muddle import encoding
+from muddle.encoding import encode_params
+
+
+class EncodeParamsTest(unittest.TestCase):
+
+    def test_nested(self):
+        self.assertEqual(
+            encode_params('f', {'groupids': [3, 4], 'options': {'visible': True, 'theme': None}}),
+            {'wsfunction': 'f', 'groupids[0]': 3, 'groupids[1]': 4, 'options[visible]': 1})
+
+    def test_records(self):
+        members = [{'groupid': 3, 'userid': n} for n in range(3)]
+        params = encode_params('f', {'members': members})
+        self.assertEqual(len(params), 7)
+        self.assertEqual(params['members[2][userid]'], 2)
+
+    def test_mixed_records_use_slow_path(self):
+        params = encode_params('f', {'items': [{'a': 1}, {'a': [1, 2]}]})
+        self.assertEqual(params, {'wsfunction': 'f', 'items[0][a]': 1,
+                                  'items[1][a][0]': 1, 'items[1][a][1]': 2})
+
+    def test_percent_in_names(self):
+        params = encode_params('f', {'x%d': [{'k%s': 1}]})
+        self.assertEqual(params, {'wsfunction': 'f', 'x%d[0][k%s]': 1})
+
+    def test_key_cache_thread_safe(self):
+        def encode():
+            for _ in range(20):
+                encode_params('f_threads', {'members': [{'groupid': 1, 'userid': n}
+                                                        for n in range(2000)]})
+        threads = [threading.Thread(target=encode) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(encoding._schemas[('f_threads', 'members', 'userid')]), 2000)
+        params = encode_params('f_threads', {'members': [{'groupid': 1, 'userid': n}
+                                                         for n in range(3000)]})
+        self.assertEqual(len(params), 6001)
+        self.assertEqual(params['members[2999][userid]'], 2999)
@@ -0,0 +1,159 @@
+import time
+import unittest
+
+import requests
+
+import muddle
+from muddle.config import aiohttp
+from muddle.exceptions import WSError
+
+from .standin import StandInTestCase, ws_error
+
+
+class GroupsTest(StandInTestCase):
+    """ Against a stand-in holding groups and their members """
+
+    def setUp(self):
+        super().setUp()
+        self.members = {3: {1, 2}, 4: set()}
+        self.groups = [{'id': 3, 'courseid': 10, 'name': 'Red', 'idnumber': ''},
+                       {'id': 4, 'courseid': 11, 'name': 'Blue', 'idnumber': ''},
+                       {'id': 100, 'courseid': 12, 'name': 'Lab A', 'idnumber': 'LAB-A'}]
+        self.next_id = 200
+        self.groupings = [{'id': 7, 'courseid': 10, 'name': 'Colours', 'idnumber': '', 'groupids': [3]}]
+        self.server.on('core_group_get_group_members', self.get_members)
+        self.server.on('core_group_add_group_members', self.add_members)
+        self.server.on('core_group_delete_group_members', self.delete_members)
+        self.server.on('core_group_get_course_groups', self.get_course_groups)
+        self.server.on('core_group_get_course_groupings', self.get_course_groupings)
+        self.server.on('core_group_get_groupings', self.get_groupings)
+        self.server.on('core_group_create_groups', self.create_groups)
+        self.api = muddle.group.API(self.config)
+
+    def get_members(self, args):
+        return [{'groupid': int(groupid), 'userids': sorted(self.members.get(int(groupid), ()))}
+                for groupid in args['groupids']]
+
+    def add_members(self, args):
+        if any(member['userid'] == '666' for member in args['members']):
+            return ws_error('notenrolled', 'User not enrolled')
+        for member in args['members']:
+            self.members[int(member['groupid'])].add(int(member['userid']))
+
+    def delete_members(self, args):
+        for member in args['members']:
+            self.members[int(member['groupid'])].discard(int(member['userid']))
+
+    def get_course_groups(self, args):
+        return [group for group in self.groups if group['courseid'] == int(args['courseid'])]
+
+    def get_course_groupings(self, args):
+        return [{key: value for key, value in grouping.items() if key != 'groupids'}
+                for grouping in self.groupings if grouping['courseid'] == int(args['courseid'])]
+
+    def get_groupings(self, args):
+        ids = [int(groupingid) for groupingid in args['groupingids']]
+        return [dict({key: value for key, value in grouping.items() if key != 'groupids'},
+                     groups=[group for group in self.groups if group['id'] in grouping['groupids']])
+                for grouping in self.groupings if grouping['id'] in ids]
+
+    def create_groups(self, args):
+        created = []
+        for group in args['groups']:
+            self.next_id += 1
+            created.append(dict(group, id=self.next_id, courseid=int(group['courseid'])))
+        self.groups.extend(created)
+        return created
+
+    def test_sync_members(self):
+        report = self.api.sync_members({3: [2, 5], 4: [6]})
+        self.assertEqual(self.members, {3: {2, 5}, 4: {6}})
+        self.assertEqual(report['added'], [{'groupid': 3, 'userid': 5}, {'groupid': 4, 'userid': 6}])
+        self.assertEqual(report['removed'], [{'groupid': 3, 'userid': 1}])
+        self.assertEqual(report['unchanged'], 1)
+
+    def test_sync_members_nothing_to_do(self):
+        report = self.api.sync_members({3: [1, 2]})
+        self.assertEqual(report['writes'], 0)
+        self.assertEqual(len(self.server.calls), 1)
+
+    def test_sync_members_dry_run_and_add_only(self):
+        self.api.sync_members({3: [5]}, dry_run=True)
+        self.assertEqual(self.members[3], {1, 2})
+        self.api.sync_members({3: [5]}, remove=False)
+        self.assertEqual(self.members[3], {1, 2, 5})
+
+    def test_sync_members_reports_failed_calls(self):
+        report = self.api.sync_members({4: [666]})
+        self.assertEqual(len(report['errors']), 1)
+        self.assertIsInstance(report['errors'][0][1], WSError)
+
+    def test_sync_members_reports_transport_errors(self):
+        self.api.write_chunk_size = 1
+        # The read and the delete go through, then a proxy gives up on the first add
+        self.server.fail(200, times=2, handled=True)
+        self.server.fail(502, handled=True)
+        report = self.api.sync_members({3: [2, 5, 6]})
+        self.assertEqual(report['removed'], [{'groupid': 3, 'userid': 1}])
+        self.assertEqual(report['added'], [{'groupid': 3, 'userid': 6}])
+        self.assertEqual(report['writes'], 3)
+        self.assertEqual(report['errors'][0][0], [{'groupid': 3, 'userid': 5}])
+        self.assertIsInstance(report['errors'][0][1], requests.HTTPError)
+        # It went through, though the proxy said otherwise
+        self.assertEqual(self.members[3], {2, 5, 6})
+
+    def test_sync_members_connection_lost(self):
+        self.api = muddle.group.API(self.config.with_options(timeout=0.2))
+        self.members[4] = {9}
+
+        def slow_delete(args):
+            time.sleep(0.5)
+            return self.delete_members(args)
+        self.server.on('core_group_delete_group_members', slow_delete)
+        report = self.api.sync_members({3: [1, 2], 4: []})
+        self.assertEqual(report['removed'], [])
+        self.assertIsInstance(report['errors'][0][1], requests.Timeout)
+
+    def test_snapshot(self):
+        self.members[4] = {2}
+        snap = self.api.snapshot([10, 11])
+        self.assertEqual(set(snap.groups), {3, 4})
+        self.assertEqual(snap.course_groups, {10: {3}, 11: {4}})
+        self.assertEqual(snap.course_groupings, {10: {7}})
+        self.assertEqual(snap.grouping_groups, {7: {3}})
+        self.assertEqual(snap.grouping_members, {7: {1, 2}})
+        self.assertEqual(snap.groups_for_user(2), {3, 4})
+        self.assertEqual(snap.groups_for_user(2, course_id=11), {4})
+        self.assertEqual(snap.groupings_for_user(1), {7})
+        self.assertEqual(snap.groupings_for_user(2, course_id=11), set())
+        self.assertEqual(len(self.server.calls), 6)
+
+    def test_ensure_groups(self):
+        ids = self.api.ensure_groups([
+            {'courseid': 12, 'name': 'Lab A', 'idnumber': 'LAB-A'},
+            {'courseid': 12, 'name': 'Lab B', 'idnumber': 'LAB-B'},
+            {'courseid': 12, 'name': 'Lab B', 'idnumber': 'LAB-B'},
+        ])
+        self.assertEqual(ids, {'LAB-A': 100, 'LAB-B': 201})
+        self.assertEqual(len(self.server.calls_to('core_group_create_groups')), 1)
+        again = self.api.ensure_groups([{'courseid': 12, 'name': 'Lab B', 'idnumber': 'LAB-B'}])
+        self.assertEqual(again, {'LAB-B': 201})
+        self.assertEqual(len(self.server.calls_to('core_group_create_groups')), 1)
+
+    def test_ensure_groups_matches_within_course(self):
+        ids = self.api.ensure_groups([{'courseid': 11, 'name': 'Lab A', 'idnumber': 'LAB-A'}])
+        self.assertEqual(ids, {'LAB-A': 201})
+
+    def test_ensure_groups_same_idnumber_two_courses(self):
+        with self.assertRaises(ValueError):
+            self.api.ensure_groups([{'courseid': 10, 'name': 'X', 'idnumber': 'X'},
+                                    {'courseid': 11, 'name': 'X', 'idnumber': 'X'}])
+
+    @unittest.skipIf(aiohttp is None, 'aiohttp is not installed')
+    def test_async_config_rejected(self):
+        api = muddle.group.API(muddle.AsyncWSConfig('token', self.server.url))
+        self.assertRaises(TypeError, api.get_members_map, [3])
+        self.assertRaises(TypeError, api.sync_members, {3: [1]})
+        self.assertRaises(TypeError, api.snapshot, [10])
+        self.assertRaises(TypeError, api.ensure_groups, [{'courseid': 10, 'name': 'X', 'idnumber': 'X'}])
+        self.assertRaises(TypeError, api.ensure_groupings, [{'courseid': 10, 'name': 'X', 'idnumber': 'X'}])
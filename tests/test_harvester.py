@@ -0,0 +1,86 @@
+from muddle.activity import ActivityStore
+from muddle.harvester import ActivityHarvester
+
+from .standin import StandInTestCase, ws_error
+from .test_activity import DAY, T0, activity_row
+
+FUNCTION = 'local_presentation_get_stats_activity_daily_by_course'
+
+
+class HarvesterTest(StandInTestCase):
+    """ Against a stand-in with daily stats up to self.now """
+
+    def setUp(self):
+        super().setUp()
+        self.now = T0 + 100 * DAY
+        self.failing = set()
+        self.server.on(FUNCTION, self.daily)
+
+    def daily(self, args):
+        courseid = int(args['course'][1:])
+        start = int(args.get('starttime') or 0)
+        end = int(args['endtime'])
+        if (args['course'], start) in self.failing:
+            return ws_error('dberror', 'Error reading from database')
+        # Both ends inclusive, so windows overlap at their edges
+        return [activity_row(courseid, roleid, timeend)
+                for timeend in range(T0 + DAY, self.now + 1, DAY) if start <= timeend <= end
+                for roleid in (3, 5)]
+
+    def windows(self):
+        return [(int(args['starttime']), int(args['endtime'])) for args in self.server.calls_to(FUNCTION)]
+
+    def test_windows_bounded(self):
+        harvester = ActivityHarvester(self.config, window=30 * DAY)
+        self.assertEqual(harvester.windows(T0, T0 + 70 * DAY, 'daily'),
+                         [(T0, T0 + 30 * DAY), (T0 + 30 * DAY, T0 + 60 * DAY), (T0 + 60 * DAY, T0 + 70 * DAY)])
+
+    def test_refresh_without_duplicates(self):
+        harvester = ActivityHarvester(self.config)
+        summary = harvester.refresh(['C1', 'C2'], since=T0, until=self.now)
+        store = harvester.stores['daily']
+        self.assertEqual(summary['rows'], 400)
+        self.assertGreater(summary['duplicates'], 0)
+        self.assertEqual(len(store), 400)
+        self.assertEqual(harvester.watermarks[('C1', 'daily')], self.now)
+        self.assertTrue(all(end - start <= 31 * DAY for start, end in self.windows()))
+
+    def test_refresh_fetches_only_new(self):
+        harvester = ActivityHarvester(self.config)
+        harvester.refresh(['C1'], since=T0, until=self.now)
+        calls = len(self.server.calls)
+        self.assertEqual(harvester.refresh(['C1'], until=self.now)['requests'], 0)
+        self.now += 3 * DAY
+        summary = harvester.refresh(['C1'], until=self.now)
+        self.assertEqual(summary['rows'], 6)
+        self.assertEqual(self.windows()[calls:], [(self.now - 3 * DAY, self.now)])
+
+    def test_first_harvest_windowed_from_horizon(self):
+        harvester = ActivityHarvester(self.config, horizon=90 * DAY)
+        harvester.refresh(['C1'], until=self.now)
+        windows = sorted(self.windows())
+        self.assertEqual(windows[0][0], self.now - 90 * DAY)
+        self.assertEqual(len(windows), 3)
+
+    def test_watermarks_from_saved_store(self):
+        store = ActivityStore('daily')
+        store.extend(activity_row(1, 5, T0 + day * DAY) for day in range(1, 11))
+        harvester = ActivityHarvester(self.config, {'daily': store})
+        self.assertEqual(harvester.watermarks, {('C1', 'daily'): T0 + 10 * DAY})
+        harvester.refresh(['C1'], until=T0 + 20 * DAY)
+        self.assertEqual(self.windows(), [(T0 + 10 * DAY, T0 + 20 * DAY)])
+        self.assertEqual(len(store), 10 + 20)
+
+    def test_failed_window_stops_course(self):
+        self.failing.add(('C1', T0 + 31 * DAY))
+        errors = []
+        harvester = ActivityHarvester(self.config)
+        summary = harvester.refresh(['C1', 'C2'], since=T0, until=self.now,
+                                    on_error=lambda shortname, e: errors.append(shortname))
+        self.assertEqual(summary['failed'], ['C1'])
+        self.assertEqual(errors, ['C1'])
+        self.assertEqual(harvester.watermarks[('C1', 'daily')], T0 + 31 * DAY)
+        self.assertEqual(harvester.watermarks[('C2', 'daily')], self.now)
+        self.failing.clear()
+        harvester.refresh(['C1'], until=self.now)
+        self.assertEqual(len(harvester.stores['daily']), 400)
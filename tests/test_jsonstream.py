@@ -0,0 +1,35 @@
+import json
+import random
+import unittest
+
+from muddle.exceptions import MuddleError, WSError
+from muddle.jsonstream import iter_array
+
+
+class IterArrayTest(unittest.TestCase):
+
+    def test_items_split_across_chunks(self):
+        self.assertEqual(list(iter_array([b'[{"id": 1}, {"i', b'd": 2}]'])), [{'id': 1}, {'id': 2}])
+
+    def test_number_cut_before_fraction(self):
+        self.assertEqual(list(iter_array([b'[1, 100000.', b'0]'])), [1, 100000.0])
+        self.assertEqual(list(iter_array([b'[1e', b'5, 2]'])), [100000.0, 2])
+        self.assertEqual(list(iter_array([b'[-', b'1]'])), [-1])
+
+    def test_random_splits(self):
+        rnd = random.Random(1)
+        for _ in range(300):
+            items = [rnd.choice([rnd.randint(-10 ** 6, 10 ** 6), rnd.random() * 10 ** rnd.randint(-5, 8),
+                                 {'a': 'x]'}, 'é', True, None]) for _ in range(rnd.randint(0, 10))]
+            data = json.dumps(items, ensure_ascii=False).encode('utf-8')
+            cuts = sorted(rnd.sample(range(len(data) + 1), min(len(data) + 1, 4)))
+            chunks = [data[i:j] for i, j in zip([0] + cuts, cuts + [len(data)])]
+            self.assertEqual(list(iter_array(chunks)), items)
+
+    def test_incomplete(self):
+        with self.assertRaises(MuddleError):
+            list(iter_array([b'[1, 2']))
+
+    def test_error_object(self):
+        with self.assertRaises(WSError):
+            list(iter_array([b'{"exception": "x", "errorcode": "e", "message": "m"}']))
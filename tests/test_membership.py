@@ -0,0 +1,56 @@
+import unittest
+
+from muddle.api.group import GroupSnapshot
+from muddle.membership import Membership
+
+
+class MembershipTest(unittest.TestCase):
+
+    def setUp(self):
+        self.ms = Membership.from_members_map({1: [10, 11, 12], 2: [12, 13], 3: []})
+        self.ms.add_grouping(7, [1, 2])
+
+    def test_algebra(self):
+        one, two = self.ms.group(1), self.ms.group(2)
+        self.assertEqual((one | two).userids(), {10, 11, 12, 13})
+        self.assertEqual((one & two).userids(), {12})
+        self.assertEqual((one - two).userids(), {10, 11})
+        self.assertEqual((one ^ two).userids(), {10, 11, 13})
+        self.assertEqual(self.ms.grouping(7), one | two)
+        self.assertEqual(self.ms.union([one, two, self.ms.group(3)]), one | two)
+        self.assertEqual(self.ms.intersection([one, two]), one & two)
+        self.assertFalse(self.ms.intersection([]))
+
+    def test_membership_and_counts(self):
+        one = self.ms.group(1)
+        self.assertIn(11, one)
+        self.assertNotIn(13, one)
+        self.assertNotIn(99, one)
+        self.assertEqual(len(self.ms.group(99)), 0)
+        self.assertEqual(self.ms.counts(), {1: 3, 2: 2, 3: 0})
+
+    def test_users_outside_groups(self):
+        roster = self.ms.users([11, 13, 20])
+        self.assertEqual((roster - self.ms.group(1)).userids(), {13, 20})
+        self.assertEqual(sorted(roster & self.ms.grouping(7)), [11, 13])
+
+    def test_to_members(self):
+        self.assertEqual(self.ms.group(2).to_members(5),
+                         [{'groupid': 5, 'userid': 12}, {'groupid': 5, 'userid': 13}])
+
+    def test_many_users(self):
+        ms = Membership.from_members_map({1: range(0, 5000, 2), 2: range(0, 5000, 3)})
+        both = ms.group(1) & ms.group(2)
+        self.assertEqual(len(both), len(range(0, 5000, 6)))
+        self.assertEqual(list(both), list(range(0, 5000, 6)))
+
+    def test_sets_from_other_membership_rejected(self):
+        with self.assertRaises(TypeError):
+            self.ms.group(1) | Membership.from_members_map({1: [10]}).group(1)
+
+    def test_from_snapshot(self):
+        snapshot = GroupSnapshot([{'id': 1, 'courseid': 10}, {'id': 2, 'courseid': 10}],
+                                 [{'id': 7, 'courseid': 10}], {7: {2}}, {1: {10, 11}, 2: {11, 12}})
+        ms = Membership.from_snapshot(snapshot)
+        self.assertEqual(ms.grouping(7).userids(), {11, 12})
+        self.assertEqual((ms.group(1) - ms.grouping(7)).userids(), {10})
@@ -0,0 +1,68 @@
+import io
+import threading
+import unittest
+
+from muddle.pipeline import RosterImport, buffered
+
+from .standin import StandInTestCase, ws_error
+
+
+class RosterImportTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.members = set()
+        self.server.on('core_user_get_users_by_field', self.get_users)
+        self.server.on('core_group_add_group_members', self.add_members)
+
+    def get_users(self, args):
+        return [{'id': int(value[1:]), 'username': value} for value in args['values']
+                if value.startswith('u')]
+
+    def add_members(self, args):
+        members = [(int(m['groupid']), int(m['userid'])) for m in args['members']]
+        if any(userid % 10 == 7 for groupid, userid in members):
+            return ws_error('notenrolled', 'User not enrolled')
+        self.members.update(members)
+
+    def test_run(self):
+        lines = ['username,group'] + ['u%d,%d' % (n, n % 3 + 1) for n in range(1, 41)]
+        lines += ['ghost,1', 'u50,lab']
+        errors = []
+        counts = RosterImport(self.config, add_batch_size=40).run(
+            io.StringIO('\n'.join(lines)), on_error=errors.append)
+        self.assertEqual(counts['rows'], 42)
+        self.assertEqual(counts['added'], 36)
+        self.assertEqual(len(self.members), 36)
+        self.assertEqual(sorted(row.line for row in errors if 'group' in row.error),
+                         [8, 18, 28, 38, 43])
+        self.assertIn("No user with username 'ghost'", [row.error for row in errors])
+
+
+class BufferedTest(unittest.TestCase):
+
+    def test_items_and_error_passed_on(self):
+        def items():
+            yield 1
+            yield 2
+            raise KeyError('x')
+        consumed = []
+        with self.assertRaises(KeyError):
+            for item in buffered(items(), 1):
+                consumed.append(item)
+        self.assertEqual(consumed, [1, 2])
+
+    def test_producer_stops_when_consumer_leaves(self):
+        def items():
+            yield 1
+            yield 2
+            raise KeyError('x')
+        before = set(threading.enumerate())
+        rows = buffered(items(), 1)
+        next(rows)
+        producer, = set(threading.enumerate()) - before
+        # Let the producer fill the queue and fail
+        producer.join(0.3)
+        rows.close()
+        producer.join(1)
+        self.assertFalse(producer.is_alive())
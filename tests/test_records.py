@@ -0,0 +1,31 @@
+import unittest
+
+from muddle.exceptions import WSError
+from muddle.records import Course, project, record_type
+
+from .standin import ws_error
+
+
+class RecordsTest(unittest.TestCase):
+
+    def test_project(self):
+        users = project([{'id': 1, 'username': 'u1', 'email': 'x'}], ('id', 'username'))
+        self.assertEqual((users[0].id, users[0]['username']), (1, 'u1'))
+        self.assertEqual(users[0].as_dict(), {'id': 1, 'username': 'u1'})
+        self.assertIsNone(users[0].get('email'))
+        self.assertRaises(KeyError, lambda: users[0]['email'])
+        self.assertFalse(hasattr(users[0], '__dict__'))
+
+    def test_types_shared(self):
+        self.assertIs(record_type(('id', 'name')), record_type(['id', 'name']))
+        self.assertIs(record_type(Course), Course)
+        self.assertRaises(ValueError, record_type, ('id', 'not a name'))
+
+    def test_missing_fields_none(self):
+        course = project([{'id': 2, 'shortname': 'C2'}], Course)[0]
+        self.assertEqual(course, Course.from_dict({'id': 2, 'shortname': 'C2', 'extra': 1}))
+        self.assertIsNone(course.enddate)
+
+    def test_error_raised(self):
+        with self.assertRaises(WSError):
+            project(ws_error('invalidrecord'), Course)
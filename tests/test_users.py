@@ -0,0 +1,54 @@
+import muddle
+from muddle.records import User
+
+from .standin import StandInTestCase
+
+
+class UsersByFieldTest(StandInTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.users = {'u%d' % n: {'id': n, 'username': 'u%d' % n, 'email': 'U%d@example.com' % n}
+                      for n in range(1, 50)}
+        self.server.on('core_user_get_users_by_field', self.get_users)
+        self.api = muddle.users.API(self.config)
+
+    def get_users(self, args):
+        # Moodle's own order (by id, descending here), with repeats
+        found = [self.users[value] for value in args['values'] if value in self.users]
+        return sorted(found, key=lambda user: -user['id'])
+
+    def test_single_chunk_ordered_and_deduped(self):
+        users = self.api.get_users_by_field('username', ['u3', 'U1', 'u2', 'u3', 'nobody'])
+        self.assertEqual([user['id'] for user in users], [3, 1, 2])
+
+    def test_chunks_match_single_call(self):
+        values = ['u%d' % n for n in (9, 4, 30, 4, 12, 1)]
+        single = self.api.get_users_by_field('username', values)
+        chunked = self.api.get_users_by_field('username', values, chunk_size=2)
+        self.assertEqual(single, chunked)
+        self.assertEqual(len(self.server.calls), 4)
+
+    def test_in_batch(self):
+        with self.config.batch() as batch:
+            users = muddle.users.API(batch).get_users_by_field('username', ['u3', 'u1', 'u3'])
+            projected = muddle.users.API(batch).get_users_by_field('username', ['u2'], fields=('email',))
+        self.assertEqual([user['id'] for user in users.result()], [3, 1])
+        self.assertEqual(projected.result()[0].email, 'U2@example.com')
+        self.assertEqual(len(self.server.calls), 1)
+
+    def test_match_reports_misses(self):
+        pairs = self.api.match_users_by_field('username', ['u5', 'ghost'])
+        self.assertEqual([(value, user and user['id']) for value, user in pairs], [('u5', 5), ('ghost', None)])
+
+    def test_fields_projection(self):
+        users = self.api.get_users_by_field('username', ['u5'], fields=('email',))
+        self.assertEqual(users[0]['id'], 5)
+        self.assertEqual(users[0]['email'], 'U5@example.com')
+        self.assertIsInstance(self.api.get_users_by_field('username', ['u5'], fields=User)[0], User)
+
+    def test_resolver_caches_hits_and_misses(self):
+        resolver = self.api.resolver()
+        self.assertEqual(resolver.resolve('username', ['u1', 'ghost', 'u2']), [1, None, 2])
+        self.assertEqual(resolver.resolve('username', ['u2', 'ghost']), [2, None])
+        self.assertEqual(len(self.server.calls), 1)